@@ -0,0 +1,203 @@
+"""
+Throughput and p50/p99 latency of every /products route.
+
+  --target client    drives the app in-process through the Flask test client
+  --target gunicorn  starts a real gunicorn and drives it over HTTP with
+                     --concurrency client threads
+
+Usage: python -m benchmarks.bench_api --size medium --target gunicorn --output api.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.common import add_common_arguments, configure, row_count, seed, summarize, write_results
+
+
+class ClientTarget:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, json=body)
+        response.get_data()
+        return response.status_code, response.get_json(silent=True)
+
+    def close(self):
+        pass
+
+
+class HTTPTarget:
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def request(self, method, path, body=None):
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(self.base_url + path, data=data, method=method)
+        if data is not None:
+            request.add_header("Content-Type", "application/json")
+        try:
+            with urllib.request.urlopen(request) as response:
+                payload = response.read()
+                code = response.status
+        except urllib.error.HTTPError as error:
+            return error.code, None
+        return code, json.loads(payload) if payload else None
+
+    def close(self):
+        pass
+
+
+class GunicornTarget(HTTPTarget):
+    def __init__(self, database_uri, workers, extra_args):
+        port = free_port()
+        super().__init__(f"http://127.0.0.1:{port}")
+        env = dict(os.environ, DATABASE_URI=database_uri)
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", f"--bind=127.0.0.1:{port}",
+             f"--workers={workers}", "--log-level=warning", *extra_args, "service:app"],
+            env=env,
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                if self.request("GET", "/healthcheck")[0] == 200:
+                    return
+            except OSError:
+                time.sleep(0.2)
+        self.close()
+        raise RuntimeError("gunicorn did not become healthy within 30s")
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait(timeout=30)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def scenarios(ids, sample, count):
+    new_product = dict(sample)
+    new_product.pop("id")
+    created = []
+
+    def create():
+        code, data = yield "POST", "/products", new_product
+        if code == 201:
+            created.append(data["id"])
+
+    def delete():
+        product_id = created.pop() if created else 0
+        yield "DELETE", f"/products/{product_id}", None
+
+    def update():
+        product_id = random.choice(ids)
+        yield "PUT", f"/products/{product_id}", dict(new_product, name="bench")
+
+    def static(method, path):
+        def scenario():
+            yield method, path, None
+        return scenario
+
+    routes = {
+        "get_product": lambda: static("GET", f"/products/{random.choice(ids)}")(),
+        "list_by_category": static("GET", f"/products?category={sample['category']}&limit=100"),
+        "list_by_availability": static("GET", "/products?available=true&limit=100"),
+        "list_by_name": static("GET", f"/products?name={sample['name']}"),
+        "list_page": static("GET", "/products?limit=100"),
+        "create_product": create,
+        "update_product": update,
+        "delete_product": delete,
+    }
+    if count <= 10000:
+        routes["list_all"] = static("GET", "/products")
+    return routes
+
+
+def run_scenario(target, scenario):
+    steps = scenario()
+    method, path, body = next(steps)
+    start = time.perf_counter()
+    code, data = target.request(method, path, body)
+    elapsed = time.perf_counter() - start
+    try:
+        steps.send((code, data))
+    except StopIteration:
+        pass
+    return elapsed, code
+
+
+def measure(target, scenario, requests, concurrency):
+    start = time.perf_counter()
+    if concurrency == 1:
+        outcomes = [run_scenario(target, scenario) for _ in range(requests)]
+    else:
+        with ThreadPoolExecutor(concurrency) as pool:
+            outcomes = list(pool.map(lambda _: run_scenario(target, scenario), range(requests)))
+    elapsed = time.perf_counter() - start
+    result = summarize([seconds for seconds, _ in outcomes], elapsed)
+    # a 404 or 429 is as wrong as a 500: its latency is not the route's
+    result["errors"] = sum(1 for _, code in outcomes if not is_success(code))
+    return result
+
+
+def is_success(code):
+    return 200 <= code < 300 or code == 304
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    add_common_arguments(parser)
+    parser.add_argument("--target", choices=["client", "gunicorn"], default="client")
+    parser.add_argument("--requests", type=int, default=500, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--gunicorn-arg", action="append", default=[])
+    parser.add_argument("--no-cache", action="store_true", help="disable the product cache")
+    args = parser.parse_args()
+
+    # measure the routes, not the throttle; also read by the gunicorn target
+    os.environ["RATELIMIT_ENABLED"] = "false"
+    if args.no_cache:
+        os.environ["CACHE_ENABLED"] = "false"
+    app = configure(args)
+    from service.models import Product  # pylint: disable=import-outside-toplevel
+
+    count = row_count(args)
+    seconds = None if args.no_seed else seed(app, count)
+    with app.app_context():
+        ids = [row.id for row in Product.query.with_entities(Product.id).limit(10000)]
+        sample = Product.find(ids[0]).serialize()
+
+    if args.target == "gunicorn":
+        target = GunicornTarget(args.database_uri, args.workers, args.gunicorn_arg)
+    else:
+        target = ClientTarget(app)
+    try:
+        results = {
+            name: measure(target, scenario, args.requests, args.concurrency)
+            for name, scenario in scenarios(ids, sample, count).items()
+        }
+    finally:
+        target.close()
+    write_results(
+        args, f"api-{args.target}", results, seed_seconds=seconds,
+        concurrency=args.concurrency, cache=not args.no_cache,
+    )
+    failed = {name: result["errors"] for name, result in results.items() if result["errors"]}
+    if failed:
+        sys.exit(f"Requests failed, results are not valid: {failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Micro-benchmarks for Product.serialize/deserialize and each find_by_* query.
+
+Usage: python -m benchmarks.bench_models --size small --output models.json
+"""
+import time
+import argparse
+from benchmarks.common import add_common_arguments, configure, row_count, seed, summarize, write_results
+
+
+def measure(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    add_common_arguments(parser)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--query-iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    app = configure(args)
+    from service import db  # pylint: disable=import-outside-toplevel
+    from service.models import Product  # pylint: disable=import-outside-toplevel
+
+    seconds = None if args.no_seed else seed(app, row_count(args))
+    sample = Product.query.first()
+    data = sample.serialize()
+    name, category, available = sample.name, sample.category, sample.available
+
+    def run_query(query):
+        def func():
+            query().all()
+            db.session.remove()
+        return func
+
+    results = {
+        "serialize": measure(sample.serialize, args.iterations),
+        "deserialize": measure(lambda: Product().deserialize(data), args.iterations),
+        "find": measure(lambda: (Product.find(sample.id), db.session.remove()), args.iterations),
+    }
+    queries = {
+        "find_by_name": lambda: Product.find_by_name(name),
+        "find_by_category": lambda: Product.find_by_category(category),
+        "find_by_availability": lambda: Product.find_by_availability(available),
+        "find_by_filters": lambda: Product.find_by_filters(category=category, available=available),
+    }
+    for label, query in queries.items():
+        results[label] = measure(run_query(query), args.query_iterations)
+    write_results(args, "models", results, seed_seconds=seconds)
+
+
+if __name__ == "__main__":
+    main()
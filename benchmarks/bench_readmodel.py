@@ -0,0 +1,86 @@
+"""
+Compares the in-memory read model with the ORM for the hot read paths:
+
+  build / load    write the snapshot file, and map it back in
+  get             one product by id (read model vs Product.find)
+  find_category   every product in a category (read model vs find_by_category)
+  memory          Python heap held by the whole catalog: mapped snapshot
+                  vs Product.all()
+
+Usage: python -m benchmarks.bench_readmodel --size medium
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from benchmarks.common import add_common_arguments, configure, row_count, seed, summarize, write_results
+
+
+def measure(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def heap_bytes(func):
+    tracemalloc.start()
+    kept = func()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    add_common_arguments(parser)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--query-iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    app = configure(args)
+    from service import db  # pylint: disable=import-outside-toplevel
+    from service.models import Product, Category  # pylint: disable=import-outside-toplevel
+    from service.readmodel import Snapshot, read_model  # pylint: disable=import-outside-toplevel
+
+    seconds = None if args.no_seed else seed(app, row_count(args))
+    path = os.path.join(tempfile.gettempdir(), "bench_catalog.snapshot")
+    read_model.configure(app, path, refresh_interval=3600)
+    read_model.enabled = True
+
+    with app.app_context():
+        start = time.perf_counter()
+        read_model.build()
+        build_seconds = time.perf_counter() - start
+        results = {
+            "build_ms": build_seconds * 1000,
+            "load": measure(lambda: Snapshot(path), 20),
+        }
+        read_model.load()
+        ids = [row.id for row in Product.query.with_entities(Product.id)]
+        db.session.remove()
+        results["get_read_model"] = measure(lambda: read_model.get(random.choice(ids)).serialize(), args.iterations)
+        results["get_orm"] = measure(
+            lambda: (Product.find(random.choice(ids)).serialize(), db.session.remove()), args.iterations
+        )
+        results["find_category_read_model"] = measure(
+            lambda: [row.serialize() for row in read_model.find(Category.FOOD)], args.query_iterations
+        )
+        results["find_category_orm"] = measure(
+            lambda: ([p.serialize() for p in Product.find_by_category(Category.FOOD)], db.session.remove()),
+            args.query_iterations,
+        )
+        results["memory_read_model_bytes"] = heap_bytes(lambda: Snapshot(path))
+        results["memory_orm_bytes"] = heap_bytes(Product.all)
+        results["snapshot_file_bytes"] = os.path.getsize(path)
+    os.remove(path)
+    write_results(args, "readmodel", results, seed_seconds=seconds)
+
+
+if __name__ == "__main__":
+    main()
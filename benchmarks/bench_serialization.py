@@ -0,0 +1,71 @@
+"""
+Compares the two ways GET /products can build its response body:
+
+  orm   Product instances -> serialize() -> jsonify   (the original path)
+  fast  Product.rows() tuples -> serialize_row() -> encoding.dumps
+
+Usage: python -m benchmarks.bench_serialization --rows 10000 --repeat 5
+"""
+import time
+import argparse
+import statistics
+from flask import jsonify
+from benchmarks.common import add_common_arguments, configure, row_count, seed, write_results
+
+
+def orm_path():
+    from service import app  # pylint: disable=import-outside-toplevel
+    from service.models import Product  # pylint: disable=import-outside-toplevel
+
+    with app.test_request_context():
+        products = Product.paginate(Product.query).all()
+        return jsonify([product.serialize() for product in products]).get_data()
+
+
+def fast_path():
+    from service import encoding  # pylint: disable=import-outside-toplevel
+    from service.models import Product  # pylint: disable=import-outside-toplevel
+
+    rows = Product.rows(Product.paginate(Product.query)).all()
+    return encoding.dumps([Product.serialize_row(row) for row in rows])
+
+
+def measure(func, repeat):
+    from service import db  # pylint: disable=import-outside-toplevel
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = func()
+        timings.append(time.perf_counter() - start)
+        # drop the identity map so every run hydrates from scratch
+        db.session.remove()
+    return {
+        "median_s": statistics.median(timings),
+        "min_s": min(timings),
+        "bytes": len(body),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    add_common_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = configure(args)
+    from service import encoding  # pylint: disable=import-outside-toplevel
+
+    seconds = None if args.no_seed else seed(app, row_count(args))
+    results = {
+        "orm": measure(orm_path, args.repeat),
+        "fast": measure(fast_path, args.repeat),
+    }
+    results["fast"]["speedup"] = results["orm"]["median_s"] / results["fast"]["median_s"]
+    write_results(
+        args, "serialization", results, seed_seconds=seconds, encoder=encoding.encoder_name()
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Measures what a gunicorn worker pays before it can answer its first request:
+
+  import          import service (no app yet)
+  create_app      import service and build the app
+  cold_worker     import, build the app and serve GET /healthcheck and one
+                  GET /products page: a worker without --preload
+  preload_worker  fork a process that already built the app and serve the
+                  same two requests: a worker respawned under --preload
+
+Every sample runs in a fresh interpreter, so nothing is warm.
+
+Usage: python -m benchmarks.bench_startup --repeat 10
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+from benchmarks.common import add_common_arguments, configure, write_results
+
+FIRST_REQUESTS = """
+client = app.test_client()
+assert client.get("/healthcheck").status_code == 200
+assert client.get("/products", query_string="limit=1").status_code == 200
+"""
+
+SCRIPTS = {
+    "import": """
+start = time.perf_counter()
+import service
+elapsed = time.perf_counter() - start
+""",
+    "create_app": """
+start = time.perf_counter()
+import service
+app = service.create_app()
+elapsed = time.perf_counter() - start
+""",
+    "cold_worker": """
+start = time.perf_counter()
+import service
+app = service.create_app()
+""" + FIRST_REQUESTS + """
+elapsed = time.perf_counter() - start
+""",
+    "preload_worker": """
+import service
+from service import db
+app = service.create_app()
+read, write = os.pipe()
+start = time.perf_counter()
+pid = os.fork()
+if pid == 0:
+    with app.app_context():
+        db.engine.dispose(close=False)
+""" + "\n".join("    " + line for line in FIRST_REQUESTS.strip().splitlines()) + """
+    os.write(write, str(time.perf_counter() - start).encode())
+    os._exit(0)
+os.waitpid(pid, 0)
+elapsed = float(os.read(read, 64))
+""",
+}
+
+
+def sample(name, database_uri):
+    code = "import os, time\n" + SCRIPTS[name] + "\nprint(elapsed)\n"
+    env = dict(os.environ, DATABASE_URI=database_uri)
+    output = subprocess.check_output([sys.executable, "-c", code], env=env, text=True)
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    add_common_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    # the table has to exist for the first GET /products
+    app = configure(args)
+    from service import db  # pylint: disable=import-outside-toplevel
+    from service.models import Product  # pylint: disable=import-outside-toplevel
+
+    with app.app_context():
+        db.create_all()
+        args.rows = Product.query.count()
+
+    results = {}
+    for name in SCRIPTS:
+        if name == "preload_worker" and not hasattr(os, "fork"):
+            continue
+        timings = [sample(name, args.database_uri) for _ in range(args.repeat)]
+        results[name] = {
+            "median_ms": statistics.median(timings) * 1000,
+            "min_ms": min(timings) * 1000,
+        }
+    write_results(args, "startup", results, repeat=args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Helpers shared by the benchmark scripts: seeding, timing and result files.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+
+SIZES = {"small": 1000, "medium": 100000, "large": 1000000}
+SEED_CHUNK = 10000
+DEFAULT_DATABASE_URI = "sqlite:///" + os.path.join(tempfile.gettempdir(), "bench.db")
+
+
+def add_common_arguments(parser):
+    parser.add_argument("--size", choices=sorted(SIZES), default="small")
+    parser.add_argument("--rows", type=int, help="overrides --size")
+    parser.add_argument("--database-uri", default=DEFAULT_DATABASE_URI)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--no-seed", action="store_true", help="reuse the existing data")
+
+
+def row_count(args):
+    return args.rows if args.rows else SIZES[args.size]
+
+
+def configure(args):
+    # the service reads DATABASE_URI at import time, so set it first
+    os.environ["DATABASE_URI"] = args.database_uri
+    from service import app  # pylint: disable=import-outside-toplevel
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = args.database_uri
+    return app
+
+
+def seed(app, count):
+    from service import db  # pylint: disable=import-outside-toplevel
+    from service.models import Product  # pylint: disable=import-outside-toplevel
+    from tests.factories import ProductFactory  # pylint: disable=import-outside-toplevel
+
+    start = time.perf_counter()
+    Product.init_db(app)
+    for offset in range(0, count, SEED_CHUNK):
+        Product.create_batch(ProductFactory.create_batch(min(SEED_CHUNK, count - offset)))
+    db.session.remove()
+    return time.perf_counter() - start
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summarize(samples, elapsed=None):
+    elapsed = sum(samples) if elapsed is None else elapsed
+    return {
+        "count": len(samples),
+        "ops_per_s": len(samples) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples) * 1000 if samples else 0.0,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(args, suite, results, **meta):
+    document = {
+        "suite": suite,
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "database_uri": args.database_uri,
+        "rows": row_count(args),
+        **meta,
+        "results": results,
+    }
+    text = json.dumps(document, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            output.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+    return document
@@ -0,0 +1,54 @@
+"""
+Compares two benchmark result files and reports regressions.
+
+Usage: python -m benchmarks.compare baseline.json candidate.json --threshold 0.10
+
+Exits with status 1 when any shared benchmark's p50 or p99 latency grew,
+or its throughput dropped, by more than the threshold.
+"""
+import sys
+import json
+import argparse
+
+# metric -> True when a larger value is better
+METRICS = {"ops_per_s": True, "p50_ms": False, "p99_ms": False}
+
+
+def compare(baseline, candidate, threshold):
+    rows, regressions = [], []
+    for name in sorted(set(baseline["results"]) & set(candidate["results"])):
+        before, after = baseline["results"][name], candidate["results"][name]
+        for metric, higher_is_better in METRICS.items():
+            if not before.get(metric) or metric not in after:
+                continue
+            change = (after[metric] - before[metric]) / before[metric]
+            worse = -change if higher_is_better else change
+            rows.append((name, metric, before[metric], after[metric], change))
+            if worse > threshold:
+                regressions.append((name, metric, change))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args()
+
+    with open(args.baseline, encoding="utf-8") as baseline_file:
+        baseline = json.load(baseline_file)
+    with open(args.candidate, encoding="utf-8") as candidate_file:
+        candidate = json.load(candidate_file)
+    rows, regressions = compare(baseline, candidate, args.threshold)
+
+    print(f"{baseline.get('commit')} -> {candidate.get('commit')} ({baseline['suite']})")
+    for name, metric, before, after, change in rows:
+        print(f"{name:24} {metric:10} {before:12.3f} {after:12.3f} {change:+8.1%}")
+    for name, metric, change in regressions:
+        print(f"REGRESSION: {name} {metric} {change:+.1%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,143 @@ import os
 # Get the base directory
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-DATABASE_URI = "sqlite:///" + os.path.join(basedir, "test.db")
+BASE_DIR = basedir
+
+DATABASE_URI = os.getenv("DATABASE_URI", "sqlite:///" + os.path.join(basedir, "test.db"))
+SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# Connection pool; size it so that workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+# stays below the database's connection limit. DB_POOL_SIZE=0 disables pooling.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() in ["true", "yes", "1"],
+}
+
+# Applied to every new SQLite connection
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# Read replicas: GET requests read from one of DATABASE_REPLICA_URIS (comma
+# separated) that is reachable and at most REPLICA_MAX_LAG revisions (on
+# PostgreSQL, bytes of WAL, so give it a few megabytes there) behind the
+# primary, else from the primary. Replicas are re-checked every
+# REPLICA_CHECK_INTERVAL seconds. After a write, the client's session cookie
+# keeps its reads off replicas that have not caught up with that write.
+DATABASE_REPLICA_URIS = [uri for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri]
+REPLICA_MAX_LAG = int(os.getenv("REPLICA_MAX_LAG", "1000"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+
+# Sharding: when DATABASE_SHARD_URIS (comma separated) is set, product rows are
+# spread over those databases by id (id % number of shards) and list queries
+# read every shard; the primary keeps everything else and hands out ids in
+# blocks of SHARD_ID_BLOCK_SIZE. The number of shards cannot change once
+# products were written.
+DATABASE_SHARD_URIS = [uri for uri in os.getenv("DATABASE_SHARD_URIS", "").split(",") if uri]
+SHARD_ID_BLOCK_SIZE = int(os.getenv("SHARD_ID_BLOCK_SIZE", "100"))
+
 SECRET_KEY = "please, tell me... in your heart"
+
+# Pagination and streaming for GET /products
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+
+# Change feed (/products/changes): long polls hold a worker thread, so keep
+# CHANGES_MAX_WAIT below the proxy and gunicorn timeouts
+CHANGES_PAGE_SIZE = 100
+CHANGES_MAX_WAIT = int(os.getenv("CHANGES_MAX_WAIT", "25"))
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "0.5"))
+
+# Batch endpoints (/products/batch)
+MAX_BATCH_SIZE = 10000
+
+# Bulk import (/products/import): rows per INSERT transaction
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+
+# Rate limiting (off unless RATELIMIT_ENABLED): a token bucket per client
+# (a known X-API-Key, else its address) that refills at RATELIMIT_RATE
+# tokens/s up to RATELIMIT_BURST. Expensive
+# endpoints cost more (see service.ratelimit.DEFAULT_COSTS, overridable via
+# RATELIMIT_COSTS). Buckets are per worker unless RATELIMIT_STORAGE_URL
+# points at Redis. MAX_IN_FLIGHT > 0 sheds requests with 503 beyond that
+# many concurrent ones per worker; size it to the DB pool for threaded workers.
+RATELIMIT_ENABLED = os.getenv("RATELIMIT_ENABLED", "false").lower() in ["true", "yes", "1"]
+RATELIMIT_RATE = float(os.getenv("RATELIMIT_RATE", "20"))
+RATELIMIT_BURST = int(os.getenv("RATELIMIT_BURST", "200"))
+RATELIMIT_COSTS = {}
+RATELIMIT_STORAGE_URL = os.getenv("RATELIMIT_STORAGE_URL")
+# Only these X-API-Key values (comma separated) get a bucket of their own;
+# requests with any other key are limited by address
+RATELIMIT_API_KEYS = [key for key in os.getenv("RATELIMIT_API_KEYS", "").split(",") if key]
+# Number of reverse proxies in front of the service whose X-Forwarded-For /
+# X-Forwarded-Proto are trusted; 0 uses the socket peer as the client address
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "0"))
+
+# Background jobs (/jobs): a thread pool per worker, or RQ workers when
+# JOB_BROKER_URL points at Redis (needs the rq package). Uploads are spooled
+# to JOB_SPOOL_DIR, which RQ workers must be able to read as well.
+JOB_THREADS = int(os.getenv("JOB_THREADS", "2"))
+JOB_BROKER_URL = os.getenv("JOB_BROKER_URL")
+JOB_QUEUE_NAME = os.getenv("JOB_QUEUE_NAME", "catalog-jobs")
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", "3600"))
+JOB_SPOOL_DIR = os.getenv("JOB_SPOOL_DIR")
+# Each worker, once started, fails running jobs that have not reported progress
+# for JOB_STALE_AFTER seconds and requeues queued ones that waited that long
+JOB_STALE_AFTER = int(os.getenv("JOB_STALE_AFTER", "600"))
+
+# Request coalescing: identical list/stats requests in flight in one worker
+# share a single query and response body; a waiter gives up on a leader
+# after COALESCE_TIMEOUT seconds and runs the query itself
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() in ["true", "yes", "1"]
+COALESCE_TIMEOUT = float(os.getenv("COALESCE_TIMEOUT", "30"))
+
+# Product cache: in-process LRU per worker unless CACHE_URL points at a
+# shared Redis (needs the redis package), in which case invalidations are
+# seen by every worker
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() in ["true", "yes", "1"]
+CACHE_URL = os.getenv("CACHE_URL")
+CACHE_TTL = int(os.getenv("CACHE_TTL", "60"))
+CACHE_MAX_ENTRIES = 10000
+CACHE_MAX_LIST_ITEMS = 1000
+
+# In-process read model: GET /products/<id> and lists filtered only by
+# category/available are answered from a memory-mapped catalog snapshot
+# (READ_MODEL_SNAPSHOT, written on first start and again whenever it was
+# taken of another catalog or is ahead of the database) plus the writes made since,
+# read from the change feed right after this worker writes and at most every
+# READ_MODEL_REFRESH_INTERVAL seconds otherwise. The snapshot is rewritten
+# once READ_MODEL_MAX_OVERLAY products changed since it was taken.
+READ_MODEL_ENABLED = os.getenv("READ_MODEL_ENABLED", "false").lower() in ["true", "yes", "1"]
+READ_MODEL_SNAPSHOT = os.getenv("READ_MODEL_SNAPSHOT", os.path.join(basedir, "catalog.snapshot"))
+READ_MODEL_REFRESH_INTERVAL = float(os.getenv("READ_MODEL_REFRESH_INTERVAL", "1"))
+READ_MODEL_MAX_OVERLAY = int(os.getenv("READ_MODEL_MAX_OVERLAY", "10000"))
+
+# Query profiling (off unless PROFILE_ENABLED): per-statement timings at
+# /stats/queries, a warning with the bound parameters and EXPLAIN plan for
+# statements slower than PROFILE_SLOW_QUERY_MS, and one for requests that run
+# the same SELECT PROFILE_N_PLUS_ONE times or more. PROFILE_SAMPLE_RATE of the
+# requests, and those sending "X-Profile: <PROFILE_TOKEN>", are profiled
+# (pyinstrument when installed, else cProfile); the report is written to
+# PROFILE_DIR and served at /stats/profiles/<X-Profile-Id>. /stats/queries
+# shows slow queries' bound values only to requests sending the token.
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "false").lower() in ["true", "yes", "1"]
+PROFILE_SLOW_QUERY_MS = float(os.getenv("PROFILE_SLOW_QUERY_MS", "100"))
+PROFILE_EXPLAIN = os.getenv("PROFILE_EXPLAIN", "true").lower() in ["true", "yes", "1"]
+PROFILE_N_PLUS_ONE = int(os.getenv("PROFILE_N_PLUS_ONE", "10"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+
+# Response compression: gzip, or brotli when the brotli package is installed.
+# Bodies under COMPRESS_MIN_SIZE bytes are sent as is.
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+
+# Async (ASGI) app: defaults to DATABASE_URI with its async driver swapped in
+ASYNC_DATABASE_URI = os.getenv("ASYNC_DATABASE_URI")
@@ -4,6 +4,7 @@ from service.models import Product, Category
 @given('the following products')
 def step_impl(context):
     """ Load Products into the database """
+    products = []
     for row in context.table:
         product = Product()
         product.name = row['name']
@@ -11,4 +12,5 @@ def step_impl(context):
         product.price = float(row['price'])
         product.available = row['available'] in ['True', 'true', '1']
         product.category = getattr(Category, row['category'].upper())
-        product.create()
+        products.append(product)
+    Product.create_batch(products)
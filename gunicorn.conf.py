@@ -0,0 +1,44 @@
+#
+# Gunicorn settings, picked up automatically from the working directory
+#
+import os
+import shutil
+
+# Build the app once in the master; forked workers start in milliseconds.
+# GUNICORN_PRELOAD=false restores per-worker imports (e.g. for code reload).
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() in ["true", "yes", "1"]
+
+# Start every deployment with an empty multiprocess metrics directory. This
+# runs when gunicorn reads its settings, before a preloaded app is imported:
+# prometheus_client writes its files as soon as service.metrics is imported.
+_multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if _multiproc_dir:
+    shutil.rmtree(_multiproc_dir, ignore_errors=True)
+    os.makedirs(_multiproc_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    if not server.cfg.preload_app:
+        return
+    # pooled connections opened in the master must never be shared across
+    # processes; drop them without closing the parent's sockets
+    from service import app, db  # pylint: disable=import-outside-toplevel
+
+    with app.app_context():
+        for bind in [None] + list(app.config["SQLALCHEMY_BINDS"]):
+            db.get_engine(app, bind).dispose(close=False)
+
+
+def post_worker_init(worker):
+    # fail or requeue jobs a previous (recycled or crashed) worker left behind
+    from service import app  # pylint: disable=import-outside-toplevel
+    from service.jobs import recover_jobs  # pylint: disable=import-outside-toplevel
+
+    recover_jobs(app)
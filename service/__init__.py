@@ -1,13 +1,61 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from . import config
+from werkzeug.middleware.proxy_fix import ProxyFix
+from .database import Database, init_database
 
-app = Flask(__name__)
-app.config.from_object(config)
-db = SQLAlchemy(app)
+db = Database()
 
-from . import routes, models
 
-# Set up logging
-routes.init_logging(app)
-app.logger.info("Product Service running...")
+def create_app(config=None):
+    """Builds the Flask app; config is a settings object or a dict of overrides"""
+    from . import config as default_config
+    from . import routes
+    from .cache import init_cache
+    from .metrics import init_metrics
+    from .compression import init_compression
+    from .jobs import init_jobs
+    from .ratelimit import init_rate_limit
+    from .replicas import init_replicas
+    from .sharding import init_sharding
+    from .readmodel import init_read_model
+    from .singleflight import init_coalescing
+    from .profiling import init_profiling
+
+    app = Flask(__name__)
+    app.config.from_object(default_config)
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+    if app.config.get("TRUSTED_PROXIES"):
+        # client addresses (rate limits, logs) come from the proxies' headers
+        hops = app.config["TRUSTED_PROXIES"]
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+    init_database(app)
+    db.init_app(app)
+    init_sharding(app)
+    app.register_blueprint(routes.blueprint)
+
+    # Set up logging
+    routes.init_logging(app)
+    init_cache(app)
+    init_metrics(app)
+    init_rate_limit(app)
+    init_replicas(app)
+    init_compression(app)
+    init_jobs(app)
+    init_read_model(app)
+    init_coalescing(app)
+    init_profiling(app)
+    app.logger.info("Product Service running...")
+    return app
+
+
+def __getattr__(name):
+    # `from service import app` builds the default app on first use, so that
+    # importing a submodule (or gunicorn's factory call) does not build it twice
+    if name == "app":
+        app = create_app()
+        db.app = app  # lets scripts and tests use db outside an app context
+        globals()["app"] = app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
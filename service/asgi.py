@@ -0,0 +1,339 @@
+"""
+Async (ASGI) entry point for the core /products contract, backed by an async
+SQLAlchemy engine (aiosqlite locally, asyncpg in production). Run it with:
+
+    uvicorn service.asgi:app --host 0.0.0.0 --port 8080
+
+It serves /healthcheck, GET/POST /products and GET/PUT/DELETE
+/products/<id>, with the same bodies, status codes and ETags as the Flask
+routes. List arguments it does not implement are rejected with 400 rather
+than ignored. Only the Flask app serves the rest of the API: PATCH, the
+/products/batch, /products/stats, /products/changes, /products/import and
+/products/export routes, /jobs, and the /stats and /metrics endpoints.
+
+It reads and writes a single database, so it refuses to start when products
+are sharded (DATABASE_SHARD_URIS); serve a sharded catalog from the Flask app.
+"""
+import re
+import json
+import logging
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlencode
+from werkzeug.datastructures import MultiDict
+from sqlalchemy import inspect, select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from . import app as flask_app
+from . import encoding, query_args, status
+from .models import Product, DataValidationError, FIELDS
+from .cache import product_cache
+
+logger = logging.getLogger("flask.app")
+
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+}
+# GET /products arguments this app implements; anything else is a 400
+LIST_ARGS = {
+    "category", "available", "name", "price_min", "price_max", "sort", "limit", "cursor", "fields", "q",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = MultiDict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        self.headers = {
+            name.decode("latin-1").lower(): value.decode("latin-1")
+            for name, value in scope.get("headers", [])
+        }
+        self.scheme = scope.get("scheme", "http")
+        self.body = body
+
+    def get_json(self):
+        content_type = self.headers.get("content-type", "").split(";")[0].strip()
+        if content_type != "application/json":
+            raise HTTPError(
+                status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                "Content-Type must be application/json",
+            )
+        try:
+            return json.loads(self.body or b"null")
+        except ValueError:
+            raise HTTPError(status.HTTP_400_BAD_REQUEST, "Request body is not valid JSON")
+
+    def url_for(self, path, args=None):
+        host = self.headers.get("host", "localhost")
+        query = "?" + urlencode(args) if args else ""
+        return f"{self.scheme}://{host}{path}{query}"
+
+
+def async_database_uri(uri):
+    scheme, separator, rest = uri.partition("://")
+    if "+" in scheme:
+        return uri  # an explicit driver was chosen
+    driver = ASYNC_DRIVERS.get(scheme)
+    return driver + separator + rest if driver else uri
+
+
+class ProductASGI:
+    def __init__(self, database_uri, **engine_options):
+        self.engine = create_async_engine(async_database_uri(database_uri), **engine_options)
+        self.sessions = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.fts_index = None  # whether SQLite has product_fts, checked on first search
+        self.routes = [
+            ("GET", re.compile(r"^/healthcheck$"), self.healthcheck),
+            ("GET", re.compile(r"^/products$"), self.list_products),
+            ("POST", re.compile(r"^/products$"), self.create_products),
+            ("GET", re.compile(r"^/products/(\d+)$"), self.get_products),
+            ("PUT", re.compile(r"^/products/(\d+)$"), self.update_products),
+            ("DELETE", re.compile(r"^/products/(\d+)$"), self.delete_products),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        request = Request(scope, body)
+        try:
+            code, payload, headers = await self.dispatch(request)
+        except HTTPError as error:
+            code, payload, headers = error.code, error_body(error.code, error.message), {}
+        except DataValidationError as error:
+            code = status.HTTP_400_BAD_REQUEST
+            payload, headers = error_body(code, str(error)), {}
+        body = b"" if payload is None else encoding.dumps(payload)
+        raw_headers = [(b"content-length", str(len(body)).encode())]
+        if payload is not None:
+            raw_headers.append((b"content-type", b"application/json"))
+        raw_headers.extend((k.lower().encode(), v.encode()) for k, v in headers.items())
+        await send({"type": "http.response.start", "status": code, "headers": raw_headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                logger.info("Async Product Service running...")
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def dispatch(self, request):
+        allowed = False
+        for method, pattern, handler in self.routes:
+            match = pattern.match(request.path)
+            if match:
+                allowed = True
+                if method == request.method:
+                    return await handler(request, *(int(arg) for arg in match.groups()))
+        if allowed:
+            raise HTTPError(status.HTTP_405_METHOD_NOT_ALLOWED, "Method not allowed")
+        raise HTTPError(status.HTTP_404_NOT_FOUND, f"{request.path} was not found")
+
+    ##################################################################
+    # ROUTES
+    ##################################################################
+
+    async def healthcheck(self, request):
+        return status.HTTP_200_OK, {"status": "OK"}, {}
+
+    async def create_products(self, request):
+        logger.info("Request to create a product")
+        product = Product().deserialize(request.get_json())
+        async with self.sessions() as session:
+            session.add(product)
+            await session.commit()
+        product_cache.invalidate()
+        headers = {"Location": request.url_for(f"/products/{product.id}"), "ETag": etag(product)}
+        return status.HTTP_201_CREATED, product.serialize(), headers
+
+    async def get_products(self, request, product_id):
+        logger.info("Request for product with id: %s", product_id)
+        fields = query_args.parse_fields(request.args.get("fields"))
+        async with self.sessions() as session:
+            product = await find_or_404(session, product_id)
+        tag = etag(product)
+        if fields is not None:
+            # a partial representation needs an ETag of its own
+            tag = f'"{product_cache.etag(product)};{",".join(fields)}"'
+        if if_none_match(request, tag):
+            return status.HTTP_304_NOT_MODIFIED, None, {"ETag": tag}
+        return status.HTTP_200_OK, product.serialize(fields), {"ETag": tag}
+
+    async def update_products(self, request, product_id):
+        logger.info("Request to update product with id: %s", product_id)
+        data = request.get_json()
+        async with self.sessions() as session:
+            product = await find_or_404(session, product_id)
+            check_if_match(request, product)
+            product.deserialize(data)
+            await commit_versioned(request, session, product_id)
+        product_cache.invalidate([product_id])
+        return status.HTTP_200_OK, product.serialize(), {"ETag": etag(product)}
+
+    async def delete_products(self, request, product_id):
+        logger.info("Request to delete product with id: %s", product_id)
+        async with self.sessions() as session:
+            product = await session.get(Product, product_id)
+            if product:
+                check_if_match(request, product)
+                await session.delete(product)
+                await commit_versioned(request, session, product_id)
+                product_cache.invalidate([product_id])
+            elif "if-match" in request.headers:
+                raise HTTPError(
+                    status.HTTP_412_PRECONDITION_FAILED,
+                    f"Product with id '{product_id}' was not found.",
+                )
+        return status.HTTP_204_NO_CONTENT, None, {}
+
+    async def list_products(self, request):
+        logger.info("Request for product list")
+        args = request.args
+        unsupported = set(args).difference(LIST_ARGS)
+        if unsupported:
+            raise HTTPError(
+                status.HTTP_400_BAD_REQUEST,
+                "Query arguments not supported by the async app: " + ", ".join(sorted(unsupported)),
+            )
+        sort = args.get("sort", "id")
+        column, _ = Product.sort_column(sort)
+        fields = query_args.parse_fields(args.get("fields")) or FIELDS
+        filters = query_args.parse_filters(args)
+        if args.get("q"):
+            return await self.search_products(request, fields, filters)
+        limit, cursor = args.get("limit"), args.get("cursor")
+        if limit is None and cursor is None:
+            statement = Product.find_by_filters(query=select(*Product.row_columns(fields)), **filters)
+            async with self.sessions() as session:
+                rows = await session.execute(Product.paginate(statement, sort=sort))
+            return status.HTTP_200_OK, [Product.serialize_row(row, fields) for row in rows], {}
+
+        limit = self.page_size(limit)
+        after = query_args.decode_cursor(cursor, sort) if cursor else None
+        # the cursor needs id and the sort key even when they were not requested
+        selected = tuple(f for f in FIELDS if f in fields or f in ("id", column.key))
+        statement = Product.find_by_filters(query=select(*Product.row_columns(selected)), **filters)
+        async with self.sessions() as session:
+            page = (await session.execute(Product.paginate(statement, after, limit + 1, sort))).all()
+        results = [Product.serialize_row(row, selected) for row in page[:limit]]
+        headers = {}
+        if len(page) > limit:
+            headers = next_page_headers(request, query_args.encode_cursor(results[-1], sort), limit)
+        if selected != fields:
+            results = [{field: data[field] for field in fields} for data in results]
+        return status.HTTP_200_OK, results, headers
+
+    async def search_products(self, request, fields, filters):
+        # ranked results are always paged; the cursor carries the next offset
+        args = request.args
+        limit = self.page_size(args.get("limit"))
+        cursor = args.get("cursor")
+        offset = query_args.decode_offset_cursor(cursor) if cursor else 0
+        dialect = self.engine.dialect.name
+        if dialect == "sqlite" and self.fts_index is None:
+            async with self.engine.connect() as connection:
+                self.fts_index = await connection.run_sync(
+                    lambda sync: inspect(sync).has_table("product_fts")
+                )
+        statement = Product.find_by_filters(query=select(*Product.row_columns(fields)), **filters)
+        ranked = Product.search(args["q"], statement, dialect, self.fts_index)
+        async with self.sessions() as session:
+            page = (await session.execute(ranked.offset(offset).limit(limit + 1))).all()
+        results = [Product.serialize_row(row, fields) for row in page[:limit]]
+        headers = {}
+        if len(page) > limit:
+            headers = next_page_headers(request, query_args.encode_offset_cursor(offset + limit), limit)
+        return status.HTTP_200_OK, results, headers
+
+    @staticmethod
+    def page_size(limit):
+        return query_args.parse_limit(
+            limit,
+            flask_app.config.get("DEFAULT_PAGE_SIZE", 100),
+            flask_app.config.get("MAX_PAGE_SIZE", 1000),
+        )
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+
+async def find_or_404(session, product_id):
+    product = await session.get(Product, product_id)
+    if not product:
+        raise HTTPError(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+    return product
+
+
+def next_page_headers(request, next_cursor, limit):
+    next_url = request.url_for("/products", dict(request.args.items(), limit=limit, cursor=next_cursor))
+    return {"Link": f'<{next_url}>; rel="next"', "X-Next-Cursor": next_cursor}
+
+
+def etag(product):
+    return f'"{product_cache.etag(product)}"'
+
+
+def if_none_match(request, tag):
+    candidates = request.headers.get("if-none-match", "")
+    return tag in [candidate.strip() for candidate in candidates.split(",")] or candidates == "*"
+
+
+def check_if_match(request, product):
+    candidates = request.headers.get("if-match")
+    if candidates is None or candidates.strip() == "*":
+        return
+    tags = [candidate.strip().removeprefix("W/") for candidate in candidates.split(",")]
+    if etag(product) not in tags:
+        raise HTTPError(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"Product with id '{product.id}' has changed, fetch it again and retry",
+        )
+
+
+async def commit_versioned(request, session, product_id):
+    try:
+        await session.commit()
+    except StaleDataError:
+        await session.rollback()
+        product_cache.invalidate([product_id])
+        code = (
+            status.HTTP_412_PRECONDITION_FAILED
+            if "if-match" in request.headers
+            else status.HTTP_409_CONFLICT
+        )
+        raise HTTPError(code, f"Product with id '{product_id}' was changed by another request")
+
+
+def error_body(code, message):
+    return {"status": code, "error": HTTPStatus(code).phrase, "message": message}
+
+
+if flask_app.config.get("DATABASE_SHARD_URIS"):
+    raise RuntimeError("The async app does not support sharded products; unset DATABASE_SHARD_URIS")
+
+app = ProductASGI(
+    flask_app.config.get("ASYNC_DATABASE_URI")
+    or flask_app.config.get("SQLALCHEMY_DATABASE_URI", flask_app.config.get("DATABASE_URI"))
+)
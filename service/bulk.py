@@ -0,0 +1,141 @@
+import io
+import csv
+import json
+import logging
+from .models import Product, DataValidationError, BATCH_CHUNK_SIZE, COLUMNS, FIELDS
+from . import encoding
+
+logger = logging.getLogger("flask.app")
+
+# Streaming bulk import and export of the catalog as CSV or NDJSON. Uploads
+# are parsed record by record and inserted one chunk at a time, so memory
+# stays bounded by the chunk size whatever the file size. A CSV upload is
+# read through once before anything is inserted: one that is not UTF-8 or
+# not well-formed CSV is rejected whole, with its line number, instead of
+# failing after earlier chunks have committed.
+
+IMPORT_FORMATS = {"text/csv": "csv", "application/x-ndjson": "ndjson"}
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+REQUIRED_COLUMNS = ("name", "price", "available", "category")
+MAX_REPORTED_ERRORS = 100
+CSV_FLUSH_BYTES = 64 * 1024
+
+
+def read_records(stream, fmt):
+    """Yields (line number, raw record) pairs from a binary stream"""
+    if fmt == "csv":
+        reader = csv.DictReader(decode_lines(stream), strict=True)
+        while True:
+            try:
+                record = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as error:
+                raise DataValidationError(f"Invalid CSV at line {reader.reader.line_num}: {error}")
+            yield reader.line_num, record
+    else:
+        for number, line in enumerate(stream, start=1):
+            if line.strip():
+                yield number, line
+
+
+def decode_lines(stream):
+    # line by line, so a bad byte is reported on its own line
+    for number, line in enumerate(stream, start=1):
+        try:
+            yield line.decode("utf-8")
+        except UnicodeDecodeError as error:
+            raise DataValidationError(f"Invalid CSV at line {number}: not UTF-8 ({error.reason})")
+
+
+def check_records(stream, fmt):
+    """Reads a seekable upload through, raising DataValidationError if it is malformed"""
+    if fmt == "csv":
+        for _ in read_records(stream, fmt):
+            pass
+    stream.seek(0)
+
+
+def parse_record(record, fmt):
+    if fmt == "ndjson":
+        try:
+            record = json.loads(record)
+        except ValueError:
+            raise DataValidationError("Invalid JSON")
+        if not isinstance(record, dict):
+            raise DataValidationError("Invalid record: must be a JSON object")
+    else:
+        record = parse_csv_record(record)
+    # ids are assigned on insert, so an exported id column is ignored
+    unknown = set(record).difference(FIELDS)
+    if unknown:
+        raise DataValidationError("Invalid product: unknown fields " + ", ".join(sorted(unknown)))
+    data = {column: record[column] for column in COLUMNS if column in record}
+    missing = [column for column in REQUIRED_COLUMNS if column not in data]
+    if missing:
+        raise DataValidationError("Invalid product: missing " + ", ".join(missing))
+    return Product.check_values(data, "Invalid product")
+
+
+def parse_csv_record(record):
+    record = {key: value for key, value in record.items() if key is not None and value is not None}
+    if "available" in record:
+        available = record["available"].strip().lower()
+        if available in ("true", "yes", "1"):
+            record["available"] = True
+        elif available in ("false", "no", "0"):
+            record["available"] = False
+    if record.get("description") == "":
+        record["description"] = None
+    return record
+
+
+def import_products(stream, fmt, chunk_size=BATCH_CHUNK_SIZE, progress=None):
+    """Loads a seekable upload in chunked bulk transactions and returns a summary
+
+    progress, if given, is called with (imported, failed) after every chunk.
+    Raises DataValidationError, before inserting anything, if the upload is malformed.
+    """
+    logger.info("Importing products from %s", fmt)
+    check_records(stream, fmt)
+    imported, failed, errors = 0, 0, []
+    chunk = []
+    for line, record in read_records(stream, fmt):
+        try:
+            chunk.append(parse_record(record, fmt))
+        except DataValidationError as error:
+            failed += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({"line": line, "error": str(error)})
+            continue
+        if len(chunk) >= chunk_size:
+            imported += Product.insert_batch(chunk)
+            chunk = []
+            if progress:
+                progress(imported, failed)
+    if chunk:
+        imported += Product.insert_batch(chunk)
+    if progress:
+        progress(imported, failed)
+    logger.info("Imported %d products, rejected %d", imported, failed)
+    return {"imported": imported, "failed": failed, "errors": errors}
+
+
+def export_products(rows, fmt):
+    """Yields the encoded export of rows from Product.rows(), one piece at a time"""
+    if fmt == "ndjson":
+        for row in rows:
+            yield encoding.dumps(Product.serialize_row(row)) + b"\n"
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for row in rows:
+        data = Product.serialize_row(row)
+        data["available"] = "true" if data["available"] else "false"
+        writer.writerow(data[field] for field in FIELDS)
+        if buffer.tell() >= CSV_FLUSH_BYTES:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
@@ -0,0 +1,179 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from .replicas import read_bind
+
+logger = logging.getLogger("flask.app")
+
+LIST_GENERATION_KEY = "products:list-generation"
+
+
+class LRUCache:
+    """In-process LRU cache whose entries also expire after a TTL"""
+
+    def __init__(self, max_entries=10000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    # counters live outside the LRU: an evicted generation would resurrect stale lists
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """Shared cache backend so that every worker sees the same invalidations"""
+
+    def __init__(self, url, ttl=60, prefix="catalog:"):
+        import redis  # pylint: disable=import-outside-toplevel
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl or self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def counter(self, key):
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+class ProductCache:
+    """Read-through cache for serialized products and list responses"""
+
+    def __init__(self, backend=None, enabled=True, max_list_items=1000):
+        self.backend = backend or LRUCache()
+        self.enabled = enabled
+        self.max_list_items = max_list_items
+
+    @staticmethod
+    def etag(product):
+        return f"{product.id}-{product.version}"
+
+    def get_product(self, product_id):
+        if not self.enabled:
+            return None
+        return self.backend.get(f"product:{product_id}")
+
+    def writable(self):
+        # a replica may not have caught up with the write that bumped the
+        # generation yet, so only reads from the primary fill the cache
+        return self.enabled and read_bind() is None
+
+    def put_product(self, product, generation):
+        """Caches product as read by a query that started at generation"""
+        entry = {"etag": self.etag(product), "data": product.serialize()}
+        # a write since then has already dropped this key; refilling it with
+        # the row read before that write would serve it stale until the TTL
+        if self.writable() and self.generation() == generation:
+            self.backend.set(f"product:{product.id}", entry)
+        return entry
+
+    def generation(self):
+        """Bumped by every write this cache hears of"""
+        return int(self.backend.counter(LIST_GENERATION_KEY))
+
+    def list_key(self, args, generation=None):
+        if generation is None:
+            generation = self.generation()
+        query = "&".join(f"{key}={value}" for key, value in sorted(args.items(multi=True)))
+        return f"list:{generation}:{query}"
+
+    def get_list(self, args):
+        if not self.enabled:
+            return None
+        return self.backend.get(self.list_key(args))
+
+    def put_list(self, args, generation, data, headers=None):
+        # stored under the generation the query started at, so rows read
+        # before a concurrent write are orphaned along with that generation
+        if self.writable() and len(data) <= self.max_list_items:
+            self.backend.set(self.list_key(args, generation), {"data": data, "headers": headers or {}})
+
+    def stats_key(self, generation=None):
+        return f"stats:{self.generation() if generation is None else generation}"
+
+    def get_stats(self):
+        if not self.enabled:
+            return None
+        return self.backend.get(self.stats_key())
+
+    def put_stats(self, generation, data):
+        if self.writable():
+            self.backend.set(self.stats_key(generation), data)
+
+    def invalidate(self, product_ids=()):
+        for product_id in product_ids:
+            self.backend.delete(f"product:{product_id}")
+        # bumping the generation orphans every cached list at once
+        self.backend.incr(LIST_GENERATION_KEY)
+
+    def clear(self):
+        self.backend.clear()
+
+
+product_cache = ProductCache()
+
+
+def init_cache(app):
+    ttl = app.config.get("CACHE_TTL", 60)
+    url = app.config.get("CACHE_URL")
+    if url:
+        backend = RedisCache(url, ttl)
+    else:
+        backend = LRUCache(app.config.get("CACHE_MAX_ENTRIES", 10000), ttl)
+    product_cache.backend = backend
+    product_cache.enabled = app.config.get("CACHE_ENABLED", True)
+    product_cache.max_list_items = app.config.get("CACHE_MAX_LIST_ITEMS", 1000)
+    logger.info("Product cache using %s", type(backend).__name__)
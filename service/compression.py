@@ -0,0 +1,99 @@
+import zlib
+import logging
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+logger = logging.getLogger("flask.app")
+
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/x-ndjson", "text/csv", "text/plain")
+
+settings = {"level": 6, "min_size": 1024, "mimetypes": COMPRESSIBLE_MIMETYPES}
+
+
+class GzipEncoder:
+    name = "gzip"
+
+    def __init__(self, level):
+        # wbits=31 writes a gzip header and trailer around the deflate stream
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliEncoder:
+    name = "br"
+
+    def __init__(self, level):
+        # brotli quality runs 0-11; map the shared gzip-style level onto it
+        self.compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+def choose_encoder():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return BrotliEncoder(settings["level"])
+    if accepted["gzip"]:
+        return GzipEncoder(settings["level"])
+    return None
+
+
+def compress_stream(chunks, encoder):
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = encoder.compress(chunk)
+        if data:
+            yield data
+    yield encoder.finish()
+
+
+def compress_response(response):
+    if (
+        response.status_code < 200
+        or response.status_code in (204, 304)
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in settings["mimetypes"]
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    if not response.is_streamed and response.content_length is not None \
+            and response.content_length < settings["min_size"]:
+        return response
+    encoder = choose_encoder()
+    if encoder is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoder)
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(encoder.compress(response.get_data()) + encoder.finish())
+    response.headers["Content-Encoding"] = encoder.name
+    # the encoded bytes differ, so a strong validator must become weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    settings.update(
+        level=app.config.get("COMPRESS_LEVEL", 6),
+        min_size=app.config.get("COMPRESS_MIN_SIZE", 1024),
+    )
+    app.after_request(compress_response)
+    logger.info("Response compression: gzip%s", ", br" if brotli is not None else "")
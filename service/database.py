@@ -0,0 +1,183 @@
+import time
+import sqlite3
+import logging
+import threading
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import Pool, QueuePool
+from .replicas import replica_router, read_bind
+from .sharding import shard_set, scatter_gather, PRODUCT_TABLE
+
+logger = logging.getLogger("flask.app")
+
+sqlite_pragmas = {}
+
+
+class PoolStats:
+    """Process-wide connection pool counters, used to size workers against the DB"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.timeouts = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def increment(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self, pool=None):
+        with self._lock:
+            stats = {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "checked_out": self.checkouts - self.checkins,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": round(self.wait_seconds_total, 6),
+                "wait_seconds_max": round(self.wait_seconds_max, 6),
+            }
+        if isinstance(pool, QueuePool):
+            stats.update(
+                pool_size=pool.size(),
+                pool_checked_in=pool.checkedin(),
+                pool_overflow=pool.overflow(),
+            )
+        return stats
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait for a connection"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_stats.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_stats.record_wait(time.perf_counter() - start)
+        return connection
+
+
+class RoutingSession(SignallingSession):
+    """Picks the database for each statement: a product shard, a replica or the primary"""
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        if shard_set.binds:
+            # the unit of work asks this for every row it writes
+            self.connection_callable = self.connection_for_instance
+            event.listen(self, "do_orm_execute", scatter_gather, retval=True)
+
+    def get_bind(self, mapper=None, clause=None, shard=None, **kwargs):
+        if shard:
+            return shard_set.engine(shard)
+        bind = read_bind()
+        if bind and not self._flushing and getattr(clause, "is_select", False):
+            return replica_router.engine(bind)
+        return super().get_bind(mapper, clause)
+
+    def commit(self):
+        if shard_set.binds:
+            self.commit_shards()
+        super().commit()
+
+    def commit_shards(self):
+        """Commits the product shards ahead of the primary
+
+        The primary holds the revisions and tombstones of the product rows,
+        and a revision only counts as committed once the primary commits it,
+        so committing the primary last keeps latest_revision() from passing
+        a change whose row is not on its shard yet. There is no two-phase
+        commit: if the primary then fails, the shard rows stay.
+        """
+        transaction = self._transaction
+        if transaction is None or transaction._parent is not None:  # pylint: disable=protected-access
+            return
+        self.flush()
+        connections = transaction._connections  # pylint: disable=protected-access
+        for engine in shard_set.engines():
+            entry = connections.get(engine)
+            if entry is None or not entry[2]:
+                continue
+            connection, shard_transaction, _, autoclose = entry
+            shard_transaction.commit()
+            # the session's own commit then skips it
+            connections[connection] = connections[engine] = (connection, shard_transaction, False, autoclose)
+
+    def connection_for_instance(self, mapper=None, instance=None, **kwargs):
+        shard = None
+        if mapper is not None and mapper.local_table.name == PRODUCT_TABLE:
+            shard = shard_set.shard_for(instance.id)
+        return self.connection(bind_arguments={"mapper": mapper, "shard": shard})
+
+
+class Database(SQLAlchemy):
+    """SQLAlchemy extension that applies the configured pool to every engine"""
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sqlite = sa_url.drivername.startswith("sqlite")
+        pool_size = app.config.get("DB_POOL_SIZE", 5)
+        # in-memory SQLite keeps Flask-SQLAlchemy's StaticPool
+        if pool_size and not (sqlite and sa_url.database in (None, "", ":memory:")):
+            options.update(
+                poolclass=InstrumentedQueuePool,
+                pool_size=pool_size,
+                max_overflow=app.config.get("DB_MAX_OVERFLOW", 10),
+                pool_timeout=app.config.get("DB_POOL_TIMEOUT", 30),
+            )
+            if sqlite:
+                options.setdefault("connect_args", {})["check_same_thread"] = False
+        return super().apply_driver_hacks(app, sa_url, options)
+
+    def create_session(self, options):
+        # reads of GET requests may go to a replica (see service.replicas)
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+@event.listens_for(Pool, "connect")
+def on_connect(dbapi_connection, connection_record):
+    pool_stats.increment("connects")
+    if isinstance(dbapi_connection, sqlite3.Connection) and sqlite_pragmas:
+        cursor = dbapi_connection.cursor()
+        for pragma, value in sqlite_pragmas.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+
+@event.listens_for(Pool, "checkout")
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_stats.increment("checkouts")
+
+
+@event.listens_for(Pool, "checkin")
+def on_checkin(dbapi_connection, connection_record):
+    pool_stats.increment("checkins")
+
+
+def init_database(app):
+    sqlite_pragmas.clear()
+    sqlite_pragmas.update(
+        journal_mode=app.config.get("SQLITE_JOURNAL_MODE", "WAL"),
+        synchronous=app.config.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+        busy_timeout=int(app.config.get("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+    )
+    logger.info("Database engine options: %s", app.config.get("SQLALCHEMY_ENGINE_OPTIONS"))
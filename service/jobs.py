@@ -0,0 +1,350 @@
+"""
+Background jobs for long-running catalog operations (bulk imports, bulk
+price changes). Job state lives in the database so that any worker can
+answer GET /jobs/<id>; the work itself runs on a small thread pool inside
+the worker that accepted it, or on an RQ worker when JOB_BROKER_URL is set:
+
+    rq worker --url $JOB_BROKER_URL catalog-jobs
+"""
+import os
+import uuid
+import shutil
+import logging
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+from . import db
+from . import bulk, query_args
+from .models import Product, BATCH_CHUNK_SIZE
+
+logger = logging.getLogger("flask.app")
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+# kind -> function(context, **params) returning the job's JSON result
+JOB_TYPES = {}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=QUEUED, index=True)
+    params = db.Column(db.JSON, nullable=False, default=dict)
+    done = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    result = db.Column(db.JSON)
+    error = db.Column(db.String(1024))
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # refreshed by every progress report; a running job that stops
+    # reporting belonged to a worker that exited
+    heartbeat_at = db.Column(db.DateTime)
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": {"done": self.done, "total": self.total},
+            "result": self.result,
+            "error": self.error,
+            "cancel_requested": self.cancel_requested,
+            "created_at": isoformat(self.created_at),
+            "started_at": isoformat(self.started_at),
+            "finished_at": isoformat(self.finished_at),
+        }
+
+    @classmethod
+    def submit(cls, kind, **params):
+        if kind not in JOB_TYPES:
+            raise ValueError(f"Unknown job type {kind}")
+        job = cls(id=uuid.uuid4().hex, kind=kind, status=QUEUED, params=params)
+        db.session.add(job)
+        db.session.commit()
+        logger.info("Queued %s job %s", kind, job.id)
+        job_queue.submit(job.id)
+        return job
+
+    @classmethod
+    def recent(cls, limit=20):
+        return cls.query.order_by(cls.created_at.desc()).limit(limit).all()
+
+    @classmethod
+    def cancel(cls, job_id):
+        """Cancels a queued job outright; a running one stops at its next checkpoint"""
+        table = cls.__table__
+        cancelled = db.session.execute(
+            table.update()
+            .where(db.and_(table.c.id == job_id, table.c.status == QUEUED))
+            .values(status=CANCELLED, cancel_requested=True, finished_at=datetime.utcnow())
+        ).rowcount
+        db.session.execute(
+            table.update()
+            .where(db.and_(table.c.id == job_id, table.c.status == RUNNING))
+            .values(cancel_requested=True)
+        )
+        db.session.commit()
+        job = cls.query.get(job_id)
+        if cancelled:
+            release_spool(job.params)  # the job will never run to remove it
+        return job
+
+    @classmethod
+    def claim(cls, job_id):
+        # a conditional UPDATE, so a job cancelled while queued never starts
+        table = cls.__table__
+        result = db.session.execute(
+            table.update()
+            .where(db.and_(table.c.id == job_id, table.c.status == QUEUED))
+            .values(status=RUNNING, started_at=datetime.utcnow(), heartbeat_at=datetime.utcnow())
+        )
+        db.session.commit()
+        return result.rowcount == 1
+
+    @classmethod
+    def fail_stale(cls, before):
+        """Fails running jobs that have not reported since before; returns them"""
+        table = cls.__table__
+        failed = []
+        for job in cls.query.filter(cls.status == RUNNING, cls.heartbeat_at < before).all():
+            # conditional, so a job that reported meanwhile keeps running
+            result = db.session.execute(
+                table.update()
+                .where(db.and_(table.c.id == job.id, table.c.status == RUNNING,
+                               table.c.heartbeat_at < before))
+                .values(status=FAILED, error="The worker running this job exited",
+                        finished_at=datetime.utcnow())
+            )
+            if result.rowcount == 1:
+                failed.append(job)
+        db.session.commit()
+        return failed
+
+    @classmethod
+    def unclaimed(cls, before):
+        return cls.query.filter(cls.status == QUEUED, cls.created_at < before).all()
+
+    @classmethod
+    def finish(cls, job_id, status, result=None, error=None):
+        db.session.rollback()
+        cls.query.filter_by(id=job_id).update(
+            {"status": status, "result": result, "error": error, "finished_at": datetime.utcnow()}
+        )
+        db.session.commit()
+
+
+class JobContext:
+    """Handed to job functions to report progress and honor cancellation"""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def progress(self, done, total=None):
+        Job.query.filter_by(id=self.job_id).update(
+            {"done": done, "total": total, "heartbeat_at": datetime.utcnow()}
+        )
+        db.session.commit()
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        requested = db.session.query(Job.cancel_requested).filter_by(id=self.job_id).scalar()
+        if requested:
+            raise JobCancelled()
+
+
+def job_type(kind):
+    def register(function):
+        JOB_TYPES[kind] = function
+        return function
+    return register
+
+
+def isoformat(moment):
+    return moment.isoformat() + "Z" if moment else None
+
+
+def release_spool(params):
+    """Removes the spooled upload of a job that will not run to remove it"""
+    path = (params or {}).get("path")
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def run_job(job_id):
+    """Runs a queued job to completion; the entry point for every executor"""
+    app = job_queue.app
+    if app is None:
+        # an RQ worker process: build the default app on first use
+        from . import app  # pylint: disable=import-outside-toplevel
+    with app.app_context():
+        if not Job.claim(job_id):
+            logger.info("Job %s is no longer queued, skipping", job_id)
+            job = Job.query.get(job_id)
+            if job is not None and job.status in FINISHED:
+                release_spool(job.params)
+            return
+        job = Job.query.get(job_id)
+        kind, params = job.kind, dict(job.params)
+        logger.info("Running %s job %s", kind, job_id)
+        try:
+            result = JOB_TYPES[kind](JobContext(job_id), **params)
+        except JobCancelled:
+            logger.info("Job %s cancelled", job_id)
+            Job.finish(job_id, CANCELLED)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception("Job %s failed", job_id)
+            Job.finish(job_id, FAILED, error=str(error)[:1024])
+        else:
+            Job.finish(job_id, SUCCEEDED, result=result)
+
+
+######################################################################
+#  E X E C U T O R S
+######################################################################
+
+class ThreadExecutor:
+    """Runs jobs on a thread pool in this process, created after the fork"""
+
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def submit(self, job_id):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix="job")
+        self._pool.submit(run_job, job_id)
+
+
+class RQExecutor:
+    """Hands jobs to RQ workers through Redis (needs the rq package)"""
+
+    def __init__(self, url, queue_name="catalog-jobs", timeout=3600):
+        self.url = url
+        self.queue_name = queue_name
+        self.timeout = timeout
+        self._queue = None
+
+    def submit(self, job_id):
+        if self._queue is None:
+            # imported on first submit; most workers never queue a job
+            from redis import Redis  # pylint: disable=import-outside-toplevel
+            from rq import Queue  # pylint: disable=import-outside-toplevel
+
+            self._queue = Queue(self.queue_name, connection=Redis.from_url(self.url))
+        self._queue.enqueue(run_job, job_id, job_timeout=self.timeout)
+
+
+class JobQueue:
+    def __init__(self, executor=None):
+        self.executor = executor or ThreadExecutor()
+        self.spool_dir = tempfile.gettempdir()
+        self.app = None
+
+    def submit(self, job_id):
+        self.executor.submit(job_id)
+
+    def spool(self, stream, suffix=""):
+        """Copies an upload to a file the job can read once the request is gone"""
+        handle, path = tempfile.mkstemp(suffix=suffix, dir=self.spool_dir)
+        with os.fdopen(handle, "wb") as spooled:
+            shutil.copyfileobj(stream, spooled, 64 * 1024)
+        return path
+
+
+job_queue = JobQueue()
+
+
+def recover_jobs(app):
+    """Fails running jobs whose worker exited and requeues queued jobs nobody ran
+
+    Call it in each worker once it has started (see gunicorn.conf.py); jobs
+    are only requeued onto this worker's threads, never onto the master's.
+    """
+    before = datetime.utcnow() - timedelta(seconds=app.config.get("JOB_STALE_AFTER", 600))
+    with app.app_context():
+        try:
+            for job in Job.fail_stale(before):
+                logger.warning("Job %s stopped reporting progress, marked failed", job.id)
+                release_spool(job.params)
+            if isinstance(job_queue.executor, ThreadExecutor):
+                # RQ keeps queued jobs in Redis; only pool threads lose them
+                for job in Job.unclaimed(before):
+                    logger.warning("Requeuing job %s, queued since %s", job.id, isoformat(job.created_at))
+                    job_queue.submit(job.id)
+        except SQLAlchemyError as error:
+            logger.warning("Could not recover background jobs: %s", error)
+        finally:
+            db.session.remove()
+
+
+def init_jobs(app):
+    url = app.config.get("JOB_BROKER_URL")
+    if url:
+        executor = RQExecutor(
+            url, app.config.get("JOB_QUEUE_NAME", "catalog-jobs"), app.config.get("JOB_TIMEOUT", 3600)
+        )
+    else:
+        executor = ThreadExecutor(app.config.get("JOB_THREADS", 2))
+    job_queue.executor = executor
+    job_queue.app = app
+    job_queue.spool_dir = app.config.get("JOB_SPOOL_DIR") or tempfile.gettempdir()
+    logger.info("Background jobs using %s", type(executor).__name__)
+
+
+######################################################################
+#  J O B   T Y P E S
+######################################################################
+
+@job_type("import")
+def import_job(context, path, format):  # pylint: disable=redefined-builtin
+    try:
+        with open(path, "rb") as upload:
+            return bulk.import_products(
+                upload,
+                format,
+                current_app.config.get("IMPORT_CHUNK_SIZE", BATCH_CHUNK_SIZE),
+                progress=lambda imported, failed: context.progress(imported + failed),
+            )
+    finally:
+        os.remove(path)
+
+
+@job_type("price_change")
+def price_change_job(context, percent, filters):
+    factor = 1 + percent / 100.0
+    query = Product.find_by_filters(**query_args.parse_filters(filters))
+    total = query.count()
+    done, last_id = 0, 0
+    context.progress(done, total)
+    chunk_size = current_app.config.get("IMPORT_CHUNK_SIZE", BATCH_CHUNK_SIZE)
+    while True:
+        # keyset over ids, so every chunk is its own short transaction
+        ids = [
+            row.id for row in query.with_entities(Product.id)
+            .filter(Product.id > last_id).order_by(Product.id).limit(chunk_size)
+        ]
+        if not ids:
+            break
+        done += Product.reprice_batch(ids, factor)
+        last_id = ids[-1]
+        context.progress(done, total)
+    return {"updated": done}
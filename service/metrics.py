@@ -0,0 +1,139 @@
+import os
+import time
+import logging
+from flask import g, request, has_request_context
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("flask.app")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling a request, by endpoint",
+    ["method", "endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_DB_TIME = Histogram(
+    "http_request_db_seconds",
+    "Time spent in database round-trips per request, by endpoint",
+    ["method", "endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_QUEUE_TIME = Histogram(
+    "http_request_queue_seconds",
+    "Time between the proxy's X-Request-Start and the worker picking the request up",
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    "http_requests_total",
+    "Requests handled, by endpoint and status code",
+    ["method", "endpoint", "status"],
+)
+IN_PROGRESS = Gauge(
+    "http_requests_in_progress",
+    "Requests currently being handled, by endpoint",
+    ["method", "endpoint"],
+    multiprocess_mode="livesum",
+)
+COALESCED_REQUESTS = Counter(
+    "http_requests_coalesced_total",
+    "Requests answered with the response of an identical request already in flight",
+    ["endpoint"],
+)
+DB_STATEMENTS = Counter(
+    "db_statements_total",
+    "SQL statements executed",
+)
+
+
+def endpoint_label():
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+def queue_seconds(header):
+    # nginx sends "t=<seconds>", other proxies send milliseconds
+    try:
+        started = float(header[2:] if header.startswith("t=") else header)
+    except ValueError:
+        return None
+    if started > 1e11:
+        started /= 1000.0
+    return max(time.time() - started, 0.0)
+
+
+def before_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_db_seconds = 0.0
+    g.metrics_labels = (request.method, endpoint_label())
+    IN_PROGRESS.labels(*g.metrics_labels).inc()
+    header = request.headers.get("X-Request-Start")
+    if header:
+        waited = queue_seconds(header)
+        if waited is not None:
+            REQUEST_QUEUE_TIME.observe(waited)
+
+
+def after_request(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def teardown_request(exception=None):
+    start = g.pop("metrics_start", None)
+    if start is None:
+        return
+    labels = g.metrics_labels
+    IN_PROGRESS.labels(*labels).dec()
+    REQUEST_LATENCY.labels(*labels).observe(time.perf_counter() - start)
+    REQUEST_DB_TIME.labels(*labels).observe(g.metrics_db_seconds)
+    REQUESTS.labels(*labels, g.pop("metrics_status", 500)).inc()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["metrics_start"].pop()
+    DB_STATEMENTS.inc()
+    if has_request_context() and "metrics_db_seconds" in g:
+        g.metrics_db_seconds += elapsed
+
+
+@event.listens_for(Engine, "handle_error")
+def handle_error(context):
+    starts = context.connection.info.get("metrics_start") if context.connection else None
+    if starts:
+        starts.pop()
+
+
+def export():
+    # with several gunicorn workers each process writes its own files into
+    # PROMETHEUS_MULTIPROC_DIR and the scrape aggregates all of them
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def init_metrics(app):
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+    logger.info("Request metrics enabled")
@@ -1,12 +1,109 @@
+import os
+import re
 import logging
+import secrets
+import itertools
+import threading
 from enum import Enum
+from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
 from . import db
+from .cache import product_cache
+from .sharding import shard_set
 
 logger = logging.getLogger("flask.app")
 
+BATCH_CHUNK_SIZE = 1000
+COLUMNS = ("name", "description", "price", "available", "category")
+SORT_COLUMNS = ("id", "name", "price")
+FIELDS = ("id", "name", "description", "price", "available", "category")
+
+# SQLite FTS5 index over name and description, kept in sync by triggers
+SQLITE_SEARCH_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5(
+        name, description, content='product', content_rowid='id',
+        tokenize='porter unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_insert AFTER INSERT ON product BEGIN
+        INSERT INTO product_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_delete AFTER DELETE ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_update AFTER UPDATE ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO product_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END""",
+)
+
+# Postgres GIN index; search queries must repeat this exact expression
+POSTGRES_SEARCH_DDL = (
+    """CREATE INDEX IF NOT EXISTS ix_product_search ON product USING GIN (
+        to_tsvector('english', coalesce(name, '') || ' ' || coalesce(description, '')))""",
+)
+
+# engine url -> whether product_fts exists
+fts_indexes = {}
+
+CENT = Decimal("0.01")
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def next_revisions(connection, count=1):
+    """Hands out table-wide revisions for count rows written in this transaction"""
+    if connection.dialect.name == "postgresql":
+        # the transaction's own id: no shared row to lock, so writers never
+        # wait on each other; revision_horizon() keeps the change feed from
+        # moving past a transaction that is still in flight
+        revision = connection.execute(db.select(db.func.txid_current())).scalar()
+        return [revision] * count
+    # SQLite lets one transaction write at a time anyway, so the counter row
+    # serializes nothing more; it is locked until commit, so revisions become
+    # visible in the order they were handed out
+    return next_values(Revision.__table__, connection, count)
+
+def revision_horizon(dialect):
+    """A SELECT of the latest revision at or below which every write has committed"""
+    if dialect == "postgresql":
+        # every transaction older than the oldest one still running has ended
+        return db.select(db.func.txid_snapshot_xmin(db.func.txid_current_snapshot()) - 1)
+    return db.select(Revision.value).where(Revision.id == 1)
+
+def after_revision(model, since, since_id=None):
+    """Rows written after revision since, or after (since, since_id) within it"""
+    # on PostgreSQL every row a transaction writes shares its revision
+    if since_id is None:
+        return model.revision > since
+    return db.tuple_(model.revision, model.id) > db.tuple_(since, since_id)
+
+def next_values(table, connection, count):
+    """Reserves count values of a single-row counter table"""
+    result = connection.execute(
+        table.update().where(table.c.id == 1).values(value=table.c.value + count)
+    )
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(id=1, value=count))
+    last = connection.execute(db.select(table.c.value).where(table.c.id == 1)).scalar()
+    return range(last - count + 1, last + 1)
+
+def isoformat(moment):
+    return moment.isoformat() + "Z" if moment else None
+
 class DataValidationError(Exception):
     pass
 
+class ConcurrentUpdateError(Exception):
+    pass
+
 class Category(Enum):
     CLOTHING = 0
     FOOD = 1
@@ -14,35 +111,185 @@ class Category(Enum):
     HOUSEWARES = 3
     TOYS = 4
 
+SERIALIZERS = {
+    "id": lambda product: product.id,
+    "name": lambda product: product.name,
+    "description": lambda product: product.description,
+    "price": lambda product: str(product.price),
+    "available": lambda product: product.available,
+    "category": lambda product: product.category.name,
+}
+
+class Revision(db.Model):
+    __tablename__ = "product_revision"
+
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+class IdSequence(db.Model):
+    """Next free product id when products are sharded and no database can autoincrement"""
+
+    __tablename__ = "product_id_sequence"
+
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+class IdAllocator:
+    """Hands out product ids that are unique across shards, a block at a time"""
+
+    def __init__(self, block_size=100):
+        self.block_size = block_size
+        self._ids = iter(())
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def allocate(self, count=1):
+        if not shard_set.binds:
+            return [None] * count  # None lets the database pick the next id
+        with self._lock:
+            if self._pid != os.getpid():
+                # a block reserved before a fork must not be used twice
+                self._ids, self._pid = iter(()), os.getpid()
+            ids = list(itertools.islice(self._ids, count))
+            if len(ids) < count:
+                needed = count - len(ids)
+                size = max(needed, self.block_size)
+                # its own short transaction, so the sequence row is not held
+                with db.engine.begin() as connection:
+                    block = iter(next_values(IdSequence.__table__, connection, size))
+                ids += itertools.islice(block, needed)
+                self._ids = block
+        logger.info("Allocated %d product ids", count)
+        return ids
+
+id_allocator = IdAllocator()
+
+class Catalog(db.Model):
+    """Names this catalog; init_db replaces it, so copies of an older one can tell"""
+
+    __tablename__ = "catalog"
+
+    id = db.Column(db.Integer, primary_key=True)
+    identity = db.Column(db.String(32), nullable=False)
+
+    @classmethod
+    def current_identity(cls):
+        """The catalog's identity, created on first use"""
+        table = cls.__table__
+        query = db.select(table.c.identity).where(table.c.id == 1)
+        try:
+            # its own short transaction, as for the id sequence
+            with db.engine.begin() as connection:
+                identity = connection.execute(query).scalar()
+                if identity is None:
+                    identity = secrets.token_hex(16)
+                    connection.execute(table.insert().values(id=1, identity=identity))
+        except IntegrityError:
+            # another worker created it first
+            with db.engine.connect() as connection:
+                identity = connection.execute(query).scalar()
+        return identity
+
+class Tombstone(db.Model):
+    """Left behind by a deleted product so the change feed can report it"""
+
+    __tablename__ = "product_tombstone"
+
+    id = db.Column(db.Integer, primary_key=True)  # the deleted product's id
+    revision = db.Column(db.BigInteger, nullable=False, index=True)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def bury(cls, connection, product_ids):
+        product_ids = sorted(product_ids)
+        revisions = next_revisions(connection, len(product_ids))
+        # sqlite may hand a deleted id out again, so an old tombstone is replaced
+        connection.execute(cls.__table__.delete().where(cls.id.in_(product_ids)))
+        connection.execute(
+            cls.__table__.insert(),
+            [
+                {"id": product_id, "revision": revision, "deleted_at": datetime.utcnow()}
+                for product_id, revision in zip(product_ids, revisions)
+            ],
+        )
+
+    def to_change(self):
+        return {
+            "id": self.id,
+            "revision": self.revision,
+            "updated_at": isoformat(self.deleted_at),
+            "deleted": True,
+        }
+
 class Product(db.Model):
+    __table_args__ = (
+        # price rides along so that stats() is answered from the index alone
+        db.Index("ix_product_category_available_price", "category", "available", "price"),
+        db.Index("ix_product_name", "name"),
+        db.Index("ix_product_price", "price"),
+        db.Index("ix_product_revision", "revision"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(63), nullable=False)
     description = db.Column(db.String(256))
     price = db.Column(db.Numeric(10, 2), nullable=False)
     available = db.Column(db.Boolean(), nullable=False, default=False)
     category = db.Column(db.Enum(Category), nullable=False)
+    # optimistic locking: every UPDATE/DELETE also matches the version that
+    # was read and bumps it, so a concurrent writer fails instead of winning
+    version = db.Column(db.Integer, nullable=False, default=1)
+    # table-wide; assigned on every write by assign_revisions(), see next_revisions()
+    revision = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+
+    __mapper_args__ = {"version_id_col": version}
 
     def __repr__(self):
         return f"<Product {self.name} id=[{self.id}]>"
 
     def create(self):
         logger.info("Creating %s", self.name)
-        self.id = None  # id must be none to generate next primary key
+        # None (unsharded) lets the database generate the next primary key
+        self.id = id_allocator.allocate()[0]
         db.session.add(self)
         db.session.commit()
+        product_cache.invalidate()
 
     def update(self):
         logger.info("Updating %s", self.name)
         if not self.id:
             raise DataValidationError("Update called with no id for product")
-        db.session.commit()
+        product_id = self.id
+        self.commit_versioned(product_id)
+        product_cache.invalidate([product_id])
 
     def delete(self):
         logger.info("Deleting %s", self.name)
+        product_id = self.id
         db.session.delete(self)
-        db.session.commit()
+        self.commit_versioned(product_id)
+        product_cache.invalidate([product_id])
+
+    @staticmethod
+    def commit_versioned(product_id):
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            product_cache.invalidate([product_id])
+            raise ConcurrentUpdateError(
+                f"Product with id '{product_id}' was changed by another request"
+            )
 
-    def serialize(self):
+    def to_mapping(self):
+        return {column: getattr(self, column) for column in COLUMNS}
+
+    def serialize(self, fields=None):
+        if fields is not None:
+            return {field: SERIALIZERS[field](self) for field in fields}
         return {
             "id": self.id,
             "name": self.name,
@@ -52,27 +299,334 @@ class Product(db.Model):
             "category": self.category.name,
         }
 
+    def to_change(self):
+        return dict(
+            self.serialize(),
+            revision=self.revision,
+            updated_at=isoformat(self.updated_at),
+            deleted=False,
+        )
+
+    @staticmethod
+    def serialize_row(row, fields=FIELDS):
+        # row comes from Product.rows(): no ORM instance, Decimal or Enum involved
+        data = dict(zip(fields, row))
+        if "price" in data:
+            data["price"] = f"{data['price']:.2f}"
+        if "available" in data:
+            data["available"] = bool(data["available"])
+        return data
+
     def deserialize(self, data):
-        try:
-            self.name = data["name"]
-            self.description = data.get("description")
-            self.price = data["price"]
-            self.available = data["available"]
-            self.category = getattr(Category, data["category"])
-        except KeyError as error:
-            raise DataValidationError("Invalid product: missing " + error.args[0])
-        except TypeError as error:
+        if not isinstance(data, dict):
             raise DataValidationError(
                 "Invalid product: body of request contained bad or no data"
             )
+        for field in ("name", "price", "available", "category"):
+            if field not in data:
+                raise DataValidationError("Invalid product: missing " + field)
+        # checked here, so that a bad value is a 400 and never fails a flush
+        values = Product.check_values(
+            {field: data.get(field) for field in COLUMNS}, "Invalid product"
+        )
+        for field, value in values.items():
+            setattr(self, field, value)
         return self
 
+    @staticmethod
+    def validate_changes(data):
+        """Checks a partial update body and returns the column values it sets"""
+        if not isinstance(data, dict) or not data:
+            raise DataValidationError("Invalid patch: body must be a non-empty JSON object")
+        unknown = set(data).difference(COLUMNS)
+        if unknown:
+            raise DataValidationError("Invalid patch: unknown fields " + ", ".join(sorted(unknown)))
+        return Product.check_values(data, "Invalid patch")
+
+    @staticmethod
+    def check_values(data, problem):
+        """Checks the types and ranges of the columns in data and returns their values"""
+        changes = {}
+        if "name" in data:
+            if not isinstance(data["name"], str) or not 0 < len(data["name"]) <= 63:
+                raise DataValidationError(f"{problem}: name must be 1 to 63 characters")
+            changes["name"] = data["name"]
+        if "description" in data:
+            description = data["description"]
+            if description is not None and (not isinstance(description, str) or len(description) > 256):
+                raise DataValidationError(f"{problem}: description must be at most 256 characters")
+            changes["description"] = description
+        if "price" in data:
+            try:
+                price = Decimal(str(data["price"]))
+            except InvalidOperation:
+                raise DataValidationError(f"{problem}: price must be a number")
+            # Numeric(10, 2) holds up to 99999999.99
+            if isinstance(data["price"], bool) or not price.is_finite() or not 0 <= price < 10 ** 8:
+                raise DataValidationError(f"{problem}: price must be a number")
+            # rounded to cents as the column stores it, so every response shows "1.00", never "1"
+            price = price.quantize(CENT, rounding=ROUND_HALF_UP)
+            if price >= 10 ** 8:
+                raise DataValidationError(f"{problem}: price must be a number")
+            changes["price"] = price
+        if "available" in data:
+            if not isinstance(data["available"], bool):
+                raise DataValidationError(f"{problem}: available must be true or false")
+            changes["available"] = data["available"]
+        if "category" in data:
+            try:
+                changes["category"] = Category[data["category"]]
+            except (KeyError, TypeError):
+                raise DataValidationError("Invalid attribute: " + str(data["category"]))
+        return changes
+
     @classmethod
     def init_db(cls, app):
         logger.info("Initializing database")
+        db.create_all()
+        for engine in shard_set.engines():
+            db.Model.metadata.create_all(engine, tables=[cls.__table__])
+        cls.init_search()
         cls.query.delete()
+        Tombstone.query.delete()
+        # a new catalog: snapshots of the old one are not reused
+        Catalog.query.delete()
+        db.session.add(Catalog(id=1, identity=secrets.token_hex(16)))
         db.session.commit()
-        db.create_all()
+        product_cache.clear()
+
+    @classmethod
+    def engines(cls):
+        """The databases holding products: every shard, or the primary"""
+        return shard_set.engines() or [db.engine]
+
+    @classmethod
+    def init_search(cls):
+        for engine in cls.engines():
+            cls.init_search_index(engine)
+
+    @classmethod
+    def init_search_index(cls, engine):
+        dialect = engine.dialect.name
+        statements = {"sqlite": SQLITE_SEARCH_DDL, "postgresql": POSTGRES_SEARCH_DDL}
+        if dialect not in statements:
+            logger.info("No full-text index for %s, search falls back to LIKE", dialect)
+            return
+        try:
+            with engine.begin() as connection:
+                for statement in statements[dialect]:
+                    connection.execute(db.text(statement))
+                if dialect == "sqlite":
+                    # picks up rows written before the index existed
+                    connection.execute(
+                        db.text("INSERT INTO product_fts(product_fts) VALUES ('rebuild')")
+                    )
+            fts_indexes[str(engine.url)] = dialect == "sqlite"
+        except OperationalError as error:
+            logger.warning("Full-text index unavailable, search falls back to LIKE: %s", error)
+
+    @classmethod
+    def create_batch(cls, products, chunk_size=BATCH_CHUNK_SIZE):
+        logger.info("Creating batch of %d products", len(products))
+        for chunk in chunks(products, chunk_size):
+            # ids first: the allocator commits on its own connection
+            ids = id_allocator.allocate(len(chunk))
+            # bulk saves skip the flush hooks, so revisions are assigned here
+            revisions = next_revisions(db.session.connection(), len(chunk))
+            for product, revision, product_id in zip(chunk, revisions, ids):
+                product.id = product_id
+                product.revision = revision
+            if shard_set.binds:
+                # bulk saves cannot route rows to shards, plain INSERTs can
+                for shard, group in shard_set.group(chunk, lambda product: product.id):
+                    for product in group:
+                        product.version = 1
+                    db.session.execute(
+                        cls.__table__.insert(),
+                        [dict(p.to_mapping(), id=p.id, revision=p.revision, version=1) for p in group],
+                        bind_arguments={"shard": shard},
+                    )
+            else:
+                # one transaction per chunk; ids are copied back onto the objects
+                db.session.bulk_save_objects(chunk, return_defaults=True)
+            db.session.commit()
+        product_cache.invalidate()
+        return products
+
+    @classmethod
+    def insert_batch(cls, mappings):
+        """One executemany INSERT of column mappings; ids are not read back"""
+        logger.info("Inserting batch of %d products", len(mappings))
+        ids = id_allocator.allocate(len(mappings))
+        revisions = next_revisions(db.session.connection(), len(mappings))
+        for mapping, revision, product_id in zip(mappings, revisions, ids):
+            mapping["revision"] = revision
+            if product_id is not None:
+                mapping["id"] = product_id
+        for shard, group in shard_set.group(mappings, lambda mapping: mapping.get("id")):
+            db.session.execute(cls.__table__.insert(), group, bind_arguments={"shard": shard})
+        db.session.commit()
+        product_cache.invalidate()
+        return len(mappings)
+
+    @classmethod
+    def update_batch(cls, products, chunk_size=BATCH_CHUNK_SIZE):
+        logger.info("Updating batch of %d products", len(products))
+        # executemany of one UPDATE; keys other than b_id become the SET clause
+        statement = (
+            cls.__table__.update()
+            .where(cls.id == db.bindparam("b_id"))
+            .values(version=cls.version + 1)
+        )
+        updated = set()
+        for chunk in chunks(products, chunk_size):
+            existing = cls.existing_ids(product.id for product in chunk)
+            params = [
+                dict(p.to_mapping(), b_id=p.id) for p in chunk if p.id in existing
+            ]
+            if params:
+                revisions = next_revisions(db.session.connection(), len(params))
+                for param, revision in zip(params, revisions):
+                    param["revision"] = revision
+                for shard, group in shard_set.group(params, lambda param: param["b_id"]):
+                    db.session.execute(statement, group, bind_arguments={"shard": shard})
+            db.session.commit()
+            updated |= existing
+            product_cache.invalidate(existing)
+        return updated
+
+    @classmethod
+    def reprice_batch(cls, ids, factor):
+        """Multiplies the price of every product in ids by factor, in one transaction"""
+        logger.info("Repricing batch of %d products by %s", len(ids), factor)
+        table = cls.__table__
+        statement = (
+            table.update()
+            .where(table.c.id == db.bindparam("b_id"))
+            .values(
+                price=db.func.round(table.c.price * factor, 2),
+                version=table.c.version + 1,
+            )
+        )
+        revisions = next_revisions(db.session.connection(), len(ids))
+        params = [{"b_id": product_id, "revision": revision} for product_id, revision in zip(ids, revisions)]
+        for shard, group in shard_set.group(params, lambda param: param["b_id"]):
+            db.session.execute(statement, group, bind_arguments={"shard": shard})
+        db.session.commit()
+        product_cache.invalidate(ids)
+        return len(ids)
+
+    @classmethod
+    def delete_batch(cls, ids, chunk_size=BATCH_CHUNK_SIZE):
+        logger.info("Deleting batch of %d products", len(ids))
+        deleted = set()
+        for chunk in chunks(list(ids), chunk_size):
+            existing = cls.existing_ids(chunk)
+            cls.query.filter(cls.id.in_(existing)).delete(synchronize_session=False)
+            if existing:
+                Tombstone.bury(db.session.connection(), existing)
+            db.session.commit()
+            deleted |= existing
+            product_cache.invalidate(existing)
+        return deleted
+
+    @classmethod
+    def patch(cls, product_id, changes, version=None):
+        """Partial update without loading the row first
+
+        On PostgreSQL this is one UPDATE ... RETURNING, which takes its own
+        revision. SQLite has no RETURNING in SQLAlchemy 1.4 and keeps the
+        revision in a counter row, so there the counter is bumped and the row
+        read back: four statements, but in-process calls on one connection
+        rather than network round-trips. Sharded products also take the
+        revision from the primary first.
+        """
+        logger.info("Patching %s with %s", product_id, ", ".join(changes))
+        table = cls.__table__
+        connection = db.session.connection(
+            bind_arguments={"shard": shard_set.shard_for(product_id)}
+        )
+        if connection.dialect.name == "postgresql" and not shard_set.binds:
+            # the transaction id, as next_revisions() would hand out
+            revision = db.func.txid_current()
+        else:
+            # Core bypasses the flush hook, so the revision is assigned here
+            revision = next_revisions(db.session.connection(), 1)[0]
+        statement = (
+            table.update()
+            .where(table.c.id == product_id)
+            .values(version=table.c.version + 1, revision=revision, **changes)
+        )
+        if version is not None:
+            statement = statement.where(table.c.version == version)
+        if connection.dialect.full_returning:
+            row = connection.execute(statement.returning(*table.c)).first()
+        else:
+            # no RETURNING on this backend: read the row back in the same transaction
+            result = connection.execute(statement)
+            row = None
+            if result.rowcount:
+                row = connection.execute(db.select(table).where(table.c.id == product_id)).first()
+        if row is None:
+            db.session.rollback()
+            if version is not None and cls.existing_ids([product_id]):
+                raise ConcurrentUpdateError(
+                    f"Product with id '{product_id}' was changed by another request"
+                )
+            return None
+        db.session.commit()
+        product_cache.invalidate([product_id])
+        # a detached copy to serialize; it never enters the session
+        return cls(**row._mapping)
+
+    @classmethod
+    def changes(cls, since=0, limit=100, since_id=None):
+        """Products and tombstones written after revision since (and id since_id), oldest first"""
+        logger.info("Processing changes since revision %s (limit %s) ...", since, limit)
+        # nothing past the horizon: an older write may still be in flight
+        horizon = cls.latest_revision()
+        products = (
+            cls.query.filter(after_revision(cls, since, since_id), cls.revision <= horizon)
+            .order_by(cls.revision, cls.id)
+            .limit(limit)
+            .all()
+        )
+        tombstones = (
+            Tombstone.query.filter(after_revision(Tombstone, since, since_id), Tombstone.revision <= horizon)
+            .order_by(Tombstone.revision, Tombstone.id)
+            .limit(limit)
+            .all()
+        )
+        return sorted(products + tombstones, key=lambda change: (change.revision, change.id))[:limit]
+
+    @classmethod
+    def stats(cls):
+        """Count and price aggregates per (category, available)"""
+        logger.info("Processing catalog stats ...")
+        price = db.type_coerce(cls.price, db.Numeric(10, 2, asdecimal=True))
+        return (
+            db.session.query(
+                cls.category,
+                cls.available,
+                db.func.count().label("count"),
+                db.func.min(price).label("min_price"),
+                db.func.max(price).label("max_price"),
+                db.func.sum(price).label("total_price"),
+            )
+            .group_by(cls.category, cls.available)
+            .order_by(cls.category, cls.available)
+            .all()
+        )
+
+    @classmethod
+    def latest_revision(cls):
+        """The revision every change at or below which has committed"""
+        return db.session.execute(revision_horizon(db.engine.dialect.name)).scalar() or 0
+
+    @classmethod
+    def existing_ids(cls, ids):
+        rows = db.session.query(cls.id).filter(cls.id.in_(list(ids)))
+        return {row.id for row in rows}
 
     @classmethod
     def all(cls):
@@ -80,9 +634,16 @@ class Product(db.Model):
         return cls.query.all()
 
     @classmethod
-    def find(cls, by_id):
+    def find(cls, by_id, fields=None):
         logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.get(by_id)
+        query = cls.query
+        if shard_set.binds:
+            query = query.execution_options(shard=shard_set.shard_for(by_id))
+        if fields is None:
+            return query.get(by_id)
+        # deferred loading: only the requested columns (plus the ETag's) are read
+        columns = {"id", "version", *fields}
+        return query.options(db.load_only(*columns)).get(by_id)
 
     @classmethod
     def find_by_name(cls, name):
@@ -98,3 +659,153 @@ class Product(db.Model):
     def find_by_availability(cls, available=True):
         logger.info("Processing availability query for %s ...", available)
         return cls.query.filter(cls.available == available)
+
+    @classmethod
+    def find_by_filters(cls, name=None, category=None, available=None,
+                        price_min=None, price_max=None, query=None):
+        logger.info(
+            "Processing filtered query name=%s category=%s available=%s price=[%s, %s] ...",
+            name, category, available, price_min, price_max,
+        )
+        # query may also be a Core select(), as used by the async app
+        query = cls.query if query is None else query
+        if name is not None:
+            query = query.filter(cls.name == name)
+        if category is not None:
+            query = query.filter(cls.category == category)
+        if available is not None:
+            query = query.filter(cls.available == available)
+        if price_min is not None:
+            query = query.filter(cls.price >= price_min)
+        if price_max is not None:
+            query = query.filter(cls.price <= price_max)
+        return query
+
+    @classmethod
+    def search(cls, text, query=None, dialect=None, fts_index=None):
+        """Ranks query by text; dialect and fts_index default to the product engines'"""
+        logger.info("Processing search for %s ...", text)
+        terms = re.findall(r"\w+", text)
+        if not terms:
+            raise DataValidationError("Invalid search: q must contain a word")
+        query = cls.query if query is None else query
+        dialect = dialect or cls.engines()[0].dialect.name
+        if fts_index is None and dialect == "sqlite":
+            fts_index = cls.has_fts_index()
+        if shard_set.binds and (dialect == "postgresql" or (dialect == "sqlite" and fts_index)):
+            # each shard ranks its own rows, and the ranks do not merge
+            raise DataValidationError("Invalid search: ranked search is not available on sharded products")
+        if dialect == "sqlite" and fts_index:
+            # quoted terms are ANDed; the last one also matches as a prefix
+            match = " ".join(f'"{term}"' for term in terms) + "*"
+            fts = db.table("product_fts", db.column("rowid"), db.column("rank"))
+            return (
+                query.join(fts, fts.c.rowid == cls.id)
+                .filter(db.literal_column("product_fts").op("MATCH")(match))
+                .order_by(fts.c.rank, cls.id)
+            )
+        if dialect == "postgresql":
+            document = db.func.to_tsvector(
+                "english",
+                db.func.coalesce(cls.name, "") + " " + db.func.coalesce(cls.description, ""),
+            )
+            tsquery = db.func.plainto_tsquery("english", " ".join(terms))
+            return query.filter(document.op("@@")(tsquery)).order_by(
+                db.func.ts_rank(document, tsquery).desc(), cls.id
+            )
+        for term in terms:
+            pattern = f"%{term}%"
+            query = query.filter(db.or_(cls.name.ilike(pattern), cls.description.ilike(pattern)))
+        return query.order_by(cls.id)
+
+    @classmethod
+    def has_fts_index(cls):
+        # shards are set up alike, so the first one answers for all
+        engine = cls.engines()[0]
+        url = str(engine.url)
+        if url not in fts_indexes:
+            fts_indexes[url] = db.inspect(engine).has_table("product_fts")
+        return fts_indexes[url]
+
+    @classmethod
+    def sort_column(cls, sort="id"):
+        name = sort.lstrip("-")
+        if name not in SORT_COLUMNS:
+            raise DataValidationError(
+                "Invalid sort: must be one of " + ", ".join(SORT_COLUMNS)
+            )
+        return getattr(cls, name), sort.startswith("-")
+
+    @classmethod
+    def sort_by(cls, query, sort="id"):
+        column, descending = cls.sort_column(sort)
+        order = column.desc() if descending else column
+        if column is cls.id:
+            return query.order_by(order)
+        # id breaks ties so that keyset pagination is stable
+        return query.order_by(order, cls.id)
+
+    @classmethod
+    def paginate(cls, query, after=None, limit=None, sort="id"):
+        logger.info("Processing page after %s sorted by %s (limit %s) ...", after, sort, limit)
+        query = cls.sort_by(query, sort)
+        if after is not None:
+            after_id, after_value = after
+            column, descending = cls.sort_column(sort)
+            if column is cls.id:
+                query = query.filter(cls.id < after_id if descending else cls.id > after_id)
+            else:
+                beyond = column < after_value if descending else column > after_value
+                query = query.filter(
+                    db.or_(beyond, db.and_(column == after_value, cls.id > after_id))
+                )
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @classmethod
+    def row_columns(cls, fields=FIELDS):
+        columns = {
+            "id": cls.id,
+            "name": cls.name,
+            "description": cls.description,
+            "price": db.type_coerce(cls.price, db.Float).label("price"),
+            "available": cls.available,
+            "category": db.type_coerce(cls.category, db.String).label("category"),
+        }
+        return tuple(columns[field] for field in fields)
+
+    @classmethod
+    def rows(cls, query, fields=FIELDS):
+        logger.info("Processing column-level query for %s ...", ", ".join(fields))
+        return query.with_entities(*cls.row_columns(fields))
+
+    @classmethod
+    def stream(cls, query, batch_size=1000, sort="id"):
+        logger.info("Processing streamed query (batch size %s) ...", batch_size)
+        # server-side cursor: rows are fetched and hydrated one batch at a time
+        return (
+            cls.sort_by(query, sort)
+            .execution_options(stream_results=True)
+            .yield_per(batch_size)
+        )
+
+
+@event.listens_for(Session, "before_flush")
+def assign_revisions(session, flush_context, instances):
+    # covers every ORM write, including the async app's sessions
+    changed = [
+        obj for obj in session.new if isinstance(obj, Product)
+    ] + [
+        obj for obj in session.dirty
+        if isinstance(obj, Product) and session.is_modified(obj)
+    ]
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Product)]
+    if not changed and not deleted:
+        return
+    connection = session.connection()
+    if changed:
+        for product, revision in zip(changed, next_revisions(connection, len(changed))):
+            product.revision = revision
+    if deleted:
+        Tombstone.bury(connection, deleted)
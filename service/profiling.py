@@ -0,0 +1,328 @@
+"""
+Opt-in query profiling: per-statement timings, a slow-query log with the bound
+parameters and the database's plan, N+1 detection per request, and sampled
+per-request profiles.
+
+Profiles come from pyinstrument when it is installed and cProfile otherwise.
+They are written to the profile directory as text, so that any worker can
+serve them at /stats/profiles/<id>; the id is returned in X-Profile-Id.
+"""
+import io
+import os
+import re
+import time
+import random
+import pstats
+import cProfile
+import logging
+import secrets
+import tempfile
+import threading
+from collections import deque
+from flask import g, request, has_request_context
+from prometheus_client import Counter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from . import metrics
+
+try:
+    import pyinstrument
+except ImportError:  # pragma: no cover - depends on the environment
+    pyinstrument = None
+
+logger = logging.getLogger("flask.app")
+
+SLOW_QUERIES = Counter(
+    "db_slow_queries_total",
+    "Statements slower than the slow-query threshold",
+)
+N_PLUS_ONE = Counter(
+    "db_n_plus_one_total",
+    "Requests that ran the same SELECT at least the N+1 threshold times, by endpoint",
+    ["endpoint"],
+)
+
+EXPLAINABLE = ("SELECT", "WITH", "UPDATE", "DELETE")
+# the same plan is not asked for again within this many seconds
+EXPLAIN_INTERVAL = 60.0
+MAX_STATEMENTS = 1000
+MAX_PARAMETERS_LENGTH = 500
+PROFILE_ID = re.compile(r"[0-9a-f]{16}")
+
+
+class QueryProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.slow_seconds = 0.1
+        self.explain = True
+        self.n_plus_one = 10
+        self.sample_rate = 0.0
+        self.token = None
+        self.directory = None
+        self.keep = 200
+        # statement -> [count, total seconds, max seconds], for this worker
+        self.timings = {}
+        self.slow = deque(maxlen=100)
+        self.repeated = deque(maxlen=100)
+        self.explained = {}
+        self._lock = threading.Lock()
+
+    def configure(self, enabled=False, slow_ms=100, explain=True, n_plus_one=10,
+                  sample_rate=0.0, token=None, directory=None, keep=200):
+        self.enabled = enabled
+        self.slow_seconds = slow_ms / 1000.0
+        self.explain = explain
+        self.n_plus_one = n_plus_one
+        self.sample_rate = sample_rate
+        self.token = token
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "profiles")
+        self.keep = keep
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timings = {}
+            self.explained = {}
+        self.slow.clear()
+        self.repeated.clear()
+
+    ######################################################################
+    # STATEMENTS
+    ######################################################################
+
+    def record(self, conn, statement, parameters, elapsed, executemany):
+        with self._lock:
+            timing = self.timings.get(statement)
+            if timing is None and len(self.timings) < MAX_STATEMENTS:
+                timing = self.timings[statement] = [0, 0.0, 0.0]
+            if timing is not None:
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+        if has_request_context() and "profile_statements" in g:
+            counts = g.profile_statements
+            counts[statement] = counts.get(statement, 0) + 1
+        if elapsed >= self.slow_seconds:
+            self.slow_query(conn, statement, parameters, elapsed, executemany)
+
+    def slow_query(self, conn, statement, parameters, elapsed, executemany):
+        SLOW_QUERIES.inc()
+        plan = None
+        if self.explain and not executemany and self.should_explain(statement):
+            plan = explain(conn, statement, parameters)
+        entry = {
+            "statement": statement,
+            "parameters": repr(parameters)[:MAX_PARAMETERS_LENGTH],
+            "ms": round(elapsed * 1000, 3),
+            "plan": plan,
+            "endpoint": metrics.endpoint_label() if has_request_context() else None,
+        }
+        self.slow.append(entry)
+        logger.warning(
+            "Slow query (%.1f ms): %s\nParameters: %s%s", entry["ms"], statement, entry["parameters"],
+            "\nPlan:\n  " + "\n  ".join(plan) if plan else "",
+        )
+
+    def should_explain(self, statement):
+        if not statement.lstrip().upper().startswith(EXPLAINABLE):
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if now - self.explained.get(statement, -EXPLAIN_INTERVAL) < EXPLAIN_INTERVAL:
+                return False
+            self.explained[statement] = now
+        return True
+
+    def authorized(self):
+        """Whether this request sent the profile token"""
+        return self.token is not None and secrets.compare_digest(
+            request.headers.get("X-Profile", ""), self.token
+        )
+
+    def snapshot(self, limit=20, parameters=False):
+        """Timings, slow queries and N+1 suspects; bound values only with parameters"""
+        with self._lock:
+            timings = sorted(self.timings.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return {
+            "enabled": self.enabled,
+            "statements": [
+                {"statement": statement, "count": count, "total_ms": round(total * 1000, 3),
+                 "mean_ms": round(total * 1000 / count, 3), "max_ms": round(longest * 1000, 3)}
+                for statement, (count, total, longest) in timings
+            ],
+            "slow": [entry if parameters else dict(entry, parameters=None) for entry in self.slow],
+            "n_plus_one": list(self.repeated),
+        }
+
+    ######################################################################
+    # REQUESTS
+    ######################################################################
+
+    def before_request(self):
+        if not self.enabled:
+            return
+        g.profile_statements = {}
+        forced = self.authorized()
+        if forced or (self.sample_rate and random.random() < self.sample_rate):
+            g.profiler = start_profiler()
+
+    def after_request(self, response):
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            started = time.perf_counter()
+            profile_id = self.save(profiler)
+            if profile_id:
+                response.headers["X-Profile-Id"] = profile_id
+                logger.info("Profiled %s %s as %s (%.1f ms to write)", request.method, request.path,
+                            profile_id, (time.perf_counter() - started) * 1000)
+        return response
+
+    def teardown_request(self, exception=None):
+        counts = g.pop("profile_statements", None)
+        if not counts:
+            return
+        for statement, count in counts.items():
+            if count >= self.n_plus_one and statement.lstrip().upper().startswith("SELECT"):
+                endpoint = metrics.endpoint_label()
+                N_PLUS_ONE.labels(endpoint).inc()
+                self.repeated.append({"endpoint": endpoint, "statement": statement, "count": count})
+                logger.warning("Possible N+1: %s %s ran this %d times: %s",
+                               request.method, request.path, count, statement)
+
+    ######################################################################
+    # PROFILES
+    ######################################################################
+
+    def save(self, profiler):
+        report = stop_profiler(profiler)
+        header = f"{request.method} {request.full_path.rstrip('?')}\n\n"
+        profile_id = secrets.token_hex(8)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, profile_id + ".txt"), "w", encoding="utf-8") as out:
+                out.write(header + report)
+            self.prune()
+        except OSError as error:
+            logger.warning("Could not write profile to %s: %s", self.directory, error)
+            return None
+        return profile_id
+
+    def prune(self):
+        names = [name for name in os.listdir(self.directory)
+                 if name.endswith(".txt") and PROFILE_ID.fullmatch(name[:-4])]
+        if len(names) <= self.keep:
+            return
+        paths = sorted((os.path.join(self.directory, name) for name in names), key=os.path.getmtime)
+        for path in paths[:len(paths) - self.keep]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # another worker got to it first
+
+    def load(self, profile_id):
+        """A saved profile report, or None"""
+        if not PROFILE_ID.fullmatch(profile_id):
+            return None
+        try:
+            with open(os.path.join(self.directory, profile_id + ".txt"), encoding="utf-8") as report:
+                return report.read()
+        except OSError:
+            return None
+
+
+def explain(conn, statement, parameters):
+    """The plan of statement, run on its own cursor so the caller's results are untouched"""
+    sqlite = conn.dialect.name == "sqlite"
+    prefix = "EXPLAIN QUERY PLAN " if sqlite else "EXPLAIN "
+    # on PostgreSQL a failed statement aborts the whole transaction, so the
+    # EXPLAIN gets a savepoint to roll back to; SQLite only fails the statement
+    savepoint = not sqlite and conn.in_transaction()
+    try:
+        cursor = conn.connection.cursor()
+        try:
+            if savepoint:
+                cursor.execute("SAVEPOINT profile_explain")
+            try:
+                cursor.execute(prefix + statement, parameters)
+                # SQLite's rows are (id, parent, notused, detail)
+                plan = [str(row[3]) if sqlite else " ".join(str(value) for value in row)
+                        for row in cursor.fetchall()]
+            except Exception:
+                if savepoint:
+                    cursor.execute("ROLLBACK TO SAVEPOINT profile_explain")
+                raise
+            finally:
+                if savepoint:
+                    cursor.execute("RELEASE SAVEPOINT profile_explain")
+            return plan
+        finally:
+            cursor.close()
+    except Exception as error:  # pylint: disable=broad-except
+        logger.info("Could not explain slow query: %s", error)
+        return None
+
+
+def start_profiler():
+    if pyinstrument is not None:
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        return profiler
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiler is already active on this thread
+        return None
+    return profiler
+
+
+def stop_profiler(profiler):
+    if pyinstrument is not None and isinstance(profiler, pyinstrument.Profiler):
+        profiler.stop()
+        return profiler.output_text()
+    profiler.disable()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(50)
+    return out.getvalue()
+
+
+query_profiler = QueryProfiler()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if query_profiler.enabled:
+        conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("profile_start")
+    if starts:
+        elapsed = time.perf_counter() - starts.pop()
+        query_profiler.record(conn, statement, parameters, elapsed, executemany)
+
+
+@event.listens_for(Engine, "handle_error")
+def handle_error(context):
+    starts = context.connection.info.get("profile_start") if context.connection else None
+    if starts:
+        starts.pop()
+
+
+def init_profiling(app):
+    query_profiler.configure(
+        enabled=app.config.get("PROFILE_ENABLED", False),
+        slow_ms=float(app.config.get("PROFILE_SLOW_QUERY_MS", 100)),
+        explain=app.config.get("PROFILE_EXPLAIN", True),
+        n_plus_one=int(app.config.get("PROFILE_N_PLUS_ONE", 10)),
+        sample_rate=float(app.config.get("PROFILE_SAMPLE_RATE", 0.0)),
+        token=app.config.get("PROFILE_TOKEN") or None,
+        directory=app.config.get("PROFILE_DIR"),
+    )
+    app.before_request(query_profiler.before_request)
+    app.after_request(query_profiler.after_request)
+    app.teardown_request(query_profiler.teardown_request)
+    if query_profiler.enabled:
+        logger.info("Query profiling enabled: slow queries over %.0f ms, sampling %.2f%% of requests (%s)",
+                    query_profiler.slow_seconds * 1000, query_profiler.sample_rate * 100,
+                    "pyinstrument" if pyinstrument is not None else "cProfile")
@@ -0,0 +1,160 @@
+import json
+import base64
+from decimal import Decimal, InvalidOperation
+from .models import Product, Category, DataValidationError, FIELDS
+
+# Parsing of GET /products query arguments, shared by the Flask routes and
+# the ASGI app. Every helper raises DataValidationError on bad input.
+
+def parse_filters(args):
+    category = args.get("category")
+    if category:
+        try:
+            category = Category[category.upper()]
+        except KeyError:
+            raise DataValidationError(f"Invalid category '{category}'")
+    else:
+        category = None
+    available = args.get("available")
+    if available:
+        available = available.lower() in ["true", "yes", "1"]
+    else:
+        available = None
+    return {
+        "name": args.get("name") or None,
+        "category": category,
+        "available": available,
+        "price_min": parse_price(args.get("price_min"), "price_min"),
+        "price_max": parse_price(args.get("price_max"), "price_max"),
+    }
+
+def parse_price(value, name):
+    if not value:
+        return None
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise DataValidationError(f"{name} must be a number")
+    # NaN and Infinity parse, but fail (sNaN) or mislead in comparisons
+    if not price.is_finite():
+        raise DataValidationError(f"{name} must be a number")
+    return price
+
+def parse_fields(value):
+    if not value:
+        return None
+    requested = {field.strip() for field in value.split(",") if field.strip()}
+    unknown = requested.difference(FIELDS)
+    if unknown or not requested:
+        raise DataValidationError(
+            "Invalid fields: must be a comma separated list of " + ", ".join(FIELDS)
+        )
+    return tuple(field for field in FIELDS if field in requested)
+
+def parse_limit(limit, default=100, maximum=1000):
+    if limit is None:
+        return default
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise DataValidationError("limit must be an integer")
+    if limit < 1:
+        raise DataValidationError("limit must be a positive integer")
+    return min(limit, maximum)
+
+def encode_position(position):
+    payload = json.dumps(position).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+
+def decode_position(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded))
+    except ValueError:
+        raise DataValidationError("Invalid pagination cursor")
+    if not isinstance(position, dict):
+        raise DataValidationError("Invalid pagination cursor")
+    return position
+
+def encode_cursor(data, sort="id"):
+    column, descending = Product.sort_column(sort)
+    # the sort is recorded, so a cursor cannot continue a differently sorted list
+    position = {"id": data["id"], "s": sort_name(column, descending)}
+    if column is not Product.id:
+        position["v"] = data[column.key]
+    return encode_position(position)
+
+def decode_cursor(cursor, sort="id"):
+    position = decode_position(cursor)
+    try:
+        after_id = int(position["id"])
+    except (ValueError, KeyError, TypeError):
+        raise DataValidationError("Invalid pagination cursor")
+    column, descending = Product.sort_column(sort)
+    if position.get("s") != sort_name(column, descending):
+        raise DataValidationError("Invalid pagination cursor")
+    if column is Product.id:
+        return after_id, None
+    return after_id, cursor_value(column, position.get("v"))
+
+def sort_name(column, descending):
+    return ("-" if descending else "") + column.key
+
+def cursor_value(column, value):
+    """The sort key a cursor carries, checked against the sort column"""
+    if column is Product.name:
+        if isinstance(value, str):
+            return value
+    elif isinstance(value, (str, int, float)) and not isinstance(value, bool):
+        try:
+            price = Decimal(str(value))
+        except InvalidOperation:
+            price = None
+        if price is not None and price.is_finite():
+            return price
+    raise DataValidationError("Invalid pagination cursor")
+
+# ranked search results have no stable sort key, so they page by offset
+def encode_offset_cursor(offset):
+    return encode_position({"o": offset})
+
+def decode_offset_cursor(cursor):
+    position = decode_position(cursor)
+    try:
+        offset = int(position["o"])
+    except (ValueError, KeyError, TypeError):
+        raise DataValidationError("Invalid pagination cursor")
+    if offset < 0:
+        raise DataValidationError("Invalid pagination cursor")
+    return offset
+
+# change feed tokens wrap the last revision the client has seen and, when
+# the page ended partway through a revision, the last id seen within it
+def encode_revision_token(revision, product_id=None):
+    position = {"r": revision}
+    if product_id is not None:
+        position["i"] = product_id
+    return encode_position(position)
+
+def decode_revision_token(token):
+    """(revision, id or None) of a change feed token"""
+    position = decode_position(token)
+    try:
+        revision = int(position["r"])
+        product_id = None if position.get("i") is None else int(position["i"])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise DataValidationError("Invalid change token")
+    if revision < 0 or (product_id is not None and product_id < 0):
+        raise DataValidationError("Invalid change token")
+    return revision, product_id
+
+def parse_wait(wait, maximum=30):
+    if wait is None:
+        return 0
+    try:
+        wait = float(wait)
+    except ValueError:
+        raise DataValidationError("wait must be a number of seconds")
+    if wait < 0:
+        raise DataValidationError("wait must not be negative")
+    return min(wait, maximum)
@@ -0,0 +1,188 @@
+import math
+import time
+import hashlib
+import logging
+import threading
+from http import HTTPStatus
+from collections import OrderedDict
+from flask import g, jsonify, request
+from . import status
+
+logger = logging.getLogger("flask.app")
+
+# tokens a request costs, by endpoint; anything not listed costs 1
+DEFAULT_COSTS = {
+    "list_products": 2,
+    "list_products_full": 20,  # no limit/cursor/q: serializes the whole table
+    "product_stats": 2,
+    "export_products": 50,
+    "import_products": 20,
+    "create_products_batch": 10,
+    "update_products_batch": 10,
+    "delete_products_batch": 10,
+    "create_import_job": 20,
+    "create_price_change_job": 20,
+}
+EXEMPT_ENDPOINTS = ("healthcheck", "export_metrics", "index", "static")
+# long polls sleep without touching the database, so they hold no slot
+UNCAPPED_ENDPOINTS = ("list_changes",)
+
+REDIS_TAKE_SCRIPT = """
+local rate, capacity = tonumber(ARGV[1]), tonumber(ARGV[2])
+local cost, now = tonumber(ARGV[3]), tonumber(ARGV[4])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class MemoryBuckets:
+    """Token buckets for this process only; the least recently seen clients are dropped"""
+
+    def __init__(self, max_clients=100000):
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, cost, rate, capacity):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return allowed, tokens
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisBuckets:
+    """Shared token buckets, so that a client's budget spans every worker"""
+
+    def __init__(self, url, prefix="ratelimit:"):
+        import redis  # pylint: disable=import-outside-toplevel
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.script = self.client.register_script(REDIS_TAKE_SCRIPT)
+
+    def take(self, key, cost, rate, capacity):
+        allowed, tokens = self.script(
+            keys=[self.prefix + key], args=[rate, capacity, cost, time.time()]
+        )
+        return bool(allowed), float(tokens)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+class RateLimiter:
+    def __init__(self, buckets=None):
+        self.buckets = buckets or MemoryBuckets()
+        self.enabled = False
+        self.rate = 20.0
+        self.burst = 200
+        self.costs = dict(DEFAULT_COSTS)
+        self.max_in_flight = 0
+        self.in_flight = 0
+        self.api_keys = frozenset()
+        self._lock = threading.Lock()
+
+    def cost(self):
+        name = request.endpoint.rsplit(".", 1)[-1]
+        if name == "list_products" and not any(
+            arg in request.args for arg in ("limit", "cursor", "q")
+        ):
+            name = "list_products_full"
+        # a cost above the burst could never be paid
+        return min(self.costs.get(name, 1), self.burst)
+
+    def before_request(self):
+        if not self.enabled or request.endpoint is None:
+            return None
+        name = request.endpoint.rsplit(".", 1)[-1]
+        if name in EXEMPT_ENDPOINTS:
+            return None
+        if self.max_in_flight and name not in UNCAPPED_ENDPOINTS:
+            with self._lock:
+                shed = self.in_flight >= self.max_in_flight
+                if not shed:
+                    self.in_flight += 1
+                    g.ratelimit_slot = True
+            if shed:
+                # shed load instead of queueing behind busy threads
+                logger.warning("Shedding %s %s: %d requests in flight",
+                               request.method, request.path, self.max_in_flight)
+                return limited(status.HTTP_503_SERVICE_UNAVAILABLE, "Server is busy, retry shortly", 1)
+        cost = self.cost()
+        client = self.client_key()
+        allowed, tokens = self.buckets.take(client, cost, self.rate, self.burst)
+        g.ratelimit_remaining = int(tokens)
+        if not allowed:
+            retry_after = math.ceil((cost - tokens) / self.rate)
+            logger.warning("Rate limited %s on %s %s", client, request.method, request.path)
+            return limited(status.HTTP_429_TOO_MANY_REQUESTS, "Rate limit exceeded", retry_after)
+        return None
+
+    def client_key(self):
+        # a known API key identifies a client across addresses; any other
+        # value would let a client mint itself a fresh bucket per request
+        api_key = request.headers.get("X-API-Key")
+        if api_key and api_key in self.api_keys:
+            return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+        # the client's own address only when TRUSTED_PROXIES is set right
+        return "ip:" + (request.remote_addr or "unknown")
+
+    def after_request(self, response):
+        remaining = g.pop("ratelimit_remaining", None)
+        if remaining is not None:
+            response.headers["X-RateLimit-Limit"] = str(self.burst)
+            response.headers["X-RateLimit-Remaining"] = str(remaining)
+        return response
+
+    def teardown_request(self, exception=None):
+        if g.pop("ratelimit_slot", False):
+            with self._lock:
+                self.in_flight -= 1
+
+
+def limited(code, message, retry_after):
+    response = jsonify(status=code, error=HTTPStatus(code).phrase, message=message)
+    response.status_code = code
+    response.headers["Retry-After"] = str(max(int(retry_after), 1))
+    return response
+
+
+rate_limiter = RateLimiter()
+
+
+def init_rate_limit(app):
+    url = app.config.get("RATELIMIT_STORAGE_URL")
+    rate_limiter.buckets = RedisBuckets(url) if url else MemoryBuckets()
+    rate_limiter.enabled = app.config.get("RATELIMIT_ENABLED", False)
+    rate_limiter.rate = float(app.config.get("RATELIMIT_RATE", 20))
+    rate_limiter.burst = int(app.config.get("RATELIMIT_BURST", 200))
+    rate_limiter.costs = dict(DEFAULT_COSTS, **app.config.get("RATELIMIT_COSTS", {}))
+    rate_limiter.max_in_flight = int(app.config.get("MAX_IN_FLIGHT", 0))
+    rate_limiter.api_keys = frozenset(app.config.get("RATELIMIT_API_KEYS", ()))
+    app.before_request(rate_limiter.before_request)
+    app.after_request(rate_limiter.after_request)
+    app.teardown_request(rate_limiter.teardown_request)
+    logger.info("Rate limiting using %s", type(rate_limiter.buckets).__name__)
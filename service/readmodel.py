@@ -0,0 +1,335 @@
+"""
+In-process read model of the whole catalog, for GET /products/<id> and lists
+filtered by category and/or availability.
+
+The catalog is written to a snapshot file of fixed-width columns (ids,
+versions, prices in cents, flags), a string heap and the category and
+availability indexes, and read back through mmap: loading costs no queries
+and no per-row objects, and workers forked from one master share the pages.
+Writes made since the snapshot come from the change feed into a small
+overlay; once that grows past max_overlay the snapshot is rewritten.
+
+The header records the catalog's identity and the revision the snapshot was
+taken at. A snapshot of another catalog (init_db replaces the identity) or
+one ahead of the database (restored from a backup) is rebuilt, not reused:
+neither leaves tombstones in the change feed for the rows it no longer has.
+"""
+import os
+import sys
+import mmap
+import time
+import heapq
+import struct
+import logging
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+from decimal import Decimal
+from .models import Product, Catalog, Category, FIELDS
+from .cache import product_cache
+
+logger = logging.getLogger("flask.app")
+
+MAGIC = b"CATALOG2"
+# magic, byte order, catalog identity, row count, revision, heap size
+HEADER = struct.Struct("<8s8s32sqqq")
+CATEGORIES = sorted(category.value for category in Category)
+AVAILABLE, HAS_DESCRIPTION = 1, 2
+
+
+class CatalogRow:
+    __slots__ = ("id", "name", "description", "price", "available", "category", "version")
+
+    def __init__(self, id, name, description, price, available, category, version):  # pylint: disable=redefined-builtin
+        self.id = id
+        self.name = name
+        self.description = description
+        self.price = price  # formatted like Product.serialize(), e.g. "12.50"
+        self.available = available
+        self.category = category  # the Category name
+        self.version = version
+
+    @classmethod
+    def from_product(cls, product):
+        return cls(
+            product.id, product.name, product.description, f"{product.price:.2f}",
+            product.available, product.category.name, product.version,
+        )
+
+    def serialize(self, fields=FIELDS):
+        return {field: getattr(self, field) for field in fields}
+
+    def matches(self, category=None, available=None):
+        return (category is None or self.category == category.name) and (
+            available is None or self.available == available
+        )
+
+
+def cents(price):
+    return int(round(price * 100))
+
+
+def format_cents(value):
+    return f"{Decimal(value).scaleb(-2):.2f}"
+
+
+def write_snapshot(path, rows, revision, identity=""):
+    """Writes rows (id, name, description, price, available, category, version), by id"""
+    ids, versions, prices, offsets = array("q"), array("q"), array("q"), array("q", [0])
+    flags, categories, heap = bytearray(), bytearray(), bytearray()
+    by_category = {value: array("i") for value in CATEGORIES}
+    by_availability = {False: array("i"), True: array("i")}
+    for position, (product_id, name, description, price, available, category, version) in enumerate(rows):
+        ids.append(product_id)
+        versions.append(version)
+        prices.append(cents(price))
+        for text in (name, description or ""):
+            heap += text.encode("utf-8")
+            offsets.append(len(heap))
+        flags.append((AVAILABLE if available else 0) | (HAS_DESCRIPTION if description is not None else 0))
+        categories.append(category.value)
+        by_category[category.value].append(position)
+        by_availability[bool(available)].append(position)
+    count = len(ids)
+    category_offsets = array("q", [0])
+    category_positions = array("i")
+    for value in CATEGORIES:
+        category_positions.extend(by_category[value])
+        category_offsets.append(len(category_positions))
+    available_offsets = array("q", [0, len(by_availability[False]), count])
+    available_positions = by_availability[False] + by_availability[True]
+
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(handle, "wb") as snapshot:
+        snapshot.write(HEADER.pack(
+            MAGIC, sys.byteorder.encode().ljust(8), identity.encode(), count, revision, len(heap)
+        ))
+        # widest columns first, so every column stays aligned for memoryview.cast
+        for column in (ids, versions, prices, offsets, category_offsets, available_offsets,
+                       category_positions, available_positions):
+            column.tofile(snapshot)
+        snapshot.write(flags)
+        snapshot.write(categories)
+        snapshot.write(heap)
+    # readers still mapping the old file keep it until they reload
+    os.replace(temporary, path)
+    logger.info("Wrote catalog snapshot of %d products at revision %d to %s", count, revision, path)
+    return count
+
+
+class Snapshot:
+    """A snapshot file mapped into memory; columns are views, not copies"""
+
+    def __init__(self, path):
+        with open(path, "rb") as snapshot:
+            self.mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byteorder, identity, count, self.revision, heap_size = HEADER.unpack_from(self.mapped)
+        if magic != MAGIC or byteorder.rstrip() != sys.byteorder.encode():
+            self.mapped.close()
+            raise ValueError(f"{path} is not a catalog snapshot for this platform")
+        self.identity = identity.rstrip(b"\0").decode()
+        self.count = count
+        view = memoryview(self.mapped)
+        start = HEADER.size
+        columns = {}
+        for name, code, length in (
+            ("ids", "q", count), ("versions", "q", count), ("prices", "q", count),
+            ("offsets", "q", 2 * count + 1), ("category_offsets", "q", len(CATEGORIES) + 1),
+            ("available_offsets", "q", 3), ("category_positions", "i", count),
+            ("available_positions", "i", count), ("flags", "B", count), ("categories", "B", count),
+        ):
+            size = length * struct.calcsize(code)
+            columns[name] = view[start:start + size].cast(code)
+            start += size
+        self.__dict__.update(columns)
+        self.heap = view[start:start + heap_size]
+
+    def position(self, product_id):
+        index = bisect_left(self.ids, product_id)
+        if index < self.count and self.ids[index] == product_id:
+            return index
+        return None
+
+    def text(self, index):
+        return bytes(self.heap[self.offsets[index]:self.offsets[index + 1]]).decode("utf-8")
+
+    def row(self, position):
+        flags = self.flags[position]
+        return CatalogRow(
+            self.ids[position],
+            self.text(2 * position),
+            self.text(2 * position + 1) if flags & HAS_DESCRIPTION else None,
+            format_cents(self.prices[position]),
+            bool(flags & AVAILABLE),
+            Category(self.categories[position]).name,
+            self.versions[position],
+        )
+
+    def positions(self, category=None, available=None):
+        """Positions of the matching rows, in id order"""
+        if category is not None:
+            index = CATEGORIES.index(category.value)
+            start, end = self.category_offsets[index], self.category_offsets[index + 1]
+            positions = self.category_positions[start:end]
+            if available is None:
+                return positions
+            flag = AVAILABLE if available else 0
+            return (p for p in positions if (self.flags[p] & AVAILABLE) == flag)
+        if available is not None:
+            start, end = self.available_offsets[int(available)], self.available_offsets[int(available) + 1]
+            return self.available_positions[start:end]
+        return range(self.count)
+
+
+class ReadModel:
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.path = None
+        self.refresh_interval = 1.0
+        self.max_overlay = 10000
+        self.snapshot = None
+        # id -> CatalogRow written since the snapshot, or None once deleted
+        self.overlay = {}
+        self.revision = 0
+        self.since_id = None  # the last id applied within self.revision, if any
+        self.generation = None
+        self.refreshed_at = 0.0
+        self.rebuilding = False
+        self._lock = threading.Lock()
+
+    def configure(self, app, path, refresh_interval=1.0, max_overlay=10000):
+        self.app = app
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.max_overlay = max_overlay
+        self.snapshot, self.overlay, self.revision, self.since_id = None, {}, 0, None
+
+    def load(self, rebuild=False):
+        """Maps the snapshot file, writing it first if there is none or it is stale"""
+        with self._lock:
+            snapshot = None if rebuild else self.reusable()
+            if snapshot is None:
+                self.build()
+                snapshot = Snapshot(self.path)
+            self.snapshot, self.overlay = snapshot, {}
+            self.revision, self.since_id = snapshot.revision, None
+            self.generation = None
+        logger.info("Loaded catalog snapshot of %d products at revision %d",
+                    snapshot.count, snapshot.revision)
+
+    def reusable(self):
+        """The existing snapshot, if it was taken of the catalog now in the database"""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            snapshot = Snapshot(self.path)
+        except ValueError as error:
+            logger.info("Rebuilding catalog snapshot: %s", error)
+            return None
+        identity, revision = Catalog.current_identity(), Product.latest_revision()
+        if snapshot.identity == identity and snapshot.revision <= revision:
+            return snapshot
+        logger.info("Rebuilding catalog snapshot: taken of catalog %s at revision %d, database has %s at %d",
+                    snapshot.identity or "?", snapshot.revision, identity, revision)
+        return None
+
+    def build(self):
+        identity = Catalog.current_identity()
+        # rows written after this revision are picked up again from the change feed
+        revision = Product.latest_revision()
+        query = Product.query.with_entities(
+            Product.id, Product.name, Product.description, Product.price,
+            Product.available, Product.category, Product.version,
+        ).order_by(Product.id)
+        write_snapshot(self.path, query.yield_per(10000), revision, identity)
+
+    def refresh(self):
+        """Applies the change feed when this worker wrote or the interval passed"""
+        generation = product_cache.generation()
+        now = time.monotonic()
+        if generation == self.generation and now - self.refreshed_at < self.refresh_interval:
+            return
+        with self._lock:
+            if generation == self.generation and now - self.refreshed_at < self.refresh_interval:
+                return  # another thread caught up while this one waited
+            overlay, revision, since_id = dict(self.overlay), self.revision, self.since_id
+            while True:
+                changes = Product.changes(revision, 1000, since_id)
+                if not changes:
+                    break
+                for change in changes:
+                    deleted = not isinstance(change, Product)
+                    overlay[change.id] = None if deleted else CatalogRow.from_product(change)
+                revision, since_id = changes[-1].revision, changes[-1].id
+            # readers iterate the old dict, so it is replaced, never changed
+            self.overlay, self.revision, self.since_id = overlay, revision, since_id
+            self.generation, self.refreshed_at = generation, now
+        if len(overlay) > self.max_overlay and not self.rebuilding:
+            self.rebuilding = True
+            threading.Thread(target=self.rebuild, name="snapshot", daemon=True).start()
+
+    def rebuild(self):
+        try:
+            with self.app.app_context():
+                self.load(rebuild=True)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Catalog snapshot rebuild failed")
+        finally:
+            self.rebuilding = False
+
+    def ready(self):
+        """Loads the snapshot on first use and catches up with recent writes"""
+        if not self.enabled:
+            return False
+        if self.snapshot is None:
+            try:
+                self.load()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning("Catalog read model unavailable: %s", error)
+                return False
+        self.refresh()
+        return True
+
+    def get(self, product_id):
+        """The product's row, or None when it is not in the read model"""
+        if not self.ready():
+            return None
+        if product_id in self.overlay:
+            return self.overlay[product_id]
+        position = self.snapshot.position(product_id)
+        return None if position is None else self.snapshot.row(position)
+
+    def find(self, category=None, available=None):
+        """Matching rows in id order, or None when the read model is not ready"""
+        if not self.ready():
+            return None
+        snapshot, overlay = self.snapshot, self.overlay
+        base = (
+            snapshot.row(position) for position in snapshot.positions(category, available)
+            if snapshot.ids[position] not in overlay
+        )
+        written = sorted(
+            (row for row in overlay.values() if row is not None and row.matches(category, available)),
+            key=lambda row: row.id,
+        )
+        return heapq.merge(base, written, key=lambda row: row.id)
+
+
+read_model = ReadModel()
+
+
+def init_read_model(app):
+    read_model.enabled = app.config.get("READ_MODEL_ENABLED", False)
+    read_model.configure(
+        app,
+        app.config.get("READ_MODEL_SNAPSHOT") or os.path.join(tempfile.gettempdir(), "catalog.snapshot"),
+        float(app.config.get("READ_MODEL_REFRESH_INTERVAL", 1.0)),
+        int(app.config.get("READ_MODEL_MAX_OVERLAY", 10000)),
+    )
+    if read_model.enabled:
+        # at startup, so that preloaded workers share the mapped pages
+        with app.app_context():
+            read_model.ready()
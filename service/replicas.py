@@ -0,0 +1,176 @@
+"""
+Read replica routing. GET and HEAD requests read from a replica listed in
+DATABASE_REPLICA_URIS when one is healthy and close enough to the primary;
+every other request, and every write, goes to the primary.
+
+Lag is measured in replication positions: WAL bytes on PostgreSQL (the
+primary's current WAL location against each replica's last replayed one) and
+the product_revision counter on SQLite. After a write, the client's session
+cookie remembers the primary's position and its later reads only go to
+replicas that have replayed up to it.
+"""
+import time
+import logging
+import itertools
+import threading
+from flask import g, request, session, has_request_context
+from flask_sqlalchemy import get_state
+from sqlalchemy import event, BigInteger, cast, func, literal_column, select
+
+logger = logging.getLogger("flask.app")
+
+SAFE_METHODS = ("GET", "HEAD")
+STICKY_KEY = "min_position"
+
+
+class Replica:
+    def __init__(self, bind):
+        self.bind = bind
+        self.healthy = False
+        self.position = 0
+        self.error = None
+
+
+class ReplicaRouter:
+    """Tracks replica health and lag, and picks the replica a request reads from"""
+
+    def __init__(self):
+        self.app = None
+        self.replicas = {}
+        self.max_lag = 1000
+        self.check_interval = 5.0
+        self.primary_position = 0
+        self.checked_at = None
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def configure(self, app, binds):
+        with self._lock:
+            self.app = app
+            self.replicas = {bind: Replica(bind) for bind in binds}
+            self.checked_at = None
+
+    def engine(self, bind=None):
+        return get_state(self.app).db.get_engine(self.app, bind=bind)
+
+    def refresh(self, force=False):
+        """Re-reads every replica's position, at most once per check_interval"""
+        now = time.monotonic()
+        if not force and self.checked_at is not None and now - self.checked_at < self.check_interval:
+            return
+        # one thread checks while the others keep routing on the last results
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self.checked_at = now
+            try:
+                self.primary_position = self.position_of(None)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning("Primary position check failed: %s", error)
+            for replica in self.replicas.values():
+                try:
+                    replica.position = self.position_of(replica.bind)
+                except Exception as error:  # pylint: disable=broad-except
+                    self.mark_down(replica.bind, error)
+                else:
+                    if not replica.healthy:
+                        logger.info("Replica %s is up at position %d", replica.bind, replica.position)
+                    replica.healthy, replica.error = True, None
+        finally:
+            self._lock.release()
+
+    def position_of(self, bind):
+        with self.engine(bind).connect() as connection:
+            return connection.execute(position_query(connection.dialect.name, bind is None)).scalar() or 0
+
+    def mark_down(self, bind, error):
+        replica = self.replicas.get(bind)
+        if replica is None:
+            return
+        if replica.healthy or replica.error is None:
+            logger.warning("Replica %s is down: %s", bind, error)
+        replica.healthy, replica.error = False, str(error)
+
+    def choose(self, min_position=0):
+        """Returns the bind of a usable replica, or None to read from the primary"""
+        if not self.replicas:
+            return None
+        self.refresh()
+        floor = max(min_position, self.primary_position - self.max_lag)
+        usable = [
+            replica.bind for replica in self.replicas.values()
+            if replica.healthy and replica.position >= floor
+        ]
+        if not usable:
+            return None
+        return usable[next(self._turn) % len(usable)]
+
+    def snapshot(self):
+        return {
+            "primary_position": self.primary_position,
+            "max_lag": self.max_lag,
+            "replicas": [
+                {
+                    "bind": replica.bind,
+                    "healthy": replica.healthy,
+                    "position": replica.position,
+                    "lag": max(self.primary_position - replica.position, 0),
+                    "error": replica.error,
+                }
+                for replica in self.replicas.values()
+            ],
+        }
+
+    def before_request(self):
+        if self.replicas and request.method in SAFE_METHODS:
+            g.read_bind = self.choose(session.get(STICKY_KEY, 0))
+
+    def after_request(self, response):
+        if self.replicas and request.method not in SAFE_METHODS and response.status_code < 400:
+            # read your writes: the write has committed, so the primary's
+            # position now covers it and later reads wait for a replica there
+            try:
+                session[STICKY_KEY] = self.position_of(None)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning("Could not pin client to position: %s", error)
+        return response
+
+
+replica_router = ReplicaRouter()
+
+
+def position_query(dialect, primary):
+    """A SELECT of how far a database is along the primary's history"""
+    if dialect == "postgresql":
+        # a replica's last replayed WAL location includes every transaction
+        # that committed before it, which a txid horizon does not promise
+        location = func.pg_current_wal_lsn() if primary else func.pg_last_wal_replay_lsn()
+        return select(cast(func.pg_wal_lsn_diff(location, literal_column("'0/0'")), BigInteger))
+    from .models import revision_horizon  # pylint: disable=import-outside-toplevel
+    return revision_horizon(dialect)
+
+
+def read_bind():
+    """The replica the current request reads from, or None for the primary"""
+    return g.get("read_bind") if has_request_context() else None
+
+
+def on_replica_error(bind):
+    def handle_error(context):
+        if context.is_disconnect:
+            replica_router.mark_down(bind, context.original_exception)
+    return handle_error
+
+
+def init_replicas(app):
+    uris = app.config.get("DATABASE_REPLICA_URIS") or []
+    binds = {f"replica_{index}": uri for index, uri in enumerate(uris)}
+    app.config["SQLALCHEMY_BINDS"] = dict(app.config.get("SQLALCHEMY_BINDS") or {}, **binds)
+    replica_router.max_lag = int(app.config.get("REPLICA_MAX_LAG", 1000))
+    replica_router.check_interval = float(app.config.get("REPLICA_CHECK_INTERVAL", 5))
+    replica_router.configure(app, binds)
+    for bind in binds:
+        event.listen(replica_router.engine(bind), "handle_error", on_replica_error(bind))
+    app.before_request(replica_router.before_request)
+    app.after_request(replica_router.after_request)
+    logger.info("Reading from %d replica(s)", len(binds))
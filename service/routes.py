@@ -1,15 +1,74 @@
+import time
+import shutil
 import logging
-from flask import jsonify, request, url_for, make_response, abort
-from . import app, db
-from .models import Product, Category, DataValidationError
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from werkzeug.http import is_resource_modified
+from flask import (
+    Blueprint, current_app as app, jsonify, request, url_for, make_response, abort,
+    Response, stream_with_context,
+)
+from . import db
+from .models import Product, DataValidationError, ConcurrentUpdateError, FIELDS
+from .cache import product_cache
+from .database import pool_stats
+from .replicas import replica_router, read_bind
+from .readmodel import read_model
+from .singleflight import request_flights
+from .profiling import query_profiler
+from .jobs import Job, job_queue, FINISHED
 from . import status  # HTTP Status Codes
+from . import bulk, encoding, metrics, query_args
+
+blueprint = Blueprint("products", __name__)
+
+STREAM_FORMATS = {"ndjson": "application/x-ndjson", "json": "application/json"}
+# list queries the in-memory read model can answer on its own
+READ_MODEL_ARGS = {"category", "available", "fields"}
+# revision -> when this worker first saw it, the Last-Modified of lists at that revision
+revision_times = OrderedDict()
+revision_times_lock = threading.Lock()
+MAX_REVISION_TIMES = 100
 
 # Health check endpoint
-@app.route("/healthcheck")
+@blueprint.route("/healthcheck")
 def healthcheck():
     return jsonify(status="OK"), status.HTTP_200_OK
 
-@app.route("/")
+# Connection pool statistics, for sizing workers against the DB
+@blueprint.route("/stats/pool")
+def pool_statistics():
+    return jsonify(pool_stats.snapshot(db.engine.pool)), status.HTTP_200_OK
+
+# Replica health and lag, as last checked by this worker
+@blueprint.route("/stats/replicas")
+def replica_statistics():
+    return jsonify(replica_router.snapshot()), status.HTTP_200_OK
+
+# Statement timings, slow queries and N+1 suspects seen by this worker; the
+# slow queries' bound values only for callers sending X-Profile: <PROFILE_TOKEN>
+@blueprint.route("/stats/queries")
+def query_statistics():
+    snapshot = query_profiler.snapshot(parameters=query_profiler.authorized())
+    return jsonify(snapshot), status.HTTP_200_OK
+
+# A request profile, by the X-Profile-Id it was returned with
+@blueprint.route("/stats/profiles/<profile_id>")
+def get_profile(profile_id):
+    report = query_profiler.load(profile_id)
+    if report is None:
+        abort(status.HTTP_404_NOT_FOUND, f"Profile {profile_id} was not found.")
+    return Response(report, status.HTTP_200_OK, mimetype="text/plain")
+
+# Prometheus metrics, aggregated across workers
+@blueprint.route("/metrics")
+def export_metrics():
+    body, content_type = metrics.export()
+    return Response(body, status.HTTP_200_OK, mimetype=None, content_type=content_type)
+
+@blueprint.route("/")
 def index():
     return app.send_static_file("index.html")
 
@@ -20,7 +79,7 @@ def index():
 # ---------------------------------------------------------------------
 # CREATE A NEW PRODUCT
 # ---------------------------------------------------------------------
-@app.route("/products", methods=["POST"])
+@blueprint.route("/products", methods=["POST"])
 def create_products():
     app.logger.info("Request to create a product")
     check_content_type("application/json")
@@ -28,76 +87,528 @@ def create_products():
     product.deserialize(request.get_json())
     product.create()
     message = product.serialize()
-    location_url = url_for("get_products", product_id=product.id, _external=True)
-    return make_response(
+    location_url = url_for(".get_products", product_id=product.id, _external=True)
+    response = make_response(
         jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
     )
+    response.set_etag(product_cache.etag(product))
+    return response
+
+# ---------------------------------------------------------------------
+# BATCH CREATE / UPDATE / DELETE PRODUCTS
+# ---------------------------------------------------------------------
+@blueprint.route("/products/batch", methods=["POST"])
+def create_products_batch():
+    app.logger.info("Request to create a batch of products")
+    items = get_batch_items()
+    results = [None] * len(items)
+    valid = []
+    for index, data in enumerate(items):
+        try:
+            valid.append((index, Product().deserialize(data)))
+        except DataValidationError as error:
+            results[index] = batch_error(index, status.HTTP_400_BAD_REQUEST, error)
+    Product.create_batch([product for _, product in valid])
+    for index, product in valid:
+        results[index] = batch_result(index, status.HTTP_201_CREATED, product)
+    app.logger.info("Created %d of %d products", len(valid), len(items))
+    return jsonify(results), status.HTTP_200_OK
+
+@blueprint.route("/products/batch", methods=["PUT"])
+def update_products_batch():
+    app.logger.info("Request to update a batch of products")
+    items = get_batch_items()
+    results = [None] * len(items)
+    valid = []
+    for index, data in enumerate(items):
+        try:
+            product = Product().deserialize(data)
+            product.id = get_batch_id(data)
+            valid.append((index, product))
+        except DataValidationError as error:
+            results[index] = batch_error(index, status.HTTP_400_BAD_REQUEST, error)
+    updated = Product.update_batch([product for _, product in valid])
+    for index, product in valid:
+        if product.id in updated:
+            results[index] = batch_result(index, status.HTTP_200_OK, product)
+        else:
+            results[index] = batch_error(
+                index, status.HTTP_404_NOT_FOUND,
+                f"Product with id '{product.id}' was not found.",
+            )
+    app.logger.info("Updated %d of %d products", len(updated), len(items))
+    return jsonify(results), status.HTTP_200_OK
+
+@blueprint.route("/products/batch", methods=["DELETE"])
+def delete_products_batch():
+    app.logger.info("Request to delete a batch of products")
+    items = get_batch_items()
+    results = [None] * len(items)
+    valid = []
+    for index, data in enumerate(items):
+        try:
+            valid.append((index, get_batch_id(data)))
+        except DataValidationError as error:
+            results[index] = batch_error(index, status.HTTP_400_BAD_REQUEST, error)
+    Product.delete_batch({product_id for _, product_id in valid})
+    for index, product_id in valid:
+        results[index] = {
+            "index": index, "status": status.HTTP_204_NO_CONTENT, "id": product_id
+        }
+    app.logger.info("Batch delete of %d products complete", len(valid))
+    return jsonify(results), status.HTTP_200_OK
 
 # ---------------------------------------------------------------------
 # RETRIEVE A PRODUCT (This is Task 4a)
 # ---------------------------------------------------------------------
-@app.route("/products/<int:product_id>", methods=["GET"])
+@blueprint.route("/products/<int:product_id>", methods=["GET"])
 def get_products(product_id):
     app.logger.info("Request for product with id: %s", product_id)
-    product = Product.find(product_id)
-    if not product:
-        abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
-    app.logger.info("Returning product: %s", product.name)
-    return jsonify(product.serialize()), status.HTTP_200_OK
+    fields = get_fields()
+    generation = product_cache.generation()
+    row = read_model.get(product_id)
+    if row is not None:
+        entry = {"etag": product_cache.etag(row), "data": row.serialize()}
+    else:
+        entry = product_cache.get_product(product_id)
+    if entry is None:
+        product = Product.find(product_id, fields)
+        if not product:
+            abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+        if fields is None:
+            entry = product_cache.put_product(product, generation)
+        else:
+            entry = {"etag": product_cache.etag(product), "data": product.serialize(fields)}
+    if fields is not None:
+        # a partial representation needs an ETag of its own
+        entry = {
+            "etag": f"{entry['etag']};{','.join(fields)}",
+            "data": {field: entry["data"][field] for field in fields},
+        }
+    # compressed responses carry a weak ETag, so compare weakly
+    if request.if_none_match.contains_weak(entry["etag"]):
+        app.logger.info("Product with id [%s] not modified", product_id)
+        response = make_response("", status.HTTP_304_NOT_MODIFIED)
+    else:
+        app.logger.info("Returning product with id [%s]", product_id)
+        response = make_response(jsonify(entry["data"]), status.HTTP_200_OK)
+    response.set_etag(entry["etag"])
+    return response
 
 # ---------------------------------------------------------------------
 # UPDATE AN EXISTING PRODUCT (This is Task 4b)
 # ---------------------------------------------------------------------
-@app.route("/products/<int:product_id>", methods=["PUT"])
+@blueprint.route("/products/<int:product_id>", methods=["PUT"])
 def update_products(product_id):
     app.logger.info("Request to update product with id: %s", product_id)
     check_content_type("application/json")
     product = Product.find(product_id)
     if not product:
         abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+    check_if_match(product)
     product.deserialize(request.get_json())
     product.id = product_id
-    product.update()
+    try:
+        product.update()
+    except ConcurrentUpdateError as error:
+        abort(conflict_status(), str(error))
     app.logger.info("Product with ID [%s] updated.", product.id)
-    return jsonify(product.serialize()), status.HTTP_200_OK
+    response = make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    response.set_etag(product_cache.etag(product))
+    return response
+
+# ---------------------------------------------------------------------
+# PARTIALLY UPDATE A PRODUCT
+# ---------------------------------------------------------------------
+@blueprint.route("/products/<int:product_id>", methods=["PATCH"])
+def patch_products(product_id):
+    app.logger.info("Request to patch product with id: %s", product_id)
+    check_content_type("application/json")
+    version = if_match_version(product_id)
+    try:
+        changes = Product.validate_changes(request.get_json())
+        product = Product.patch(product_id, changes, version)
+    except DataValidationError as error:
+        abort(status.HTTP_400_BAD_REQUEST, str(error))
+    except ConcurrentUpdateError as error:
+        abort(status.HTTP_412_PRECONDITION_FAILED, str(error))
+    if not product:
+        code = status.HTTP_412_PRECONDITION_FAILED if request.if_match else status.HTTP_404_NOT_FOUND
+        abort(code, f"Product with id '{product_id}' was not found.")
+    app.logger.info("Product with ID [%s] patched.", product_id)
+    response = make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    response.set_etag(product_cache.etag(product))
+    return response
 
 # ---------------------------------------------------------------------
 # DELETE A PRODUCT (This is Task 4c)
 # ---------------------------------------------------------------------
-@app.route("/products/<int:product_id>", methods=["DELETE"])
+@blueprint.route("/products/<int:product_id>", methods=["DELETE"])
 def delete_products(product_id):
     app.logger.info("Request to delete product with id: %s", product_id)
     product = Product.find(product_id)
     if product:
-        product.delete()
+        check_if_match(product)
+        try:
+            product.delete()
+        except ConcurrentUpdateError as error:
+            abort(conflict_status(), str(error))
+    elif request.if_match:
+        abort(status.HTTP_412_PRECONDITION_FAILED, f"Product with id '{product_id}' was not found.")
     app.logger.info("Product with ID [%s] delete complete.", product_id)
     return "", status.HTTP_204_NO_CONTENT
 
 # ---------------------------------------------------------------------
 # LIST ALL / QUERY PRODUCTS (This is Task 4d)
 # ---------------------------------------------------------------------
-@app.route("/products", methods=["GET"])
+@blueprint.route("/products", methods=["GET"])
 def list_products():
     app.logger.info("Request for product list")
-    products = []
-    name = request.args.get("name")
-    category = request.args.get("category")
-    available = request.args.get("available")
-    
-    if name:
-        products = Product.find_by_name(name)
-    elif category:
-        category_value = getattr(Category, category.upper())
-        products = Product.find_by_category(category_value)
-    elif available:
-        available_value = available.lower() in ["true", "yes", "1"]
-        products = Product.find_by_availability(available_value)
+    # validators come from the table-level revision, so polling clients get
+    # their 304 without the list query running at all
+    revision = None
+    if read_model.enabled and set(request.args) <= READ_MODEL_ARGS and read_model.ready():
+        # the read model answers as of its own revision, which may trail the table's
+        revision = read_model.revision
+    etag, last_modified = list_validators(revision=revision)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        app.logger.info("Product list not modified")
+        response = make_response("", status.HTTP_304_NOT_MODIFIED)
+    elif request.args.get("stream"):
+        response = query_products()
     else:
-        products = Product.all()
+        response = coalesced(("list", tuple(sorted(request.args.items(multi=True)))), query_products)
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    return response
+
+
+def query_products():
+    stream = request.args.get("stream")
+    # taken before any query runs; see ProductCache.put_list
+    generation = product_cache.generation()
+    if read_model.enabled and set(request.args) <= READ_MODEL_ARGS:
+        rows = read_model.find(**{
+            key: value for key, value in parse_filters(request.args).items()
+            if key in READ_MODEL_ARGS
+        })
+        if rows is not None:
+            fields = get_fields() or FIELDS
+            results = [row.serialize(fields) for row in rows]
+            app.logger.info("Returning %d products from the read model", len(results))
+            return json_response(results)
+    if not stream:
+        cached = product_cache.get_list(request.args)
+        if cached is not None:
+            app.logger.info("Returning %d cached products", len(cached["data"]))
+            return json_response(cached["data"], headers=cached["headers"])
+
+    products = find_products(request.args)
+    fields = get_fields() or FIELDS
+    if request.args.get("q"):
+        return search_products(products, request.args.get("q"), generation, fields)
+    sort = request.args.get("sort", "id")
+    column, _ = get_sort_column(sort)
+    if stream:
+        return stream_products(products, stream, sort, fields)
+
+    limit = request.args.get("limit")
+    cursor = request.args.get("cursor")
+    if limit is None and cursor is None:
+        rows = Product.rows(Product.paginate(products, sort=sort), fields)
+        results = [Product.serialize_row(row, fields) for row in rows]
+        product_cache.put_list(request.args, generation, results)
+        app.logger.info("Returning %d products", len(results))
+        return json_response(results)
+
+    limit = parse_limit(limit)
+    after = decode_cursor(cursor, sort) if cursor else None
+    # the cursor needs id and the sort key even when they were not requested
+    selected = tuple(f for f in FIELDS if f in fields or f in ("id", column.key))
+    # fetch one extra row to learn whether a next page exists
+    page = Product.rows(Product.paginate(products, after, limit + 1, sort), selected).all()
+    results = [Product.serialize_row(row, selected) for row in page[:limit]]
+    headers = {}
+    if len(page) > limit:
+        next_cursor = query_args.encode_cursor(results[-1], sort)
+        headers.update(next_page_headers(next_cursor, limit))
+    if selected != fields:
+        results = [{field: data[field] for field in fields} for data in results]
+    product_cache.put_list(request.args, generation, results, headers)
+    app.logger.info("Returning page of %d products", len(results))
+    return json_response(results, headers=headers)
+
+
+def search_products(products, text, generation, fields=FIELDS):
+    # ranked results are always paged; the cursor carries the next offset
+    limit = parse_limit(request.args.get("limit"))
+    cursor = request.args.get("cursor")
+    try:
+        offset = query_args.decode_offset_cursor(cursor) if cursor else 0
+        ranked = Product.search(text, products)
+    except DataValidationError as error:
+        abort(status.HTTP_400_BAD_REQUEST, str(error))
+    page = Product.rows(ranked.offset(offset).limit(limit + 1), fields).all()
+    results = [Product.serialize_row(row, fields) for row in page[:limit]]
+    headers = {}
+    if len(page) > limit:
+        next_cursor = query_args.encode_offset_cursor(offset + limit)
+        headers.update(next_page_headers(next_cursor, limit))
+    product_cache.put_list(request.args, generation, results, headers)
+    app.logger.info("Returning %d search results for %s", len(results), text)
+    return json_response(results, headers=headers)
+
+
+def stream_products(products, stream, sort="id", fields=FIELDS):
+    if stream not in STREAM_FORMATS:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"stream must be one of: {', '.join(sorted(STREAM_FORMATS))}",
+        )
+    batch_size = app.config.get("STREAM_BATCH_SIZE", 1000)
+    rows = Product.stream(Product.rows(products, fields), batch_size, sort)
+
+    def generate_ndjson():
+        for row in rows:
+            yield encoding.dumps(Product.serialize_row(row, fields)) + b"\n"
+
+    def generate_json():
+        yield b"["
+        separator = b""
+        for row in rows:
+            yield separator + encoding.dumps(Product.serialize_row(row, fields))
+            separator = b","
+        yield b"]"
+
+    generate = generate_ndjson if stream == "ndjson" else generate_json
+    app.logger.info("Streaming products as %s", stream)
+    return Response(
+        stream_with_context(generate()),
+        status=status.HTTP_200_OK,
+        mimetype=STREAM_FORMATS[stream],
+    )
+
+# ---------------------------------------------------------------------
+# BULK IMPORT / EXPORT
+# ---------------------------------------------------------------------
+@blueprint.route("/products/import", methods=["POST"])
+def import_products():
+    app.logger.info("Request to import products")
+    fmt = bulk.IMPORT_FORMATS.get(request.mimetype)
+    if fmt is None:
+        app.logger.error("Invalid Content-Type: %s", request.content_type)
+        abort(
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            "Content-Type must be one of " + ", ".join(bulk.IMPORT_FORMATS),
+        )
+    # the body is spooled to disk, never held in memory, and read twice:
+    # once to check it, once to insert it
+    with tempfile.TemporaryFile() as upload:
+        shutil.copyfileobj(request.stream, upload, 64 * 1024)
+        upload.seek(0)
+        try:
+            summary = bulk.import_products(upload, fmt, app.config.get("IMPORT_CHUNK_SIZE", 1000))
+        except DataValidationError as error:
+            app.logger.error("Rejected import: %s", error)
+            abort(status.HTTP_400_BAD_REQUEST, str(error))
+    return jsonify(summary), status.HTTP_200_OK
+
+
+@blueprint.route("/products/export", methods=["GET"])
+def export_products():
+    app.logger.info("Request to export products")
+    fmt = request.args.get("format", "csv")
+    if fmt not in bulk.EXPORT_FORMATS:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"format must be one of: {', '.join(sorted(bulk.EXPORT_FORMATS))}",
+        )
+    products = find_products(request.args)
+    rows = Product.stream(Product.rows(products), app.config.get("STREAM_BATCH_SIZE", 1000))
+    response = Response(
+        stream_with_context(bulk.export_products(rows, fmt)),
+        status=status.HTTP_200_OK,
+        mimetype=bulk.EXPORT_FORMATS[fmt],
+    )
+    response.headers["Content-Disposition"] = f"attachment; filename=products.{fmt}"
+    return response
+
+# ---------------------------------------------------------------------
+# BACKGROUND JOBS
+# ---------------------------------------------------------------------
+@blueprint.route("/jobs/import", methods=["POST"])
+def create_import_job():
+    app.logger.info("Request to queue a product import")
+    fmt = bulk.IMPORT_FORMATS.get(request.mimetype)
+    if fmt is None:
+        app.logger.error("Invalid Content-Type: %s", request.content_type)
+        abort(
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            "Content-Type must be one of " + ", ".join(bulk.IMPORT_FORMATS),
+        )
+    path = job_queue.spool(request.stream, suffix=f".{fmt}")
+    return job_accepted(Job.submit("import", path=path, format=fmt))
 
-    results = [product.serialize() for product in products]
-    app.logger.info("Returning %d products", len(results))
-    return jsonify(results), status.HTTP_200_OK
+
+@blueprint.route("/jobs/price-change", methods=["POST"])
+def create_price_change_job():
+    app.logger.info("Request to queue a bulk price change")
+    check_content_type("application/json")
+    data = request.get_json()
+    if not isinstance(data, dict):
+        abort(status.HTTP_400_BAD_REQUEST, "Request body must be a JSON object")
+    percent = data.get("percent")
+    if isinstance(percent, bool) or not isinstance(percent, (int, float)) or percent <= -100:
+        abort(status.HTTP_400_BAD_REQUEST, "percent must be a number greater than -100")
+    filters = data.get("filters") or {}
+    if not isinstance(filters, dict):
+        abort(status.HTTP_400_BAD_REQUEST, "filters must be a JSON object")
+    filters = {key: str(value) for key, value in filters.items()}
+    find_products(filters)  # validated now, applied by the job
+    return job_accepted(Job.submit("price_change", percent=percent, filters=filters))
+
+
+@blueprint.route("/jobs", methods=["GET"])
+def list_jobs():
+    app.logger.info("Request for job list")
+    limit = parse_limit(request.args.get("limit"))
+    return jsonify([job.serialize() for job in Job.recent(limit)]), status.HTTP_200_OK
+
+
+@blueprint.route("/jobs/<job_id>", methods=["GET"])
+def get_jobs(job_id):
+    app.logger.info("Request for job with id: %s", job_id)
+    job = Job.query.get(job_id)
+    if not job:
+        abort(status.HTTP_404_NOT_FOUND, f"Job with id '{job_id}' was not found.")
+    return jsonify(job.serialize()), status.HTTP_200_OK
+
+
+@blueprint.route("/jobs/<job_id>", methods=["DELETE"])
+def cancel_jobs(job_id):
+    app.logger.info("Request to cancel job with id: %s", job_id)
+    job = Job.query.get(job_id)
+    if not job:
+        abort(status.HTTP_404_NOT_FOUND, f"Job with id '{job_id}' was not found.")
+    if job.status in FINISHED:
+        abort(status.HTTP_409_CONFLICT, f"Job with id '{job_id}' is already {job.status}.")
+    job = Job.cancel(job_id)
+    return jsonify(job.serialize()), status.HTTP_202_ACCEPTED
+
+
+def job_accepted(job):
+    location_url = url_for(".get_jobs", job_id=job.id, _external=True)
+    app.logger.info("Job %s accepted", job.id)
+    return jsonify(job.serialize()), status.HTTP_202_ACCEPTED, {"Location": location_url}
+
+# ---------------------------------------------------------------------
+# CATALOG STATS
+# ---------------------------------------------------------------------
+@blueprint.route("/products/stats", methods=["GET"])
+def product_stats():
+    app.logger.info("Request for product stats")
+    etag, last_modified = list_validators("stats")
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response("", status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = coalesced(("stats",), query_stats)
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    return response
+
+
+def query_stats():
+    # one GROUP BY over the covering index, recomputed only after a write
+    generation = product_cache.generation()
+    stats = product_cache.get_stats()
+    if stats is None:
+        stats = summarize_stats(Product.stats())
+        product_cache.put_stats(generation, stats)
+    return json_response(stats)
+
+def summarize_stats(groups):
+    categories = {}
+    for group in groups:
+        category = categories.setdefault(
+            group.category.name,
+            {"count": 0, "available": 0, "min_price": None, "max_price": None, "total": 0, "groups": []},
+        )
+        category["count"] += group.count
+        category["total"] += group.total_price
+        if group.available:
+            category["available"] += group.count
+        if category["min_price"] is None or group.min_price < category["min_price"]:
+            category["min_price"] = group.min_price
+        if category["max_price"] is None or group.max_price > category["max_price"]:
+            category["max_price"] = group.max_price
+        category["groups"].append(
+            price_stats(group.count, group.min_price, group.max_price, group.total_price,
+                        available=group.available)
+        )
+    results = {}
+    for name, category in categories.items():
+        results[name] = price_stats(
+            category["count"], category["min_price"], category["max_price"], category["total"],
+            available=category["available"],
+            availability_ratio=round(category["available"] / category["count"], 4),
+            groups=category["groups"],
+        )
+    return {"total": sum(c["count"] for c in categories.values()), "categories": results}
+
+
+def price_stats(count, min_price, max_price, total, **extra):
+    return dict(
+        extra,
+        count=count,
+        min_price=f"{min_price:.2f}",
+        avg_price=f"{total / count:.2f}",
+        max_price=f"{max_price:.2f}",
+    )
+
+# ---------------------------------------------------------------------
+# CHANGE FEED
+# ---------------------------------------------------------------------
+@blueprint.route("/products/changes", methods=["GET"])
+def list_changes():
+    app.logger.info("Request for product changes")
+    try:
+        since = request.args.get("since")
+        since, since_id = query_args.decode_revision_token(since) if since else (0, None)
+        limit = query_args.parse_limit(
+            request.args.get("limit"),
+            app.config.get("CHANGES_PAGE_SIZE", 100),
+            app.config.get("MAX_PAGE_SIZE", 1000),
+        )
+        wait = query_args.parse_wait(
+            request.args.get("wait"), app.config.get("CHANGES_MAX_WAIT", 25)
+        )
+    except DataValidationError as error:
+        abort(status.HTTP_400_BAD_REQUEST, str(error))
+
+    changes = Product.changes(since, limit + 1, since_id)
+    deadline = time.monotonic() + wait
+    while not changes and time.monotonic() < deadline:
+        # end the transaction so the pooled connection is free while we sleep
+        db.session.rollback()
+        time.sleep(app.config.get("CHANGES_POLL_INTERVAL", 0.5))
+        if Product.latest_revision() > since:
+            changes = Product.changes(since, limit + 1, since_id)
+
+    more = len(changes) > limit
+    changes = changes[:limit]
+    if changes:
+        next_token = query_args.encode_revision_token(changes[-1].revision, changes[-1].id)
+    else:
+        next_token = query_args.encode_revision_token(since, since_id)
+    headers = {}
+    if more:
+        next_url = url_for(".list_changes", _external=True, since=next_token, limit=limit)
+        headers["Link"] = f'<{next_url}>; rel="next"'
+    app.logger.info("Returning %d changes", len(changes))
+    return json_response(
+        {"changes": [change.to_change() for change in changes], "next": next_token, "more": more},
+        headers=headers,
+    )
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
@@ -117,3 +628,131 @@ def check_content_type(media_type):
         return
     app.logger.error("Invalid Content-Type: %s", content_type)
     abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, f"Content-Type must be {media_type}")
+
+def check_if_match(product):
+    # the version ETag names the product state rather than the bytes sent, so
+    # a weak tag echoed back from a compressed response is still accepted
+    if request.if_match and not request.if_match.contains_weak(product_cache.etag(product)):
+        app.logger.info("Product with id [%s] failed If-Match", product.id)
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"Product with id '{product.id}' has changed, fetch it again and retry",
+        )
+
+def if_match_version(product_id):
+    # PATCH never loads the row, so the If-Match version goes into the UPDATE
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    for tag in request.if_match.as_set(include_weak=True):
+        tag_id, _, version = tag.partition("-")
+        if tag_id == str(product_id) and version.isdigit():
+            return int(version)
+    abort(status.HTTP_412_PRECONDITION_FAILED, f"Product with id '{product_id}' has changed")
+
+def conflict_status():
+    # a conditional request lost the race; otherwise it was a plain conflict
+    if request.if_match:
+        return status.HTTP_412_PRECONDITION_FAILED
+    return status.HTTP_409_CONFLICT
+
+def find_products(args):
+    return Product.find_by_filters(**parse_filters(args))
+
+def parse_filters(args):
+    try:
+        return query_args.parse_filters(args)
+    except DataValidationError as error:
+        abort(status.HTTP_400_BAD_REQUEST, str(error))
+
+def get_fields():
+    try:
+        return query_args.parse_fields(request.args.get("fields"))
+    except DataValidationError as error:
+        abort(status.HTTP_400_BAD_REQUEST, str(error))
+
+def get_sort_column(sort):
+    try:
+        return Product.sort_column(sort)
+    except DataValidationError as error:
+        abort(status.HTTP_400_BAD_REQUEST, str(error))
+
+def parse_limit(limit):
+    try:
+        return query_args.parse_limit(
+            limit,
+            app.config.get("DEFAULT_PAGE_SIZE", 100),
+            app.config.get("MAX_PAGE_SIZE", 1000),
+        )
+    except DataValidationError as error:
+        abort(status.HTTP_400_BAD_REQUEST, str(error))
+
+def decode_cursor(cursor, sort="id"):
+    try:
+        return query_args.decode_cursor(cursor, sort)
+    except DataValidationError as error:
+        abort(status.HTTP_400_BAD_REQUEST, str(error))
+
+def next_page_headers(next_cursor, limit):
+    args = request.args.to_dict()
+    args.update(limit=limit, cursor=next_cursor)
+    next_url = url_for(".list_products", _external=True, **args)
+    return {"Link": f'<{next_url}>; rel="next"', "X-Next-Cursor": next_cursor}
+
+def list_validators(name="products", revision=None):
+    """Weak ETag and Last-Modified of the catalog at revision, by default the latest"""
+    if revision is None:
+        # read from the database this request reads, so a lagging replica
+        # keeps its older tag until it catches up
+        revision = Product.latest_revision()
+    return f"{name}-r{revision}", revision_time(revision)
+
+def revision_time(revision):
+    """When this worker first saw revision: no later than any response built from it"""
+    with revision_times_lock:
+        moment = revision_times.get(revision)
+        if moment is None:
+            moment = revision_times[revision] = time.time()
+            while len(revision_times) > MAX_REVISION_TIMES:
+                revision_times.popitem(last=False)
+    return datetime.fromtimestamp(int(moment), timezone.utc)
+
+def coalesced(key, view):
+    """Runs view once for identical requests in flight; each gets its own copy of the response"""
+    # a write or a different database starts a new flight rather than join a stale one
+    key = (product_cache.generation(), read_bind()) + key
+    (body, code, headers), shared = request_flights.do(key, lambda: freeze_response(view()))
+    if shared:
+        metrics.COALESCED_REQUESTS.labels(metrics.endpoint_label()).inc()
+        app.logger.info("Sharing the response of an identical request in flight")
+    return Response(body, code, headers)
+
+def freeze_response(response):
+    return response.get_data(), response.status_code, list(response.headers)
+
+def json_response(data, code=status.HTTP_200_OK, headers=None):
+    return Response(encoding.dumps(data), code, headers, mimetype="application/json")
+
+def get_batch_items():
+    check_content_type("application/json")
+    items = request.get_json()
+    if not isinstance(items, list):
+        abort(status.HTTP_400_BAD_REQUEST, "Batch request body must be a JSON array")
+    max_size = app.config.get("MAX_BATCH_SIZE", 10000)
+    if len(items) > max_size:
+        abort(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            f"Batch requests are limited to {max_size} items",
+        )
+    return items
+
+def get_batch_id(data):
+    product_id = data.get("id") if isinstance(data, dict) else data
+    if not isinstance(product_id, int) or isinstance(product_id, bool):
+        raise DataValidationError("Invalid product: missing or bad id")
+    return product_id
+
+def batch_result(index, code, product):
+    return {"index": index, "status": code, "product": product.serialize()}
+
+def batch_error(index, code, error):
+    return {"index": index, "status": code, "error": str(error)}
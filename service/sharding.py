@@ -0,0 +1,262 @@
+"""
+Optional hash sharding of the product table. With DATABASE_SHARD_URIS set,
+product rows live on those databases, shard = id % len(shards); everything
+else (revisions, tombstones, jobs, the id sequence) stays on the primary.
+Sessions commit the shards before the primary, so a revision is only
+published once the product rows it covers are on their shards.
+
+Statements against the product table that name no shard are scattered to
+every shard by scatter_gather() and the partial results merged: rows are
+merge-sorted on the statement's ORDER BY and cut to its LIMIT/OFFSET, and
+count/sum/min/max aggregates are combined per GROUP BY key, so pages and
+stats come out as if there were one table. Streamed statements
+(stream_results) are merged lazily from the live shard cursors, so an export
+holds about one batch per shard in memory, never the whole table. Statements whose results cannot
+be merged that way (an ORDER BY on a value the rows do not carry, such as a
+search rank, or an aggregate like avg) raise ShardingError, answered with a
+400, rather than come back in the wrong order or with wrong values.
+"""
+import heapq
+import logging
+import operator
+import itertools
+import functools
+from enum import Enum
+from collections import OrderedDict
+from sqlalchemy.engine import IteratorResult
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import Label, UnaryExpression
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.sql.util import find_tables
+from flask import jsonify
+from flask_sqlalchemy import get_state
+
+logger = logging.getLogger("flask.app")
+
+PRODUCT_TABLE = "product"
+# how partial aggregates from each shard combine into the overall value
+AGGREGATES = {
+    "count": operator.add,
+    "sum": operator.add,
+    "min": min,
+    "max": max,
+}
+# aggregates whose per-shard values cannot be combined into the overall one
+UNMERGEABLE = {
+    "avg", "total", "group_concat", "string_agg", "array_agg", "json_agg",
+    "stddev", "stddev_pop", "stddev_samp", "variance", "var_pop", "var_samp",
+    "mode", "percentile_cont", "percentile_disc", "every", "bool_and", "bool_or",
+}
+
+
+class ShardingError(Exception):
+    """A statement whose per-shard results cannot be merged into one"""
+
+
+class ScatteredResult:
+    """The last shard's result of a statement run on every shard, with the summed rowcount"""
+
+    def __init__(self, results):
+        self._last = results[-1]
+        self.rowcount = sum(result.rowcount for result in results)
+
+    def __getattr__(self, name):
+        return getattr(self._last, name)
+
+
+class ShardSet:
+    def __init__(self):
+        self.app = None
+        self.binds = []
+
+    def configure(self, app, binds):
+        self.app = app
+        self.binds = list(binds)
+
+    def shard_for(self, product_id):
+        """The bind holding product_id, or None when sharding is off"""
+        if not self.binds or product_id is None:
+            return None
+        return self.binds[int(product_id) % len(self.binds)]
+
+    def group(self, items, key):
+        """Splits items by the shard of key(item), keeping their order"""
+        groups = OrderedDict()
+        for item in items:
+            groups.setdefault(self.shard_for(key(item)), []).append(item)
+        return groups.items()
+
+    def engine(self, bind):
+        return get_state(self.app).db.get_engine(self.app, bind=bind)
+
+    def engines(self):
+        return [self.engine(bind) for bind in self.binds]
+
+
+shard_set = ShardSet()
+
+
+def touches_products(statement):
+    return any(
+        table.name == PRODUCT_TABLE
+        for table in find_tables(statement, include_crud=True)
+    )
+
+
+def scatter_gather(orm_context):
+    """do_orm_execute hook: routes or scatters statements on the product table"""
+    if not shard_set.binds or "shard" in orm_context.bind_arguments:
+        return None
+    statement = orm_context.statement
+    if not touches_products(statement):
+        return None
+    shard = orm_context.execution_options.get("shard")
+    refresh_state = getattr(orm_context.load_options, "_refresh_state", None) if orm_context.is_select else None
+    if refresh_state is not None and refresh_state.identity:
+        # reloading an expired instance: it lives on its id's shard
+        shard = shard_set.shard_for(refresh_state.identity[0])
+    if shard:
+        return orm_context.invoke_statement(bind_arguments={"shard": shard})
+    if not orm_context.is_select:
+        return ScatteredResult([
+            orm_context.invoke_statement(bind_arguments={"shard": bind}) for bind in shard_set.binds
+        ])
+    for column in statement.selected_columns:
+        check_mergeable(column)
+    limit, offset = statement._limit, statement._offset  # pylint: disable=protected-access
+    if offset:
+        # every shard could hold rows of the page, so each returns all up to its end
+        statement = statement.offset(None)
+        if limit is not None:
+            statement = statement.limit(limit + offset)
+    aggregated = any(aggregate_name(column) for column in statement.selected_columns)
+    if orm_context.execution_options.get("stream_results") and not aggregated:
+        return merge_streams(orm_context, statement, limit, offset)
+    partials = [
+        orm_context.invoke_statement(statement, bind_arguments={"shard": bind}).freeze()
+        for bind in shard_set.binds
+    ]
+    keys = list(partials[0]().keys())
+    rows = [row for partial in partials for row in partial.rewrite_rows()]
+    if aggregated:
+        rows = combine_aggregates(statement, rows)
+    rows = sort_rows(statement, keys, rows)
+    end = None if limit is None else (offset or 0) + limit
+    return partials[0].with_new_rows(rows[offset or 0:end])()
+
+
+def merge_streams(orm_context, statement, limit, offset):
+    """Merge-sorts the shards' live results, reading each a batch at a time"""
+    results = [
+        orm_context.invoke_statement(statement, bind_arguments={"shard": bind})
+        for bind in shard_set.binds
+    ]
+    # each shard returns its rows in the statement's order already
+    rows = heapq.merge(*results, key=row_order(statement, list(results[0].keys())))
+    end = None if limit is None else (offset or 0) + limit
+    merged = IteratorResult(
+        results[0]._metadata, itertools.islice(rows, offset or 0, end)  # pylint: disable=protected-access
+    )
+    merged._attributes = results[0]._attributes  # pylint: disable=protected-access
+    return merged
+
+
+def aggregate_name(column):
+    element = column.element if isinstance(column, Label) else column
+    if isinstance(element, FunctionElement) and element.name in AGGREGATES:
+        return element.name
+    return None
+
+
+def check_mergeable(column):
+    """Raises ShardingError if column's per-shard values cannot be combined"""
+    element = column.element if isinstance(column, Label) else column
+    if not isinstance(element, FunctionElement):
+        return
+    distinct = any(
+        getattr(clause, "operator", None) is operators.distinct_op
+        for clause in element.clauses
+    )
+    if element.name in UNMERGEABLE or (element.name in AGGREGATES and distinct):
+        raise ShardingError(
+            f"{element.name}() cannot be combined across shards; only count, sum, min and max can"
+        )
+
+
+def combine_aggregates(statement, rows):
+    names = [aggregate_name(column) for column in statement.selected_columns]
+    groups = OrderedDict()
+    for row in rows:
+        group = tuple(value for name, value in zip(names, row) if name is None)
+        if group not in groups:
+            groups[group] = list(row)
+            continue
+        merged = groups[group]
+        for index, name in enumerate(names):
+            if name is None or row[index] is None:
+                continue
+            if merged[index] is None:
+                merged[index] = row[index]
+            else:
+                merged[index] = AGGREGATES[name](merged[index], row[index])
+    return list(groups.values())
+
+
+def sort_rows(statement, keys, rows):
+    rows.sort(key=row_order(statement, keys))
+    return rows
+
+
+def row_order(statement, keys):
+    """A sort key function putting rows in the statement's ORDER BY order"""
+    terms = []
+    for clause in statement._order_by_clauses:  # pylint: disable=protected-access
+        descending = isinstance(clause, UnaryExpression) and clause.modifier is operators.desc_op
+        if isinstance(clause, UnaryExpression) and clause.modifier in (operators.desc_op, operators.asc_op):
+            clause = clause.element
+        value = row_value(keys, clause)
+        if value is None:
+            raise ShardingError(f"Results ordered by {clause} cannot be merged across shards")
+        terms.append((value, descending))
+
+    def compare(left, right):
+        for value, descending in terms:
+            first, second = sort_key(value(left)), sort_key(value(right))
+            if first != second:
+                return (first < second) - (first > second) if descending else (first > second) - (first < second)
+        return 0
+
+    return functools.cmp_to_key(compare)
+
+
+def row_value(keys, column):
+    """A function reading column off a result row, or None if the row lacks it"""
+    name = getattr(column, "key", None) or getattr(column, "name", None)
+    if name in keys:
+        index = keys.index(name)
+        return lambda row: row[index]
+    table = getattr(column, "table", None)
+    if name and len(keys) == 1 and getattr(table, "name", None) == PRODUCT_TABLE:
+        # an entity row: read the attribute off the instance
+        return lambda row: getattr(row[0], name, None)
+    return None
+
+
+def sort_key(value):
+    # NULLs first, as SQLite does; enums are stored, and so sorted, by name
+    return (value is not None, value.name if isinstance(value, Enum) else value)
+
+
+def init_sharding(app):
+    uris = app.config.get("DATABASE_SHARD_URIS") or []
+    binds = {f"shard_{index}": uri for index, uri in enumerate(uris)}
+    app.config["SQLALCHEMY_BINDS"] = dict(app.config.get("SQLALCHEMY_BINDS") or {}, **binds)
+    shard_set.configure(app, binds)
+    app.register_error_handler(ShardingError, sharding_error)
+    if binds:
+        logger.info("Products sharded across %d databases", len(binds))
+
+
+def sharding_error(error):
+    logger.warning("Refused a query that cannot be answered across shards: %s", error)
+    return jsonify(status=400, error="Bad Request", message=str(error)), 400
@@ -0,0 +1,71 @@
+"""
+Single-flight: concurrent calls with the same key share one execution. The
+first caller runs the function; the rest wait for it and get its result (or
+its exception), so a burst of identical requests costs one query.
+"""
+import logging
+import threading
+
+logger = logging.getLogger("flask.app")
+
+
+class Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.enabled = True
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        """Returns (result, shared); shared is True for callers that did not run function"""
+        if not self.enabled:
+            return function(), False
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+            else:
+                call.waiters += 1
+        if not leader:
+            if not call.done.wait(self.timeout):
+                # a stuck leader must not hold everyone else hostage
+                return function(), False
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = function()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            # later callers start a new flight rather than reuse this result
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+# identical GET requests in flight in this worker
+request_flights = SingleFlight()
+
+
+def init_coalescing(app):
+    request_flights.enabled = app.config.get("COALESCE_ENABLED", True)
+    request_flights.timeout = app.config.get("COALESCE_TIMEOUT", 30)
+    logger.info("Request coalescing %s", "enabled" if request_flights.enabled else "disabled")
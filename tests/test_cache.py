@@ -0,0 +1,49 @@
+import time
+import unittest
+from werkzeug.datastructures import MultiDict
+from service.cache import LRUCache, ProductCache
+from .factories import ProductFactory
+
+class TestCache(unittest.TestCase):
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_lru_expires_entries(self):
+        cache = LRUCache(ttl=0.01)
+        cache.set("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+
+    def test_invalidate_product_and_lists(self):
+        cache = ProductCache(LRUCache())
+        product = ProductFactory(version=1)
+        entry = cache.put_product(product, cache.generation())
+        self.assertEqual(entry["etag"], f"{product.id}-1")
+        self.assertEqual(cache.get_product(product.id), entry)
+        args = MultiDict({"category": "FOOD"})
+        cache.put_list(args, cache.generation(), [product.serialize()])
+        self.assertIsNotNone(cache.get_list(args))
+        cache.invalidate([product.id])
+        self.assertIsNone(cache.get_product(product.id))
+        self.assertIsNone(cache.get_list(args))
+
+    def test_reads_that_race_a_write_are_not_cached(self):
+        cache = ProductCache(LRUCache())
+        product = ProductFactory(version=1)
+        args = MultiDict({"category": "FOOD"})
+        started = cache.generation()
+        cache.invalidate([product.id])  # a write commits while the reads run
+        cache.put_product(product, started)
+        cache.put_list(args, started, [product.serialize()])
+        cache.put_stats(started, {"total": 1})
+        self.assertIsNone(cache.get_product(product.id))
+        self.assertIsNone(cache.get_list(args))
+        self.assertIsNone(cache.get_stats())
@@ -0,0 +1,42 @@
+import os
+import logging
+import unittest
+from sqlalchemy import text
+from service import app, db, status
+from service.database import InstrumentedQueuePool, pool_stats
+from service.models import Product
+
+DATABASE_URI = os.getenv(
+    "DATABASE_URI", "sqlite:///" + os.path.join(app.config["BASE_DIR"], "test.db")
+)
+
+class TestDatabase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        app.config["TESTING"] = True
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        Product.init_db(app)
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_engine_uses_instrumented_pool(self):
+        self.assertIsInstance(db.engine.pool, InstrumentedQueuePool)
+
+    @unittest.skipUnless(DATABASE_URI.startswith("sqlite"), "SQLite only")
+    def test_sqlite_pragmas(self):
+        journal_mode = db.session.execute(text("PRAGMA journal_mode")).scalar()
+        self.assertEqual(journal_mode.upper(), app.config["SQLITE_JOURNAL_MODE"])
+        busy_timeout = db.session.execute(text("PRAGMA busy_timeout")).scalar()
+        self.assertEqual(busy_timeout, app.config["SQLITE_BUSY_TIMEOUT_MS"])
+
+    def test_pool_statistics(self):
+        before = pool_stats.snapshot()["checkouts"]
+        resp = app.test_client().get("/stats/pool")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["pool_size"], app.config["DB_POOL_SIZE"])
+        self.assertGreaterEqual(data["checkouts"], before)
+        self.assertIn("wait_seconds_max", data)
@@ -1,8 +1,11 @@
 import os
 import logging
 import unittest
+from decimal import Decimal
+from sqlalchemy import inspect
 from service import app, db
-from service.models import Product, Category, DataValidationError
+from service.models import Product, Category, DataValidationError, ConcurrentUpdateError
+from service.cache import product_cache
 from .factories import ProductFactory
 
 DATABASE_URI = os.getenv(
@@ -26,6 +29,7 @@ class TestProductModel(unittest.TestCase):
     def setUp(self):
         db.session.query(Product).delete()
         db.session.commit()
+        product_cache.clear()
 
     def tearDown(self):
         db.session.remove()
@@ -139,6 +143,142 @@ class TestProductModel(unittest.TestCase):
         self.assertIsNotNone(product)
         self.assertEqual(product.name, data["name"])
         self.assertEqual(product.description, data["description"])
-        self.assertEqual(product.price, float(data["price"]))
+        self.assertEqual(product.price, Decimal(data["price"]))
         self.assertEqual(product.available, data["available"])
         self.assertEqual(product.category.name, data["category"])
+
+    def test_create_update_delete_batch(self):
+        products = ProductFactory.create_batch(5)
+        Product.create_batch(products, chunk_size=2)
+        self.assertEqual(len(Product.all()), 5)
+        self.assertTrue(all(product.id for product in products))
+        for product in products:
+            product.description = "batched"
+        missing = ProductFactory(id=products[-1].id + 100)
+        updated = Product.update_batch(products + [missing], chunk_size=2)
+        self.assertEqual(updated, {product.id for product in products})
+        for product in Product.all():
+            self.assertEqual(product.description, "batched")
+        deleted = Product.delete_batch([products[0].id, missing.id])
+        self.assertEqual(deleted, {products[0].id})
+        self.assertEqual(len(Product.all()), 4)
+
+    def test_find_by_filters(self):
+        products = ProductFactory.create_batch(20)
+        Product.create_batch(products)
+        category = products[0].category
+        expected = [
+            p for p in products
+            if p.category == category and p.available and 20 <= p.price <= 80
+        ]
+        found = Product.find_by_filters(
+            category=category, available=True, price_min=20, price_max=80
+        )
+        self.assertEqual(found.count(), len(expected))
+
+    def test_paginate_sorted_by_price(self):
+        Product.create_batch(ProductFactory.create_batch(7))
+        first = Product.paginate(Product.query, limit=4, sort="-price").all()
+        last = first[-1]
+        rest = Product.paginate(
+            Product.query, after=(last.id, last.price), sort="-price"
+        ).all()
+        prices = [p.price for p in first + rest]
+        self.assertEqual(len(prices), 7)
+        self.assertEqual(prices, sorted(prices, reverse=True))
+
+    def test_sort_column_is_validated(self):
+        self.assertRaises(DataValidationError, Product.sort_column, "description")
+
+    def test_serialize_row_matches_serialize(self):
+        Product.create_batch(ProductFactory.create_batch(5))
+        expected = [product.serialize() for product in Product.paginate(Product.query)]
+        rows = Product.rows(Product.paginate(Product.query))
+        self.assertEqual([Product.serialize_row(row) for row in rows], expected)
+
+    def test_search(self):
+        products = ProductFactory.create_batch(3, description="plain")
+        products[0].name, products[0].description = "Toaster", "Stainless toaster oven"
+        products[1].name, products[1].description = "Kettle", "Electric kettle with toaster"
+        Product.create_batch(products)
+        found = Product.search("toaster").all()
+        self.assertEqual({p.id for p in found}, {products[0].id, products[1].id})
+        self.assertEqual(found[0].id, products[0].id)
+        self.assertEqual([p.id for p in Product.search("electric toast").all()], [products[1].id])
+        found[0].description = "plain"
+        found[0].name = "Oven"
+        found[0].update()
+        self.assertEqual([p.id for p in Product.search("toaster").all()], [products[1].id])
+        self.assertRaises(DataValidationError, Product.search, "!!")
+
+    def test_find_with_fields(self):
+        product = ProductFactory()
+        product.create()
+        product_id, name = product.id, product.name
+        db.session.expunge_all()
+        found = Product.find(product_id, ("name",))
+        self.assertIn("description", inspect(found).unloaded)
+        self.assertEqual(found.serialize(("name",)), {"name": name})
+
+    def test_changes_report_writes_and_deletes(self):
+        since = Product.latest_revision()
+        first, second = ProductFactory(), ProductFactory()
+        first.create()
+        second.create()
+        batch = Product.create_batch(ProductFactory.build_batch(2))
+        first.description = "changed"
+        first.update()
+        second_id = second.id
+        second.delete()
+        Product.delete_batch([batch[0].id])
+        changes = [change.to_change() for change in Product.changes(since)]
+        revisions = [change["revision"] for change in changes]
+        positions = [(change["revision"], change["id"]) for change in changes]
+        self.assertEqual(positions, sorted(set(positions)))
+        self.assertEqual(
+            [(change["id"], change["deleted"]) for change in changes],
+            [(batch[1].id, False), (first.id, False), (second_id, True), (batch[0].id, True)],
+        )
+        self.assertEqual(Product.latest_revision(), revisions[-1])
+        self.assertEqual(Product.changes(revisions[-1]), [])
+
+    def test_changes_page_within_a_revision(self):
+        products = Product.create_batch(ProductFactory.build_batch(3))
+        ids = sorted(product.id for product in products)
+        revision = Product.latest_revision()
+        # as on PostgreSQL, where every row a transaction writes shares its revision
+        Product.query.update({"revision": revision}, synchronize_session=False)
+        db.session.commit()
+        page = Product.changes(revision - 1, 2)
+        self.assertEqual([change.id for change in page], ids[:2])
+        self.assertEqual([change.id for change in Product.changes(revision, 2, page[-1].id)], ids[2:])
+        self.assertEqual(Product.changes(revision), [])
+
+    def test_concurrent_update_is_rejected(self):
+        product = ProductFactory()
+        product.create()
+        product_id = product.id
+        product.description = "changed"
+        product.update()
+        self.assertEqual(product.version, 2)
+        stale = Product.find(product_id)
+        # another worker writes the row behind this session's back
+        table = Product.__table__
+        with db.engine.begin() as connection:
+            connection.execute(
+                table.update().where(table.c.id == product_id).values(version=table.c.version + 1)
+            )
+        stale.name = "lost update"
+        self.assertRaises(ConcurrentUpdateError, stale.update)
+        self.assertNotEqual(Product.find(product_id).name, "lost update")
+
+    def test_patch_a_product(self):
+        product = ProductFactory(available=True)
+        product.create()
+        product_id, since = product.id, Product.latest_revision()
+        patched = Product.patch(product_id, Product.validate_changes({"available": False}))
+        self.assertEqual((patched.available, patched.version), (False, 2))
+        self.assertEqual([change.id for change in Product.changes(since)], [product_id])
+        self.assertRaises(ConcurrentUpdateError, Product.patch, product_id, {"name": "x"}, 1)
+        self.assertIsNone(Product.patch(0, {"name": "x"}))
+        self.assertRaises(DataValidationError, Product.validate_changes, {"price": -1})
@@ -0,0 +1,106 @@
+import os
+import logging
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from service import app, status
+from service.models import db, Product
+from service.ratelimit import rate_limiter
+from service.profiling import query_profiler, explain
+from .factories import ProductFactory
+
+DATABASE_URI = os.getenv(
+    "DATABASE_URI", "sqlite:///" + os.path.join(app.config["BASE_DIR"], "test.db")
+)
+BASE_URL = "/products"
+
+
+class TestProfiling(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        app.config["TESTING"] = True
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        rate_limiter.enabled = False  # covered by test_ratelimit
+
+    def setUp(self):
+        Product.init_db(app)
+        self.directory = tempfile.TemporaryDirectory()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        query_profiler.configure()
+        db.session.remove()
+        self.directory.cleanup()
+
+    def test_slow_queries_are_logged_with_their_plan(self):
+        product = ProductFactory()
+        product.create()
+        name = product.name
+        db.session.remove()
+        query_profiler.configure(enabled=True, slow_ms=0)
+        with app.app_context():
+            self.assertEqual(Product.find_by_name(name).count(), 1)
+        stats = query_profiler.snapshot(parameters=True)
+        slow = [entry for entry in stats["slow"] if "WHERE product.name" in entry["statement"]]
+        self.assertTrue(slow)
+        self.assertIn(repr(name), slow[0]["parameters"])
+        self.assertTrue(any("product" in line for line in slow[0]["plan"]))
+        self.assertTrue(any("WHERE product.name" in item["statement"] for item in stats["statements"]))
+        # one plan per statement per interval
+        with app.app_context():
+            Product.find_by_name(name).count()
+        self.assertIsNone(query_profiler.snapshot()["slow"][-1]["plan"])
+
+    def test_query_parameters_need_the_token(self):
+        query_profiler.configure(enabled=True, slow_ms=0, token="letmein")
+        with app.app_context():
+            Product.find_by_name("secret").count()
+        resp = self.client.get("/stats/queries")
+        self.assertTrue(resp.get_json()["slow"])
+        self.assertEqual({entry["parameters"] for entry in resp.get_json()["slow"]}, {None})
+        resp = self.client.get("/stats/queries", headers={"X-Profile": "letmein"})
+        self.assertTrue(any("secret" in (entry["parameters"] or "") for entry in resp.get_json()["slow"]))
+
+    def test_failed_explain_is_rolled_back_to_a_savepoint(self):
+        conn = MagicMock()
+        conn.dialect.name = "postgresql"
+        conn.in_transaction.return_value = True
+        cursor = conn.connection.cursor.return_value
+        cursor.execute.side_effect = lambda sql, *args: sql.startswith("EXPLAIN") and 1 / 0
+        self.assertIsNone(explain(conn, "SELECT 1", ()))
+        self.assertEqual([call.args[0] for call in cursor.execute.call_args_list], [
+            "SAVEPOINT profile_explain", "EXPLAIN SELECT 1",
+            "ROLLBACK TO SAVEPOINT profile_explain", "RELEASE SAVEPOINT profile_explain",
+        ])
+
+    def test_repeated_selects_are_reported(self):
+        products = ProductFactory.create_batch(4)
+        Product.create_batch(products)
+        query_profiler.configure(enabled=True, n_plus_one=3)
+        with app.test_request_context(BASE_URL):
+            query_profiler.before_request()
+            for product in products:
+                Product.find_by_name(product.name).all()
+            query_profiler.teardown_request()
+        repeated = query_profiler.snapshot()["n_plus_one"]
+        self.assertEqual(len(repeated), 1)
+        self.assertEqual(repeated[0]["count"], 4)
+        self.assertIn("WHERE product.name", repeated[0]["statement"])
+
+    def test_profile_through_the_debug_header(self):
+        query_profiler.configure(enabled=True, token="letmein", directory=self.directory.name)
+        resp = self.client.get(BASE_URL)
+        self.assertNotIn("X-Profile-Id", resp.headers)
+        resp = self.client.get(BASE_URL, headers={"X-Profile": "wrong"})
+        self.assertNotIn("X-Profile-Id", resp.headers)
+        resp = self.client.get(BASE_URL, headers={"X-Profile": "letmein"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.get(f"/stats/profiles/{resp.headers['X-Profile-Id']}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.get_data(as_text=True).startswith(f"GET {BASE_URL}"))
+        resp = self.client.get("/stats/profiles/../../etc/passwd")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.client.get("/stats/profiles/0123456789abcdef")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
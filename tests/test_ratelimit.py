@@ -0,0 +1,81 @@
+import os
+import logging
+import unittest
+from unittest.mock import patch
+from service import app, status
+from service.models import db, Product
+from service.ratelimit import rate_limiter, MemoryBuckets
+from .factories import ProductFactory
+
+DATABASE_URI = os.getenv(
+    "DATABASE_URI", "sqlite:///" + os.path.join(app.config["BASE_DIR"], "test.db")
+)
+BASE_URL = "/products"
+
+class TestRateLimit(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        app.config["TESTING"] = True
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        Product.init_db(app)
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.saved = (
+            rate_limiter.enabled, rate_limiter.rate, rate_limiter.burst,
+            rate_limiter.max_in_flight, dict(rate_limiter.costs), rate_limiter.api_keys,
+        )
+        rate_limiter.enabled, rate_limiter.rate, rate_limiter.burst = True, 1.0, 10
+        rate_limiter.buckets = MemoryBuckets()
+
+    def tearDown(self):
+        (
+            rate_limiter.enabled, rate_limiter.rate, rate_limiter.burst,
+            rate_limiter.max_in_flight, rate_limiter.costs, rate_limiter.api_keys,
+        ) = self.saved
+        db.session.remove()
+
+    def test_bucket_refills(self):
+        buckets = MemoryBuckets()
+        with patch("service.ratelimit.time.monotonic", side_effect=[0.0, 0.0, 0.5, 2.0]):
+            self.assertEqual(buckets.take("a", 4, 2.0, 4), (True, 0))
+            self.assertEqual(buckets.take("a", 1, 2.0, 4), (False, 0))
+            self.assertEqual(buckets.take("a", 1, 2.0, 4), (True, 0))
+            self.assertEqual(buckets.take("a", 4, 2.0, 4), (False, 3.0))
+
+    def test_expensive_routes_cost_more(self):
+        product = ProductFactory()
+        product.create()
+        resp = self.client.get(f"{BASE_URL}/{product.id}")
+        self.assertEqual(resp.headers["X-RateLimit-Remaining"], "9")
+        rate_limiter.costs["list_products_full"] = 5
+        resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.headers["X-RateLimit-Remaining"], "4")
+        resp = self.client.get(BASE_URL)
+        resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertGreaterEqual(int(resp.headers["Retry-After"]), 1)
+        self.assertEqual(resp.get_json()["error"], "Too Many Requests")
+        # an unknown key does not buy a fresh bucket
+        resp = self.client.get(BASE_URL, headers={"X-API-Key": "made-up"})
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        # other clients and exempt endpoints are unaffected
+        rate_limiter.api_keys = frozenset(["other"])
+        resp = self.client.get(BASE_URL, headers={"X-API-Key": "other"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get("/healthcheck").status_code, status.HTTP_200_OK)
+
+    def test_in_flight_cap_sheds_load(self):
+        rate_limiter.max_in_flight = 1
+        rate_limiter.in_flight = 1  # another thread holds the only slot
+        try:
+            resp = self.client.get(f"{BASE_URL}/0")
+        finally:
+            rate_limiter.in_flight = 0
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+        resp = self.client.get(f"{BASE_URL}/0")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(rate_limiter.in_flight, 0)
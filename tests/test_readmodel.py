@@ -0,0 +1,116 @@
+import os
+import logging
+import tempfile
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+from service import app, status
+from service.models import db, Product, Catalog, Category
+from service.ratelimit import rate_limiter
+from service.readmodel import Snapshot, read_model, write_snapshot
+from .factories import ProductFactory
+
+DATABASE_URI = os.getenv(
+    "DATABASE_URI", "sqlite:///" + os.path.join(app.config["BASE_DIR"], "test.db")
+)
+BASE_URL = "/products"
+
+
+class TestReadModel(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        app.config["TESTING"] = True
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        rate_limiter.enabled = False  # covered by test_ratelimit
+
+    def setUp(self):
+        Product.init_db(app)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "catalog.snapshot")
+        read_model.configure(app, self.path, refresh_interval=60)
+        read_model.enabled = True
+        self.client = app.test_client()
+
+    def tearDown(self):
+        read_model.enabled = False
+        read_model.configure(app, None)
+        db.session.remove()
+        self.directory.cleanup()
+
+    def test_snapshot_round_trip(self):
+        rows = [
+            (1, "Hat", "Wool", Decimal("12.50"), True, Category.CLOTHING, 1),
+            (4, "Pear", None, Decimal("0.99"), False, Category.FOOD, 3),
+            (9, "Café", "", Decimal("100.00"), True, Category.FOOD, 2),
+        ]
+        self.assertEqual(write_snapshot(self.path, rows, 42, "catalog"), 3)
+        snapshot = Snapshot(self.path)
+        self.assertEqual((snapshot.identity, snapshot.count, snapshot.revision), ("catalog", 3, 42))
+        self.assertIsNone(snapshot.position(5))
+        row = snapshot.row(snapshot.position(9))
+        self.assertEqual(row.serialize(), {
+            "id": 9, "name": "Café", "description": "", "price": "100.00",
+            "available": True, "category": "FOOD",
+        })
+        self.assertIsNone(snapshot.row(1).description)
+        self.assertEqual(snapshot.row(1).price, "0.99")
+        self.assertEqual(list(snapshot.positions(Category.FOOD)), [1, 2])
+        self.assertEqual(list(snapshot.positions(Category.FOOD, True)), [2])
+        self.assertEqual(list(snapshot.positions(available=True)), [0, 2])
+
+    def test_reads_are_served_without_queries(self):
+        products = ProductFactory.create_batch(3, category=Category.TOYS)
+        Product.create_batch(products)
+        read_model.load()
+        with patch.object(Product, "find", side_effect=AssertionError("queried")):
+            resp = self.client.get(f"{BASE_URL}/{products[0].id}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), products[0].serialize())
+        self.assertEqual(resp.headers["ETag"], f'"{products[0].id}-1"')
+        with patch.object(Product, "find_by_filters", side_effect=AssertionError("queried")):
+            resp = self.client.get(BASE_URL, query_string="category=TOYS&fields=id,name")
+        self.assertEqual(resp.get_json(), [{"id": p.id, "name": p.name} for p in products])
+
+    def test_writes_reach_the_read_model(self):
+        products = ProductFactory.create_batch(3, category=Category.FOOD, available=True)
+        Product.create_batch(products)
+        read_model.load()
+        first, second = products[0].id, products[1].id
+        resp = self.client.put(
+            f"{BASE_URL}/{first}", json=dict(products[0].serialize(), name="renamed", available=False)
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.delete(f"{BASE_URL}/{second}").status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.client.post(BASE_URL, json=ProductFactory(category=Category.FOOD, available=True).serialize())
+        created = resp.get_json()["id"]
+        self.assertEqual(self.client.get(f"{BASE_URL}/{first}").get_json()["name"], "renamed")
+        self.assertEqual(self.client.get(f"{BASE_URL}/{second}").status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.client.get(BASE_URL, query_string="category=FOOD&available=true")
+        self.assertEqual([item["id"] for item in resp.get_json()], [products[2].id, created])
+        # a rewritten snapshot holds the same catalog without the overlay
+        read_model.load(rebuild=True)
+        self.assertEqual(read_model.overlay, {})
+        resp = self.client.get(BASE_URL, query_string="category=FOOD")
+        self.assertEqual([item["id"] for item in resp.get_json()], [first, products[2].id, created])
+
+    def test_snapshots_of_another_catalog_are_rebuilt(self):
+        old = ProductFactory.create_batch(2)
+        Product.create_batch(old)
+        read_model.load()
+        # init_db deletes without tombstones, so only the identity tells
+        Product.init_db(app)
+        product = ProductFactory()
+        product.create()
+        read_model.configure(app, self.path, refresh_interval=60)
+        read_model.load()
+        self.assertEqual([row.id for row in read_model.find()], [product.id])
+        gone = max(p.id for p in old)  # SQLite hands the lower ids out again
+        self.assertNotEqual(gone, product.id)
+        self.assertEqual(self.client.get(f"{BASE_URL}/{gone}").status_code, status.HTTP_404_NOT_FOUND)
+        # a database restored to before the snapshot was taken
+        write_snapshot(self.path, [], Product.latest_revision() + 1, Catalog.current_identity())
+        read_model.load()
+        self.assertEqual(read_model.snapshot.revision, Product.latest_revision())
+        self.assertEqual([row.id for row in read_model.find()], [product.id])
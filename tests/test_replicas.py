@@ -0,0 +1,127 @@
+import os
+import logging
+import sqlite3
+import tempfile
+import unittest
+from sqlalchemy.dialects import postgresql
+from service import app, status
+from service.models import db, Product
+from service.cache import product_cache
+from service.ratelimit import rate_limiter
+from service.replicas import replica_router, position_query
+from .factories import ProductFactory
+
+DATABASE_URI = os.getenv(
+    "DATABASE_URI", "sqlite:///" + os.path.join(app.config["BASE_DIR"], "test.db")
+)
+BASE_URL = "/products"
+
+
+@unittest.skipUnless(DATABASE_URI.startswith("sqlite:///"), "replicas are SQLite file copies")
+class TestReplicas(unittest.TestCase):
+    """Routing between the primary and a replica, using two SQLite files"""
+
+    @classmethod
+    def setUpClass(cls):
+        app.config["TESTING"] = True
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        rate_limiter.enabled = False  # covered by test_ratelimit
+        Product.init_db(app)
+
+    def setUp(self):
+        db.session.query(Product).delete()
+        db.session.commit()
+        self.saved = (product_cache.enabled, replica_router.max_lag, replica_router.check_interval)
+        product_cache.enabled = False
+        replica_router.max_lag, replica_router.check_interval = 10, 0
+        handle, self.replica_path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        app.config["SQLALCHEMY_BINDS"] = {"replica_0": "sqlite:///" + self.replica_path}
+        replica_router.configure(app, ["replica_0"])
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine(app, "replica_0").dispose()
+        app.config["SQLALCHEMY_BINDS"] = {}
+        replica_router.configure(app, [])
+        product_cache.enabled, replica_router.max_lag, replica_router.check_interval = self.saved
+        os.remove(self.replica_path)
+
+    def replicate(self):
+        """Copies the primary into the replica file, like a replication catch-up"""
+        db.get_engine(app, "replica_0").dispose()
+        primary = sqlite3.connect(DATABASE_URI[len("sqlite:///"):])
+        replica = sqlite3.connect(self.replica_path)
+        with replica:
+            primary.backup(replica)
+        primary.close()
+        replica.close()
+
+    def create_products(self, count):
+        for _ in range(count):
+            ProductFactory().create()
+
+    def test_reads_use_a_replica_within_max_lag(self):
+        self.create_products(2)
+        self.replicate()
+        self.create_products(1)
+        resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        replicas = self.client.get("/stats/replicas").get_json()["replicas"]
+        self.assertEqual(replicas[0]["lag"], 1)
+        self.assertTrue(replicas[0]["healthy"])
+        # too far behind: the primary answers
+        replica_router.max_lag = 0
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 3)
+
+    def test_client_reads_its_own_writes(self):
+        self.create_products(2)
+        self.replicate()
+        other = app.test_client()
+        resp = self.client.post(BASE_URL, json=ProductFactory().serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        product_id = resp.get_json()["id"]
+        # the writer is pinned to the primary until the replica catches up
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 3)
+        self.assertEqual(self.client.get(f"{BASE_URL}/{product_id}").status_code, status.HTTP_200_OK)
+        self.assertEqual(len(other.get(BASE_URL).get_json()), 2)
+        self.replicate()
+        self.assertEqual(len(other.get(BASE_URL).get_json()), 3)
+
+    def test_unhealthy_replica_is_skipped(self):
+        self.create_products(2)
+        # the empty replica file has no tables, so its health check fails
+        resp = self.client.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 2)
+        replica = self.client.get("/stats/replicas").get_json()["replicas"][0]
+        self.assertFalse(replica["healthy"])
+        self.assertIsNotNone(replica["error"])
+        self.replicate()
+        self.client.get(BASE_URL)
+        self.assertTrue(replica_router.replicas["replica_0"].healthy)
+
+    def test_writes_go_to_the_primary(self):
+        self.create_products(1)
+        self.replicate()
+        product = Product.all()[0]
+        resp = self.client.put(
+            f"{BASE_URL}/{product.id}", json=dict(product.serialize(), name="renamed")
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        db.session.remove()
+        self.assertEqual(Product.find(product.id).name, "renamed")
+        with sqlite3.connect(self.replica_path) as replica:
+            name = replica.execute("SELECT name FROM product WHERE id = ?", (product.id,)).fetchone()[0]
+        self.assertNotEqual(name, "renamed")
+
+    def test_postgresql_compares_wal_locations(self):
+        # a txid horizon can trail a committed write while an older
+        # transaction is open, so the pin is the primary's WAL location
+        primary = str(position_query("postgresql", True).compile(dialect=postgresql.dialect()))
+        replica = str(position_query("postgresql", False).compile(dialect=postgresql.dialect()))
+        self.assertIn("pg_current_wal_lsn()", primary)
+        self.assertIn("pg_last_wal_replay_lsn()", replica)
+        self.assertNotIn("txid", primary + replica)
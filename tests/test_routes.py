@@ -1,9 +1,18 @@
 import os
+import gzip
+import json
+import time
 import logging
 import unittest
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
 from urllib.parse import quote_plus
-from service import app, status
-from service.models import db, Product
+from service import app, status, query_args
+from service.models import db, Product, Category
+from service.cache import product_cache
+from service.ratelimit import rate_limiter
+from service.jobs import Job, ThreadExecutor, job_queue, run_job, recover_jobs
 from .factories import ProductFactory
 
 DATABASE_URI = os.getenv(
@@ -20,6 +29,7 @@ class TestProductService(unittest.TestCase):
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
         Product.init_db(app)
+        rate_limiter.enabled = False  # covered by test_ratelimit
 
     @classmethod
     def tearDownClass(cls):
@@ -29,6 +39,7 @@ class TestProductService(unittest.TestCase):
         self.client = app.test_client()
         db.session.query(Product).delete()
         db.session.commit()
+        product_cache.clear()
 
     def tearDown(self):
         db.session.remove()
@@ -132,3 +143,452 @@ class TestProductService(unittest.TestCase):
         self.assertEqual(len(data), available_count)
         for product in data:
             self.assertEqual(product["available"], test_available)
+
+    def test_paginate_product_list(self):
+        self._create_products(5)
+        resp = self.client.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        seen = [product["id"] for product in resp.get_json()]
+        self.assertEqual(len(seen), 2)
+        while "Link" in resp.headers:
+            cursor = resp.headers["X-Next-Cursor"]
+            self.assertIn('rel="next"', resp.headers["Link"])
+            resp = self.client.get(BASE_URL, query_string=f"limit=2&cursor={cursor}")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen.extend(product["id"] for product in resp.get_json())
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_paginate_bad_arguments(self):
+        resp = self.client.get(BASE_URL, query_string="limit=zero")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(BASE_URL, query_string="cursor=not-a-cursor")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # well-formed cursors whose sort key does not fit the sort column
+        for sort, value in [("price", {"a": 1}), ("name", {"a": 1}), ("name", 5), ("price", "NaN")]:
+            cursor = query_args.encode_position({"id": 1, "s": sort, "v": value})
+            resp = self.client.get(BASE_URL, query_string={"sort": sort, "limit": 2, "cursor": cursor})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # a cursor only continues the sort that produced it
+        self._create_products(3)
+        resp = self.client.get(BASE_URL, query_string="sort=-price&limit=2")
+        cursor = resp.headers["X-Next-Cursor"]
+        for sort in ("-price", "price", "name", "id"):
+            resp = self.client.get(BASE_URL, query_string={"sort": sort, "limit": 2, "cursor": cursor})
+            expected = status.HTTP_200_OK if sort == "-price" else status.HTTP_400_BAD_REQUEST
+            self.assertEqual(resp.status_code, expected)
+
+    def test_stream_product_list(self):
+        self._create_products(3)
+        resp = self.client.get(BASE_URL, query_string="stream=ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 3)
+        resp = self.client.get(BASE_URL, query_string="stream=json")
+        self.assertEqual(len(resp.get_json()), 3)
+        resp = self.client.get(BASE_URL, query_string="stream=xml")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_create_products(self):
+        payload = [ProductFactory().serialize() for _ in range(3)]
+        payload[1]["price"] = 1
+        payload[2]["price"] = "2.345"
+        payload.append({"name": "no price"})
+        payload.append(dict(payload[0], price="abc"))
+        payload.append(dict(payload[0], available="yes"))
+        resp = self.client.post(f"{BASE_URL}/batch", json=payload)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        results = resp.get_json()
+        self.assertEqual([r["status"] for r in results], [201, 201, 201, 400, 400, 400])
+        self.assertEqual([r["index"] for r in results[3:]], [3, 4, 5])
+        self.assertIn("price", results[4]["error"])
+        self.assertIsNotNone(results[0]["product"]["id"])
+        # stored, and answered, in cents like a single POST
+        self.assertEqual([r["product"]["price"] for r in results[1:3]], ["1.00", "2.35"])
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 3)
+
+    def test_batch_update_and_delete_products(self):
+        products = self._create_products(2)
+        payload = [product.serialize() for product in products]
+        ids = [data["id"] for data in payload]
+        for data in payload:
+            data["name"] = "batched"
+        payload.append(dict(payload[0], id=ids[-1] + 100))
+        resp = self.client.put(f"{BASE_URL}/batch", json=payload)
+        self.assertEqual([r["status"] for r in resp.get_json()], [200, 200, 404])
+        data = self.client.get(f"{BASE_URL}/{ids[0]}").get_json()
+        self.assertEqual(data["name"], "batched")
+        resp = self.client.delete(f"{BASE_URL}/batch", json=ids + ["x"])
+        self.assertEqual([r["status"] for r in resp.get_json()], [204, 204, 400])
+        self.assertEqual(self.client.get(BASE_URL).get_json(), [])
+
+    def test_batch_requires_array(self):
+        resp = self.client.post(f"{BASE_URL}/batch", json={"name": "x"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_combined_filters(self):
+        products = self._create_products(20)
+        category = products[0].category
+        expected = [
+            p for p in products
+            if p.category == category and not p.available and p.price >= 30
+        ]
+        resp = self.client.get(
+            BASE_URL,
+            query_string=f"category={category.name}&available=false&price_min=30&sort=-price",
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), len(expected))
+        prices = [Decimal(product["price"]) for product in data]
+        self.assertEqual(prices, sorted(prices, reverse=True))
+
+    def test_paginate_sorted_by_name(self):
+        self._create_products(6)
+        resp = self.client.get(BASE_URL, query_string="limit=4&sort=name")
+        names = [product["name"] for product in resp.get_json()]
+        cursor = resp.headers["X-Next-Cursor"]
+        resp = self.client.get(BASE_URL, query_string=f"limit=4&sort=name&cursor={cursor}")
+        names.extend(product["name"] for product in resp.get_json())
+        self.assertEqual(len(names), 6)
+        self.assertEqual(names, sorted(names))
+
+    def test_query_bad_filters(self):
+        for query in ["category=SHOES", "price_min=cheap", "price_min=sNaN", "price_max=Infinity",
+                      "sort=description"]:
+            resp = self.client.get(BASE_URL, query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_product_etag(self):
+        test_product = self._create_products(1)[0]
+        resp = self.client.get(f"{BASE_URL}/{test_product.id}")
+        etag = resp.headers["ETag"]
+        resp = self.client.get(
+            f"{BASE_URL}/{test_product.id}", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        data = test_product.serialize()
+        data["name"] = "changed"
+        resp = self.client.put(f"{BASE_URL}/{data['id']}", json=data)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        resp = self.client.get(f"{BASE_URL}/{data['id']}", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["name"], "changed")
+
+    def test_list_cache_invalidated_on_create(self):
+        self._create_products(2)
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 2)
+        resp = self.client.post(BASE_URL, json=ProductFactory().serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 3)
+
+    def test_metrics(self):
+        self._create_products(2)
+        self.client.get(BASE_URL)
+        self.client.get(f"{BASE_URL}/0")
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        text = resp.get_data(as_text=True)
+        self.assertIn(
+            'http_requests_total{endpoint="/products",method="GET",status="200"}', text
+        )
+        self.assertIn(
+            'http_requests_total{endpoint="/products/<int:product_id>",method="GET",status="404"}',
+            text,
+        )
+        self.assertIn("http_request_db_seconds_bucket", text)
+        self.assertIn("http_requests_in_progress", text)
+
+    def test_search_products(self):
+        products = [ProductFactory(name=f"Lamp {n}", description="desk lamp") for n in range(3)]
+        Product.create_batch(products + ProductFactory.create_batch(3, description="other"))
+        resp = self.client.get(BASE_URL, query_string="q=lamp&limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        names = [product["name"] for product in resp.get_json()]
+        cursor = resp.headers["X-Next-Cursor"]
+        resp = self.client.get(BASE_URL, query_string=f"q=lamp&limit=2&cursor={cursor}")
+        names.extend(product["name"] for product in resp.get_json())
+        self.assertEqual(sorted(names), ["Lamp 0", "Lamp 1", "Lamp 2"])
+        self.assertNotIn("X-Next-Cursor", resp.headers)
+        resp = self.client.get(BASE_URL, query_string="q=%3F%3F")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_field_selection(self):
+        products = self._create_products(3)
+        product_id = products[0].id
+        resp = self.client.get(BASE_URL, query_string="fields=name,id,price")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        for data in resp.get_json():
+            self.assertEqual(set(data), {"id", "name", "price"})
+        resp = self.client.get(BASE_URL, query_string="fields=name&limit=2&sort=price")
+        self.assertEqual([set(data) for data in resp.get_json()], [{"name"}, {"name"}])
+        self.assertIn("X-Next-Cursor", resp.headers)
+        resp = self.client.get(f"{BASE_URL}/{product_id}", query_string="fields=price")
+        self.assertEqual(list(resp.get_json()), ["price"])
+        partial_etag = resp.headers["ETag"]
+        resp = self.client.get(f"{BASE_URL}/{product_id}")
+        self.assertEqual(len(resp.get_json()), 6)
+        self.assertNotEqual(resp.headers["ETag"], partial_etag)
+        resp = self.client.get(f"{BASE_URL}/{product_id}", query_string="fields=price")
+        self.assertEqual(resp.headers["ETag"], partial_etag)
+        resp = self.client.get(BASE_URL, query_string="fields=name,secret")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_compressed_responses(self):
+        self._create_products(20)
+        resp = self.client.get(BASE_URL, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertEqual(len(json.loads(gzip.decompress(resp.data))), 20)
+        resp = self.client.get(BASE_URL, query_string="limit=1", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+        resp = self.client.get(
+            BASE_URL, query_string="stream=ndjson", headers={"Accept-Encoding": "gzip"}
+        )
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        lines = gzip.decompress(resp.data).splitlines()
+        self.assertEqual(len(lines), 20)
+
+    def test_list_not_modified(self):
+        self._create_products(2)
+        resp = self.client.get(BASE_URL)
+        etag = resp.headers["ETag"]
+        self.assertTrue(etag.startswith("W/"))
+        self.assertIn("Last-Modified", resp.headers)
+        resp = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, b"")
+        self.client.post(BASE_URL, json=ProductFactory().serialize())
+        resp = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 3)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        # a write by another worker never touches this worker's cache, only the table
+        etag = resp.headers["ETag"]
+        with patch.object(product_cache, "invalidate"):
+            ProductFactory().create()
+        product_cache.clear()
+        resp = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 4)
+
+    def test_change_feed(self):
+        since = query_args.encode_revision_token(Product.latest_revision())
+        products = self._create_products(3)
+        deleted_id = products[0].id
+        self.client.delete(f"{BASE_URL}/{deleted_id}")
+        resp = self.client.get(f"{BASE_URL}/changes", query_string=f"since={since}&limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        page = resp.get_json()
+        self.assertTrue(page["more"])
+        self.assertIn("Link", resp.headers)
+        self.assertEqual(len(page["changes"]), 2)
+        resp = self.client.get(f"{BASE_URL}/changes", query_string=f"since={page['next']}")
+        page = resp.get_json()
+        self.assertFalse(page["more"])
+        self.assertEqual(page["changes"][-1]["id"], deleted_id)
+        self.assertTrue(page["changes"][-1]["deleted"])
+        resp = self.client.get(f"{BASE_URL}/changes", query_string=f"since={page['next']}&wait=0.6")
+        self.assertEqual(resp.get_json(), {"changes": [], "next": page["next"], "more": False})
+        resp = self.client.get(f"{BASE_URL}/changes", query_string="since=bogus")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        token = query_args.encode_revision_token(7, 3)
+        self.assertEqual(query_args.decode_revision_token(token), (7, 3))
+        self.assertEqual(query_args.decode_revision_token(query_args.encode_revision_token(7)), (7, None))
+
+    def test_if_match_preconditions(self):
+        product = self._create_products(1)[0]
+        data = product.serialize()
+        url = f"{BASE_URL}/{data['id']}"
+        etag = self.client.get(url).headers["ETag"]
+        resp = self.client.put(url, json=dict(data, name="first"), headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.put(url, json=dict(data, name="second"), headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.client.get(url).get_json()["name"], "first")
+        resp = self.client.delete(url, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        current = self.client.get(url).headers["ETag"]
+        resp = self.client.delete(url, headers={"If-Match": f"W/{current}"})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.client.delete(url, headers={"If-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_patch_product(self):
+        product = self._create_products(1)[0]
+        data = product.serialize()
+        url = f"{BASE_URL}/{data['id']}"
+        etag = self.client.get(url).headers["ETag"]
+        resp = self.client.patch(url, json={"available": False, "price": "12.50"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        patched = resp.get_json()
+        self.assertEqual(patched, dict(data, available=False, price="12.50"))
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertEqual(self.client.get(url).get_json(), patched)
+        resp = self.client.patch(url, json={"name": "stale"}, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        current = self.client.get(url).headers["ETag"]
+        resp = self.client.patch(url, json={"name": "fresh"}, headers={"If-Match": current})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["name"], "fresh")
+        for body in ({"price": "cheap"}, {"available": "yes"}, {"colour": "red"}, {}, {"category": "SHOES"}):
+            resp = self.client.patch(url, json=body)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, body)
+        resp = self.client.patch(f"{BASE_URL}/0", json={"available": True})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_product_stats(self):
+        prices = [("FOOD", True, "1.00"), ("FOOD", True, "3.00"), ("FOOD", False, "8.00"), ("TOYS", False, "5.50")]
+        Product.create_batch([
+            ProductFactory(category=getattr(Category, name), available=available, price=Decimal(price))
+            for name, available, price in prices
+        ])
+        resp = self.client.get(f"{BASE_URL}/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        stats = resp.get_json()
+        self.assertEqual(stats["total"], 4)
+        food = stats["categories"]["FOOD"]
+        self.assertEqual((food["count"], food["available"], food["availability_ratio"]), (3, 2, 0.6667))
+        self.assertEqual((food["min_price"], food["avg_price"], food["max_price"]), ("1.00", "4.00", "8.00"))
+        self.assertEqual(
+            food["groups"],
+            [
+                {"available": False, "count": 1, "min_price": "8.00", "avg_price": "8.00", "max_price": "8.00"},
+                {"available": True, "count": 2, "min_price": "1.00", "avg_price": "2.00", "max_price": "3.00"},
+            ],
+        )
+        self.assertEqual(stats["categories"]["TOYS"]["availability_ratio"], 0)
+        resp = self.client.get(f"{BASE_URL}/stats", headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_import_and_export(self):
+        csv_body = (
+            "name,description,price,available,category\n"
+            "Hat,A nice hat,10.00,true,CLOTHING\n"
+            "Apple,,0.50,false,FOOD\n"
+            "Broken,,cheap,true,FOOD\n"
+        )
+        app.config["IMPORT_CHUNK_SIZE"] = 1
+        resp = self.client.post(f"{BASE_URL}/import", data=csv_body, content_type="text/csv")
+        app.config["IMPORT_CHUNK_SIZE"] = 1000
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        summary = resp.get_json()
+        self.assertEqual((summary["imported"], summary["failed"]), (2, 1))
+        self.assertEqual(summary["errors"], [{"line": 4, "error": "Invalid product: price must be a number"}])
+        ndjson_body = "\n".join(
+            json.dumps(dict(ProductFactory().serialize(), id=None)) for _ in range(3)
+        ) + "\nnot json\n" + json.dumps(dict(ProductFactory().serialize(), colour="red")) + "\n"
+        resp = self.client.post(f"{BASE_URL}/import", data=ndjson_body, content_type="application/x-ndjson")
+        self.assertEqual(resp.get_json()["imported"], 3)
+        self.assertEqual(resp.get_json()["errors"], [
+            {"line": 4, "error": "Invalid JSON"},
+            {"line": 5, "error": "Invalid product: unknown fields colour"},
+        ])
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 5)
+
+        resp = self.client.get(f"{BASE_URL}/export")
+        self.assertEqual(resp.mimetype, "text/csv")
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], "id,name,description,price,available,category")
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[1].endswith(",Hat,A nice hat,10.00,true,CLOTHING"))
+        resp = self.client.get(f"{BASE_URL}/export", query_string="format=ndjson&category=FOOD")
+        self.assertEqual(json.loads(resp.data.splitlines()[0])["name"], "Apple")
+        exported = self.client.get(f"{BASE_URL}/export").data
+        resp = self.client.post(f"{BASE_URL}/import", data=exported, content_type="text/csv")
+        self.assertEqual(resp.get_json()["imported"], 5)
+        resp = self.client.post(f"{BASE_URL}/import", data="x", content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def wait_for_job(self, url):
+        for _ in range(200):
+            job = self.client.get(url).get_json()
+            if job["status"] not in ("queued", "running"):
+                return job
+            time.sleep(0.02)
+        self.fail(f"{url} did not finish")
+
+    def test_background_jobs(self):
+        body = "name,price,available,category\n" + "".join(
+            f"Item {n},{n}.00,true,FOOD\n" for n in range(1, 6)
+        )
+        resp = self.client.post("/jobs/import", data=body, content_type="text/csv")
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        job = self.wait_for_job(resp.headers["Location"])
+        self.assertEqual(job["status"], "succeeded")
+        self.assertEqual(job["result"]["imported"], 5)
+        self.assertEqual(job["progress"]["done"], 5)
+
+        resp = self.client.post(
+            "/jobs/price-change", json={"percent": 10, "filters": {"category": "FOOD"}}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        job = self.wait_for_job(resp.headers["Location"])
+        self.assertEqual((job["status"], job["result"]), ("succeeded", {"updated": 5}))
+        prices = sorted(product["price"] for product in self.client.get(BASE_URL).get_json())
+        self.assertEqual(prices, ["1.10", "2.20", "3.30", "4.40", "5.50"])
+        resp = self.client.delete(resp.headers["Location"])
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn(job["id"], [job["id"] for job in self.client.get("/jobs").get_json()])
+
+        resp = self.client.post("/jobs/price-change", json={"percent": -100})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.post("/jobs/price-change", json={"percent": 5, "filters": {"category": "SHOES"}})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get("/jobs/missing").status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cancel_queued_job(self):
+        with patch.object(job_queue, "executor") as executor:
+            resp = self.client.post("/jobs/price-change", json={"percent": 5})
+            job_id = resp.get_json()["id"]
+            executor.submit.assert_called_once_with(job_id)
+        resp = self.client.delete(f"/jobs/{job_id}")
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(resp.get_json()["status"], "cancelled")
+        run_job(job_id)
+        self.assertEqual(self.client.get(f"/jobs/{job_id}").get_json()["started_at"], None)
+
+    def test_malformed_csv_imports_nothing(self):
+        header = "name,description,price,available,category\n"
+        good = "Hat,A nice hat,10.00,true,CLOTHING\n"
+        app.config["IMPORT_CHUNK_SIZE"] = 1
+        for body, line in (
+            ((header + good * 3).encode() + b"Caf\xe9,,1.00,true,FOOD\n", 5),
+            (header + good + 'Quote,"misquoted"!,1.00,true,FOOD\n' + good, 3),
+        ):
+            resp = self.client.post(f"{BASE_URL}/import", data=body, content_type="text/csv")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn(f"line {line}", resp.get_data(as_text=True))
+        app.config["IMPORT_CHUNK_SIZE"] = 1000
+        self.assertEqual(self.client.get(BASE_URL).get_json(), [])
+
+    def test_cancelled_import_removes_its_upload(self):
+        with patch.object(job_queue, "executor"):
+            resp = self.client.post("/jobs/import", data="name,price\n", content_type="text/csv")
+        job_id = resp.get_json()["id"]
+        path = Job.query.get(job_id).params["path"]
+        self.assertTrue(os.path.exists(path))
+        self.client.delete(f"/jobs/{job_id}")
+        self.assertFalse(os.path.exists(path))
+        run_job(job_id)  # the queued call still arrives, and finds nothing to do
+
+    def test_recover_abandoned_jobs(self):
+        Job.query.delete()
+        db.session.commit()
+        long_ago = datetime.utcnow() - timedelta(hours=1)
+        with patch.object(job_queue, "executor"):
+            running = Job.submit("price_change", percent=5, filters={})
+            queued = Job.submit("price_change", percent=5, filters={})
+            fresh = Job.submit("price_change", percent=5, filters={})
+        Job.query.filter_by(id=running.id).update({"status": "running", "heartbeat_at": long_ago})
+        Job.query.filter_by(id=queued.id).update({"created_at": long_ago})
+        db.session.commit()
+        ids = (running.id, queued.id, fresh.id)
+        executor = MagicMock(spec=ThreadExecutor)
+        with patch.object(job_queue, "executor", executor):
+            recover_jobs(app)
+        executor.submit.assert_called_once_with(ids[1])
+        statuses = [self.client.get(f"/jobs/{job_id}").get_json()["status"] for job_id in ids]
+        self.assertEqual(statuses, ["failed", "queued", "queued"])
@@ -0,0 +1,194 @@
+import os
+import json
+import logging
+import tempfile
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+from sqlalchemy import event
+from service import app, status
+from service.models import db, Product, Category, DataValidationError, id_allocator
+from service.cache import product_cache
+from service.ratelimit import rate_limiter
+from service.sharding import shard_set, ShardingError
+from .factories import ProductFactory
+
+DATABASE_URI = os.getenv(
+    "DATABASE_URI", "sqlite:///" + os.path.join(app.config["BASE_DIR"], "test.db")
+)
+BASE_URL = "/products"
+SHARDS = ("shard_0", "shard_1")
+
+
+class TestSharding(unittest.TestCase):
+    """Products spread over two SQLite shard files"""
+
+    @classmethod
+    def setUpClass(cls):
+        app.config["TESTING"] = True
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        rate_limiter.enabled = False  # covered by test_ratelimit
+        cls.directory = tempfile.TemporaryDirectory()
+        app.config["SQLALCHEMY_BINDS"] = {
+            shard: "sqlite:///" + os.path.join(cls.directory.name, shard + ".db") for shard in SHARDS
+        }
+        shard_set.configure(app, SHARDS)
+        db.session.remove()  # sessions made from now on route to the shards
+        cls.saved_cache = product_cache.enabled
+        product_cache.enabled = False
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        for shard in SHARDS:
+            db.get_engine(app, shard).dispose()
+        shard_set.configure(app, [])
+        app.config["SQLALCHEMY_BINDS"] = {}
+        product_cache.enabled = cls.saved_cache
+        cls.directory.cleanup()
+
+    def setUp(self):
+        Product.init_db(app)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+
+    def shard_ids(self, shard):
+        with db.get_engine(app, shard).connect() as connection:
+            return {row.id for row in connection.execute(db.text("SELECT id FROM product"))}
+
+    def test_ids_are_unique_across_shards(self):
+        products = ProductFactory.create_batch(6)
+        for product in products[:3]:
+            product.create()
+        Product.create_batch(products[3:])
+        ids = [product.id for product in products]
+        self.assertEqual(len(set(ids)), 6)
+        self.assertEqual(self.shard_ids("shard_0") | self.shard_ids("shard_1"), set(ids))
+        self.assertTrue(self.shard_ids("shard_0") and self.shard_ids("shard_1"))
+        for product_id in ids:
+            self.assertIn(product_id, self.shard_ids(shard_set.shard_for(product_id)))
+        self.assertEqual(id_allocator.allocate(2)[0], max(ids) + 1)
+
+    def test_point_lookups_updates_and_deletes_are_routed(self):
+        products = ProductFactory.create_batch(4)
+        for product in products:
+            product.create()
+        ids = [product.id for product in products]
+        product = Product.find(ids[1])
+        self.assertEqual(product.name, products[1].name)
+        product.name = "renamed"
+        product.update()
+        db.session.remove()
+        self.assertEqual(Product.find(ids[1]).name, "renamed")
+        self.assertEqual(Product.find(ids[1]).version, 2)
+        Product.find(ids[2]).delete()
+        self.assertIsNone(Product.find(ids[2]))
+        patched = Product.patch(ids[3], {"price": Decimal("1.50")})
+        self.assertEqual(patched.price, Decimal("1.50"))
+        self.assertEqual(len(Product.all()), 3)
+
+    def test_list_pages_merge_across_shards(self):
+        products = ProductFactory.create_batch(7)
+        Product.create_batch(products)
+        resp = self.client.get(BASE_URL, query_string="sort=-price&limit=3")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        prices = [float(item["price"]) for item in resp.get_json()]
+        while "X-Next-Cursor" in resp.headers:
+            resp = self.client.get(
+                BASE_URL,
+                query_string={"sort": "-price", "limit": 3, "cursor": resp.headers["X-Next-Cursor"]},
+            )
+            prices += [float(item["price"]) for item in resp.get_json()]
+        self.assertEqual(prices, sorted((float(p.price) for p in products), reverse=True))
+        self.assertEqual(Product.find_by_category(products[0].category).count(),
+                         sum(1 for p in products if p.category == products[0].category))
+
+    def test_streams_merge_live_shard_results(self):
+        products = ProductFactory.create_batch(7)
+        Product.create_batch(products)
+        batch_size, app.config["STREAM_BATCH_SIZE"] = app.config.get("STREAM_BATCH_SIZE"), 2
+        try:
+            # nothing is buffered: each shard is read a batch at a time
+            with patch("sqlalchemy.engine.Result.freeze", side_effect=AssertionError("buffered")):
+                resp = self.client.get(BASE_URL, query_string="stream=ndjson&sort=-price")
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                lines = resp.get_data(as_text=True).splitlines()
+                export = self.client.get(f"{BASE_URL}/export", query_string="format=csv")
+                self.assertEqual(export.status_code, status.HTTP_200_OK)
+                exported = export.get_data(as_text=True).splitlines()
+        finally:
+            app.config["STREAM_BATCH_SIZE"] = batch_size
+        prices = [Decimal(json.loads(line)["price"]) for line in lines]
+        self.assertEqual(prices, sorted((product.price for product in products), reverse=True))
+        self.assertEqual(len(exported), 8)
+        ids = [int(line.split(",")[0]) for line in exported[1:]]
+        self.assertEqual(ids, sorted(product.id for product in products))
+
+    def test_stats_and_changes_combine_shards(self):
+        products = [ProductFactory(category=Category.FOOD, available=True, price=price)
+                    for price in ("1.00", "2.00", "3.00", "4.00")]
+        Product.create_batch(products)
+        resp = self.client.get(f"{BASE_URL}/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        food = resp.get_json()["categories"]["FOOD"]
+        self.assertEqual(food["count"], 4)
+        self.assertEqual(food["min_price"], "1.00")
+        self.assertEqual(food["max_price"], "4.00")
+        changes = Product.changes(0, limit=3)
+        self.assertEqual([change.revision for change in changes],
+                         sorted(product.revision for product in products)[:3])
+
+    def test_batch_update_and_delete(self):
+        products = ProductFactory.create_batch(4)
+        Product.create_batch(products)
+        for product in products:
+            product.name = "batch"
+        self.assertEqual(Product.update_batch(products), {p.id for p in products})
+        self.assertEqual({p.name for p in Product.all()}, {"batch"})
+        Product.delete_batch([p.id for p in products[:2]])
+        self.assertEqual(len(Product.all()), 2)
+
+    def test_scattered_writes_report_every_shard(self):
+        products = ProductFactory.create_batch(6)
+        Product.create_batch(products)
+        count = Product.query.filter(Product.id.in_([p.id for p in products])).update(
+            {"name": "renamed"}, synchronize_session=False
+        )
+        self.assertEqual(count, 6)
+        db.session.commit()
+        self.assertEqual(Product.query.delete(), 6)
+
+    def test_unmergeable_queries_are_refused(self):
+        products = [ProductFactory(name=f"widget {index}") for index in range(4)]
+        Product.create_batch(products)
+        # ranks are per shard, so ranked search is refused; the unranked match merges on id
+        for dialect, fts_index in (("postgresql", None), ("sqlite", True)):
+            self.assertRaises(DataValidationError, Product.search, "widget",
+                              dialect=dialect, fts_index=fts_index)
+        found = Product.search("widget", dialect="sqlite", fts_index=False).all()
+        self.assertEqual([p.id for p in found], sorted(p.id for p in products))
+        self.assertRaises(ShardingError, db.session.query(db.func.avg(Product.price)).scalar)
+        distinct = db.func.count(db.distinct(Product.category)).label("categories")
+        self.assertRaises(ShardingError, db.session.query(distinct).scalar)
+
+    def test_shards_commit_before_the_primary(self):
+        commits = []
+        engines = {db.get_engine(app): "primary"}
+        engines.update({db.get_engine(app, shard): shard for shard in SHARDS})
+        listeners = [(engine, lambda connection, name=name: commits.append(name)) for engine, name in engines.items()]
+        for engine, listener in listeners:
+            event.listen(engine, "commit", listener)
+        try:
+            for product in ProductFactory.create_batch(2):
+                product.create()
+        finally:
+            for engine, listener in listeners:
+                event.remove(engine, "commit", listener)
+        # the primary publishes each product's revision after its row is on the shard
+        self.assertEqual(commits.count("primary"), 2)
+        self.assertEqual(commits[1], "primary")
+        self.assertEqual(commits[3], "primary")
+        self.assertEqual(len(commits), 4)
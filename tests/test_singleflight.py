@@ -0,0 +1,112 @@
+import os
+import time
+import logging
+import threading
+import unittest
+from unittest.mock import patch
+from service import app, status, routes
+from service.models import db, Product
+from service.ratelimit import rate_limiter
+from service.singleflight import SingleFlight, request_flights
+
+DATABASE_URI = os.getenv(
+    "DATABASE_URI", "sqlite:///" + os.path.join(app.config["BASE_DIR"], "test.db")
+)
+BASE_URL = "/products"
+
+
+def wait_for_waiters(flights, count):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with flights._lock:  # pylint: disable=protected-access
+            if sum(call.waiters for call in flights._calls.values()) >= count:  # pylint: disable=protected-access
+                return
+        time.sleep(0.001)
+    raise AssertionError("followers never joined the flight")
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        app.config["TESTING"] = True
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        rate_limiter.enabled = False  # covered by test_ratelimit
+        Product.init_db(app)
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_followers_share_the_result(self):
+        flights = SingleFlight()
+        release, calls, results = threading.Event(), [], []
+
+        def work():
+            calls.append(1)
+            release.wait(5)
+            return "rows"
+
+        threads = run_threads(4, lambda: results.append(flights.do("key", work)))
+        wait_for_waiters(flights, 3)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [("rows", False)] + [("rows", True)] * 3)
+        self.assertEqual(flights.in_flight(), 0)
+        # the flight is over, so the next call runs again
+        self.assertEqual(flights.do("key", lambda: "fresh"), ("fresh", False))
+
+    def test_followers_see_the_leaders_error(self):
+        flights = SingleFlight()
+        release, errors = threading.Event(), []
+
+        def work():
+            release.wait(5)
+            raise ValueError("query failed")
+
+        def call():
+            try:
+                flights.do("key", work)
+            except ValueError as error:
+                errors.append(str(error))
+
+        threads = run_threads(3, call)
+        wait_for_waiters(flights, 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, ["query failed"] * 3)
+
+    def test_identical_requests_share_one_response(self):
+        release, calls, responses = threading.Event(), [], []
+        query_stats = routes.query_stats
+
+        def slow_stats():
+            calls.append(1)
+            release.wait(5)
+            return query_stats()
+
+        def get():
+            with app.test_client() as client:
+                resp = client.get(f"{BASE_URL}/stats")
+                responses.append((resp.status_code, resp.get_data()))
+
+        with patch.object(routes, "query_stats", side_effect=slow_stats):
+            threads = run_threads(3, get)
+            wait_for_waiters(request_flights, 2)
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(responses), 3)
+        self.assertEqual({code for code, _ in responses}, {status.HTTP_200_OK})
+        self.assertEqual(len({body for _, body in responses}), 1)